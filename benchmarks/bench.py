@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks of oneslate.py against the local mock server.
+
+Usage:
+  bench.py [options]
+
+Options:
+  -h --help                 Show this screen.
+  -n --ops=<n>              Operations per benchmark and mode [default: 200].
+  -w --workers=<n>          Threads, or requests in flight for async
+                            [default: 16].
+  --repeat=<n>              Runs of each benchmark; the median run is
+                            reported [default: 3].
+  --only=<names>            Comma separated benchmarks to run, of bootstrap,
+                            resume, create, search, rate and tree
+                            [default: all].
+  --modes=<modes>           Comma separated modes, of sequential, threads and
+                            async [default: sequential,threads,async].
+  --latency=<seconds>       Server latency per request [default: 0.005].
+  --jitter=<seconds>        Random extra server latency [default: 0].
+  --error-rate=<fraction>   Fraction of requests failed with 503/429
+                            [default: 0].
+  --seed=<n>                Seed for the server and the workload [default: 1].
+  --json=<file>             Write the results to a JSON file.
+  --compare=<file>          Compare with results saved earlier by --json.
+
+The server runs in its own process so it does not compete with the client for
+the interpreter lock.  Every benchmark reports operations per second over the
+whole run and the p50/p99 latency of single operations, retries included.
+"""
+
+import asyncio
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import oneslate
+import mock_server
+
+BENCHMARKS = ('bootstrap', 'resume', 'create', 'search', 'rate', 'tree')
+MODES = ('sequential', 'threads', 'async')
+USER = 'bench@example.com'
+PASSWORD = 'bench'
+
+
+def serve(settings, url_queue):
+    server = mock_server.MockServer(('127.0.0.1', 0),
+                                    mock_server.MockState(**settings))
+    url_queue.put(server.url)
+    server.serve_forever()
+
+def start_server_process(settings):
+    # Returns (process, base URL) of a mock server in a child process.
+    url_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(settings, url_queue),
+                                      daemon=True)
+    process.start()
+    return process, url_queue.get(timeout=10)
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def timed(operation):
+    # Wraps operation(item) to return (latency, succeeded).
+    def run(item):
+        started = time.perf_counter()
+        try:
+            succeeded = operation(item) not in (None, False)
+        except Exception as e:
+            logging.debug("Operation failed: {0}".format(e))
+            succeeded = False
+        return time.perf_counter() - started, succeeded
+    return run
+
+def run_sync(operation, items, mode, workers):
+    if mode == 'sequential':
+        return [timed(operation)(item) for item in items]
+    return list(oneslate.iter_bounded(timed(operation), items, workers))
+
+def run_async(coroutine_function, items, server, session, token, workers):
+    async def run_all():
+        from oneslate_async import AsyncOneslateClient
+        async with AsyncOneslateClient.from_session(
+                server, session, token, max_concurrency=workers) as client:
+            # timed from when a slot is free, as in threads mode
+            slots = asyncio.Semaphore(workers)
+            async def run(item):
+                async with slots:
+                    started = time.perf_counter()
+                    try:
+                        result = await coroutine_function(client, item)
+                        succeeded = result not in (None, False)
+                    except Exception as e:
+                        logging.debug("Operation failed: {0}".format(e))
+                        succeeded = False
+                    return time.perf_counter() - started, succeeded
+            return await asyncio.gather(*(run(item) for item in items))
+    return asyncio.run(run_all())
+
+class Workload(object):
+    # Server URL, a signed-in session and the nodes seeded before timing.
+
+    def __init__(self, server, ops, workers, seed):
+        self.server = server
+        self.ops = ops
+        self.workers = workers
+        self.random = random.Random(seed)
+        self.cookies_file = os.path.join(tempfile.mkdtemp(), 'cookies')
+        self.session, self.token = oneslate.get_session(server, None, USER,
+                                                        PASSWORD)
+        oneslate.save_session(self.session, self.cookies_file)
+        titles = ['Seed claim {0} about topic {1}'.format(index, index % 10)
+                  for index in range(max(ops, 50))]
+        self.node_ids = [result.node_id for result in oneslate.iter_add_nodes(
+            server, self.session, self.token, titles, workers)
+            if result.node_id is not None]
+        # every node supports the one at half its position, forming a tree
+        links = [(self.node_ids[index // 2], self.node_ids[index])
+                 for index in range(1, len(self.node_ids))]
+        list(oneslate.iter_bounded(
+            lambda link: oneslate.add_support_link(server, self.session,
+                                                   self.token, *link),
+            links, workers))
+
+    def sample_ids(self):
+        return [self.random.choice(self.node_ids) for _ in range(self.ops)]
+
+def bench_bootstrap(workload, mode):
+    # Fresh logins: sign in page, login POST and CSRF token extraction.
+    if mode == 'async':
+        return None
+    return run_sync(lambda item: oneslate.get_session(
+        workload.server, None, USER, PASSWORD)[1], range(workload.ops), mode,
+        workload.workers)
+
+def bench_resume(workload, mode):
+    # Sessions rebuilt from a saved cookies file and CSRF token.
+    if mode != 'sequential':
+        return None
+    return run_sync(lambda item: oneslate.get_session(
+        workload.server, workload.cookies_file, USER, PASSWORD)[1],
+        range(workload.ops), mode, workload.workers)
+
+def bench_create(workload, mode):
+    titles = ['Benchmark claim {0} {1}'.format(mode, index)
+              for index in range(workload.ops)]
+    if mode == 'async':
+        return run_async(lambda client, title: client.add_node(title), titles,
+                         workload.server, workload.session, workload.token,
+                         workload.workers)
+    return run_sync(lambda title: oneslate.post_node(
+        workload.server, workload.session, workload.token, title).node_id,
+        titles, mode, workload.workers)
+
+def bench_search(workload, mode):
+    terms = ['topic {0}'.format(workload.random.randrange(10))
+             for _ in range(workload.ops)]
+    if mode == 'async':
+        return run_async(lambda client, term: client.search_nodes(term), terms,
+                         workload.server, workload.session, workload.token,
+                         workload.workers)
+    return run_sync(lambda term: list(oneslate.iter_search_results(
+        workload.server, workload.session, workload.token, term)), terms,
+        mode, workload.workers)
+
+def bench_rate(workload, mode):
+    node_ids = workload.sample_ids()
+    if mode == 'async':
+        return run_async(
+            lambda client, node_id: client.rate_node(node_id, node_id % 5),
+            node_ids, workload.server, workload.session, workload.token,
+            workload.workers)
+    return run_sync(lambda node_id: oneslate.post_rating(
+        workload.server, workload.session, workload.token, node_id,
+        node_id % 5).ok, node_ids, mode, workload.workers)
+
+def bench_tree(workload, mode):
+    node_ids = workload.sample_ids()
+    if mode == 'async':
+        return run_async(lambda client, node_id: client.list_supports(node_id),
+                         node_ids, workload.server, workload.session,
+                         workload.token, workload.workers)
+    return run_sync(lambda node_id: oneslate.get_tree(
+        workload.server, workload.session, workload.token, node_id), node_ids,
+        mode, workload.workers)
+
+# Each returns [(latency, succeeded), ...], or None for modes it lacks.
+BENCHMARK_FUNCTIONS = {
+    'bootstrap': bench_bootstrap,
+    'resume': bench_resume,
+    'create': bench_create,
+    'search': bench_search,
+    'rate': bench_rate,
+    'tree': bench_tree,
+}
+
+def run_benchmark(workload, name, mode, repeat):
+    # Returns the result dict of the median of repeat runs, or None if the
+    # benchmark has no such mode.
+    runs = []
+    for _ in range(repeat):
+        oneslate.argument_graph.clear()
+        started = time.perf_counter()
+        samples = BENCHMARK_FUNCTIONS[name](workload, mode)
+        elapsed = time.perf_counter() - started
+        if samples is None:
+            return None
+        latencies = [latency for latency, succeeded in samples]
+        runs.append({
+            'benchmark': name, 'mode': mode, 'ops': len(samples),
+            'errors': sum(1 for latency, succeeded in samples
+                          if not succeeded),
+            'seconds': elapsed, 'ops_per_second': len(samples) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        })
+    runs.sort(key=lambda run: run['ops_per_second'])
+    return runs[len(runs) // 2]
+
+def format_results(results, baseline=None):
+    lines = ['{0: <10}| {1: <11}| {2: >6} | {3: >6} | {4: >9} | {5: >8} | '
+             '{6: >8}{7}'.format('benchmark', 'mode', 'ops', 'errors',
+                                 'ops/sec', 'p50 ms', 'p99 ms',
+                                 ' | vs baseline' if baseline else '')]
+    lines.append('-' * 10 + '+' + '-' * (len(lines[0]) - 11))
+    for result in results:
+        change = ''
+        previous = (baseline or {}).get((result['benchmark'], result['mode']))
+        if previous is not None:
+            change = ' | {0:+.1f}% ops/sec, {1:+.1f}% p99'.format(
+                100 * (result['ops_per_second'] /
+                       previous['ops_per_second'] - 1),
+                100 * (result['p99_ms'] / previous['p99_ms'] - 1))
+        lines.append('{benchmark: <10}| {mode: <11}| {ops: >6} | {errors: >6} '
+                     '| {ops_per_second: >9.1f} | {p50_ms: >8.2f} | '
+                     '{p99_ms: >8.2f}{0}'.format(change, **result))
+    return '\n'.join(lines)
+
+def main(args):
+    logging.basicConfig(level=logging.ERROR)
+    names = BENCHMARKS if args['--only'] == 'all' else \
+        [name.strip() for name in args['--only'].split(',')]
+    modes = [mode.strip() for mode in args['--modes'].split(',')]
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark {0}.".format(name))
+    for mode in modes:
+        if mode not in MODES:
+            sys.exit("Unknown mode {0}.".format(mode))
+    if 'async' in modes:
+        if importlib.util.find_spec('aiohttp') is None:
+            logging.warning("aiohttp is not installed; skipping async mode.")
+            modes.remove('async')
+    seed = int(args['--seed'])
+    process, server = start_server_process({
+        'latency': float(args['--latency']),
+        'jitter': float(args['--jitter']),
+        'error_rate': float(args['--error-rate']), 'seed': seed})
+    try:
+        workers = int(args['--workers'])
+        workload = Workload(server, int(args['--ops']), workers, seed)
+        results = []
+        for name in names:
+            for mode in modes:
+                result = run_benchmark(workload, name, mode,
+                                       int(args['--repeat']))
+                if result is not None:
+                    result['workers'] = workers if mode != 'sequential' else 1
+                    results.append(result)
+    finally:
+        process.terminate()
+    baseline = None
+    if args['--compare']:
+        with open(args['--compare'], 'r') as baseline_file:
+            baseline = {(result['benchmark'], result['mode']): result
+                        for result in json.load(baseline_file)['results']}
+    print(format_results(results, baseline))
+    if args['--json']:
+        settings = dict((key.lstrip('-'), value) for key, value in
+                        args.items() if key not in ('--json', '--compare'))
+        with open(args['--json'], 'w') as results_file:
+            json.dump({'settings': settings, 'created_at': time.time(),
+                       'results': results}, results_file, indent=2)
+    return None
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    main(arguments)
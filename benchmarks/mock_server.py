@@ -0,0 +1,379 @@
+#! /usr/bin/env python3
+
+"""
+Local stand-in for a Oneslate server, for benchmarks and offline trials.
+
+Usage:
+  mock_server.py [options]
+
+Options:
+  -h --help                 Show this screen.
+  --host=<host>             Address to listen on [default: 127.0.0.1].
+  --port=<port>             Port to listen on, 0 for any free port
+                            [default: 8765].
+  --latency=<seconds>       Delay added to every response [default: 0].
+  --jitter=<seconds>        Random extra delay of up to this much
+                            [default: 0].
+  --error-rate=<fraction>   Fraction of requests answered with 503 (reads) or
+                            429 (writes) and Retry-After: 0 [default: 0].
+  --seed=<n>                Seed for jitter and error injection [default: 1].
+
+Implements what oneslate.py talks to: the /users/sign_in page (CSRF meta tag
+once signed in, authenticity_token form otherwise) and login POST,
+/nodes search with Link pagination and creation, /nodes/{id}.json detail and
+stats views, links, edits and relegation, /nodes/{id}/ratings.json and
+/trees/{id}.json.  Requests other than sign in need the session cookie, and
+writes the current CSRF token, like the real server.  State is kept in
+memory only.
+"""
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from docopt import docopt
+
+
+SESSION_COOKIE = 'oneslate_session'
+SEARCH_PAGE_SIZE = 25
+
+NODE_RE = re.compile(r'^/nodes/(\d+)\.json$')
+RATINGS_RE = re.compile(r'^/nodes/(\d+)/ratings\.json$')
+TREE_RE = re.compile(r'^/trees/(\d+)\.json$')
+
+
+class MockState(object):
+    # Nodes, support edges, sessions and the fault settings of one server.
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, seed=1):
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.error_rate = float(error_rate)
+        self.random = random.Random(seed)
+        self.nodes = {}
+        self.last_node_id = 0
+        self.supports = {}
+        self.conclusions = {}
+        self.sessions = {}
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            self.request_count += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            fail = self.random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        return fail
+
+    def new_session(self):
+        with self.lock:
+            session_id = '{0:x}'.format(self.random.getrandbits(64))
+            self.sessions[session_id] = 'csrf-{0:x}'.format(
+                self.random.getrandbits(64))
+        return session_id
+
+    def add_node(self, title, explanation=None):
+        with self.lock:
+            self.last_node_id += 1
+            node_id = self.last_node_id
+            self.nodes[node_id] = {
+                'id': node_id, 'title': title, 'rating': None,
+                'explanation': explanation, 'media': False, 'type': None,
+                'flagged': None, 'followed': None,
+                'created_at': time.strftime('%B %d, %Y %H:%M'),
+                'username': 'mock', 'rating_counts': [0, 0, 0, 0, 0],
+                'ratings_count': 0, 'current_user_author': True,
+                'communities': [], 'sources': [], 'ratings_time_series': [],
+            }
+            return dict(self.nodes[node_id])
+
+    def link(self, conclusion_id, support_id):
+        with self.lock:
+            if conclusion_id not in self.nodes or support_id not in self.nodes:
+                return False
+            supports = self.supports.setdefault(conclusion_id, [])
+            if support_id not in supports:
+                supports.append(support_id)
+                self.conclusions.setdefault(support_id, []).append(
+                    conclusion_id)
+            return True
+
+    def rate(self, node_id, rating):
+        with self.lock:
+            node = self.nodes.get(node_id)
+            if node is None:
+                return False
+            node['rating_counts'][rating] += 1
+            node['ratings_count'] += 1
+            node['rating'] = round(sum(
+                validity * count for validity, count in
+                enumerate(node['rating_counts'])) / node['ratings_count'])
+            node['ratings_time_series'].append([time.time(), rating])
+            return True
+
+    def stats(self, node_id):
+        with self.lock:
+            return {
+                'children_count': len(self.supports.get(node_id, [])),
+                'parents_count': len(self.conclusions.get(node_id, [])),
+                'flags_count': 0,
+                'ratings_count': self.nodes[node_id]['ratings_count'],
+            }
+
+    def tree(self, node_id):
+        with self.lock:
+            supports = list(self.supports.get(node_id, []))
+            conclusions = list(self.conclusions.get(node_id, []))
+            return {
+                'nodes': [{'id': related_id,
+                           'title': self.nodes[related_id]['title']}
+                          for related_id in [node_id] + supports +
+                          conclusions],
+                'mapping': {'id': node_id,
+                            'children': [{'id': support_id}
+                                         for support_id in supports],
+                            'parents': [{'id': conclusion_id}
+                                        for conclusion_id in conclusions]},
+            }
+
+    def search(self, term):
+        term = (term or '').lower()
+        with self.lock:
+            return [{'id': node['id'], 'title': node['title']}
+                    for node in self.nodes.values()
+                    if term in node['title'].lower()]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; without this every response
+    # waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send(self, status, body=None, content_type='application/json',
+             headers=None):
+        if body is None:
+            payload = b''
+        elif isinstance(body, bytes):
+            payload = body
+        elif content_type == 'application/json':
+            payload = json.dumps(body).encode('utf-8')
+        else:
+            payload = body.encode('utf-8')
+        self.send_response(status)
+        if payload or status not in (204, 304):
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def json_body(self):
+        try:
+            return json.loads(self.read_body() or b'{}')
+        except ValueError:
+            return {}
+
+    def session_id(self):
+        cookies = self.headers.get('Cookie') or ''
+        for cookie in cookies.split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE and value in self.state.sessions:
+                return value
+        return None
+
+    def check(self, path, write=False):
+        # Applies latency, error injection, and session and CSRF checks.
+        # Returns the session id, or None once an error has been sent.
+        if self.state.delay():
+            status = 429 if write else 503
+            self.send(status, {'error': 'injected'},
+                      headers={'Retry-After': '0'})
+            return None
+        session_id = self.session_id()
+        if path == '/users/sign_in':
+            return session_id or ''
+        if session_id is None:
+            self.send(401, {'error': 'not signed in'})
+            return None
+        if write and (self.headers.get('X-CSRF-Token') !=
+                      self.state.sessions[session_id]):
+            self.send(422, {'error': 'invalid authenticity token'})
+            return None
+        return session_id
+
+    def sign_in_page(self, session_id):
+        if session_id:
+            return ('<html><head><meta name="csrf-param" '
+                    'content="authenticity_token" /><meta name="csrf-token" '
+                    'content="{0}" /></head><body></body></html>'.format(
+                        self.state.sessions[session_id]))
+        return ('<html><body><form action="/users/sign_in" method="post">'
+                '<input type="hidden" name="authenticity_token" '
+                'value="form-token" /><input name="private_user[email]" />'
+                '</form></body></html>')
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        body = urllib.parse.parse_qs(self.read_body().decode('utf-8'))
+        session_id = self.check(url.path)
+        if session_id is None:
+            return
+        if url.path == '/users/sign_in':
+            return self.send(200, self.sign_in_page(session_id), 'text/html')
+        if url.path in ('/nodes', '/nodes.json'):
+            term = (query.get('term') or body.get('term') or [''])[0]
+            page = int((query.get('page') or ['1'])[0])
+            results = self.state.search(term)
+            start = (page - 1) * SEARCH_PAGE_SIZE
+            headers = {}
+            if start + SEARCH_PAGE_SIZE < len(results):
+                next_url = 'http://{0}/nodes?'.format(
+                    self.headers.get('Host')) + urllib.parse.urlencode(
+                    {'term': term, 'filter': 'title', 'page': page + 1})
+                headers['Link'] = '<{0}>; rel="next"'.format(next_url)
+            return self.send(200, results[start:start + SEARCH_PAGE_SIZE],
+                             headers=headers)
+        match = NODE_RE.match(url.path)
+        if match and int(match.group(1)) in self.state.nodes:
+            node_id = int(match.group(1))
+            if query.get('view') == ['stats']:
+                return self.send(200, self.state.stats(node_id))
+            with self.state.lock:
+                node = json.loads(json.dumps(self.state.nodes[node_id]))
+            return self.send(200, node)
+        match = TREE_RE.match(url.path)
+        if match and int(match.group(1)) in self.state.nodes:
+            return self.send(200, self.state.tree(int(match.group(1))))
+        self.send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/users/sign_in':
+            form = urllib.parse.parse_qs(self.read_body().decode('utf-8'))
+            if self.check(url.path) is None:
+                return
+            if form.get('authenticity_token') != ['form-token']:
+                return self.send(422, self.sign_in_page(None), 'text/html')
+            session_id = self.state.new_session()
+            return self.send(200, self.sign_in_page(session_id), 'text/html',
+                             headers={'Set-Cookie': '{0}={1}; Path=/'.format(
+                                 SESSION_COOKIE, session_id)})
+        data = self.json_body()
+        if self.check(url.path, write=True) is None:
+            return
+        if url.path in ('/nodes', '/nodes.json'):
+            if not data.get('title'):
+                return self.send(422, {'error': 'title missing'})
+            return self.send(201, self.state.add_node(data['title'],
+                                                      data.get('explanation')))
+        match = RATINGS_RE.match(url.path)
+        if match:
+            rating = data.get('rating')
+            if rating not in (0, 1, 2, 3, 4):
+                return self.send(422, {'error': 'rating out of range'})
+            if self.state.rate(int(match.group(1)), rating):
+                return self.send(201, {})
+        self.send(404, {'error': 'not found'})
+
+    def do_PATCH(self):
+        url = urllib.parse.urlsplit(self.path)
+        data = self.json_body()
+        if self.check(url.path, write=True) is None:
+            return
+        match = NODE_RE.match(url.path)
+        node_id = int(match.group(1)) if match else None
+        if node_id not in self.state.nodes:
+            return self.send(404, {'error': 'not found'})
+        if 'child_id' in data:
+            self.state.link(node_id, int(data['child_id']))
+        if 'parent_id' in data:
+            self.state.link(int(data['parent_id']), node_id)
+        if 'title' in data:
+            with self.state.lock:
+                self.state.nodes[node_id]['title'] = str(data['title'])
+        self.send(202, {})
+
+    def do_DELETE(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.read_body()
+        if self.check(url.path, write=True) is None:
+            return
+        match = NODE_RE.match(url.path)
+        node_id = int(match.group(1)) if match else None
+        with self.state.lock:
+            if self.state.nodes.pop(node_id, None) is None:
+                return self.send(404, {'error': 'not found'})
+            for linked_id in self.state.supports.pop(node_id, []):
+                self.state.conclusions[linked_id].remove(node_id)
+            for linked_id in self.state.conclusions.pop(node_id, []):
+                self.state.supports[linked_id].remove(node_id)
+        self.send(204)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, state):
+        ThreadingHTTPServer.__init__(self, address, MockHandler)
+        self.state = state
+
+    def handle_error(self, request, client_address):
+        # Clients may close a connection without reading the response, as
+        # sessions do with a refused streamed request.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+
+def start_server(host='127.0.0.1', port=0, **state_settings):
+    # Serves from a daemon thread and returns the server; its url attribute
+    # is the base URL to hand to oneslate.py.
+    server = MockServer((host, int(port)), MockState(**state_settings))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main(args):
+    server = MockServer((args['--host'], int(args['--port'])),
+                        MockState(latency=args['--latency'],
+                                  jitter=args['--jitter'],
+                                  error_rate=args['--error-rate'],
+                                  seed=int(args['--seed'])))
+    print("Serving on {0}".format(server.url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return None
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    main(arguments)
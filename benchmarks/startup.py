@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+"""
+Startup-time benchmark of oneslate.py as a library and as a command.
+
+Usage:
+  startup.py [options]
+
+Options:
+  -h --help                 Show this screen.
+  -n --runs=<n>             Runs of each case; the median is reported
+                            [default: 20].
+  --only=<names>            Comma separated cases to run, of python, import,
+                            script, module and command [default: all].
+  --json=<file>             Write the results to a JSON file.
+  --compare=<file>          Compare with results saved earlier by --json.
+
+Every run is a fresh interpreter.  The cases are python (an empty
+interpreter, the floor for the others), import (import oneslate), script
+(oneslate.py --version, which Python compiles on every run), module
+(python -m oneslate --version, from cached bytecode) and command (python -m
+oneslate search_nodes against the local mock server, resuming a saved
+session).  The command case also reports the median of each phase printed
+by --timings.
+"""
+
+import compileall
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+import mock_server
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(PACKAGE_DIR, 'oneslate.py')
+CASES = ('python', 'import', 'script', 'module', 'command')
+PHASES = ('import', 'arguments', 'session', 'command', 'finish')
+TIMING_RE = re.compile(r'(\w+) ([\d.]+) ms')
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def case_commands(server_url, cookies_file):
+    command_args = ['-s', server_url, '-u', 'bench@example.com', '-p',
+                    'bench', '-i', cookies_file, '-o', cookies_file]
+    return {
+        'python': [sys.executable, '-c', 'pass'],
+        'import': [sys.executable, '-c', 'import oneslate'],
+        'script': [sys.executable, SCRIPT, '--version'],
+        'module': [sys.executable, '-m', 'oneslate', '--version'],
+        'command': [sys.executable, '-m', 'oneslate'] + command_args +
+                   ['--timings', 'search_nodes', 'startup'],
+    }
+
+def run_case(command, runs):
+    # Returns (seconds per run, {phase: [ms, ...]} from --timings).
+    seconds = []
+    phases = {}
+    for _ in range(runs):
+        started = time.perf_counter()
+        completed = subprocess.run(command, cwd=PACKAGE_DIR,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        seconds.append(time.perf_counter() - started)
+        if completed.returncode != 0:
+            sys.exit("{0} failed:\n{1}".format(' '.join(command),
+                                               completed.stderr))
+        for line in completed.stderr.splitlines():
+            if line.startswith('Timings:'):
+                for phase, value in TIMING_RE.findall(line):
+                    phases.setdefault(phase, []).append(float(value))
+    return seconds, phases
+
+def format_results(results, baseline=None):
+    header = '{0: <8}| {1: >9} | {2: >9}'.format('case', 'median ms',
+                                                 'min ms')
+    header += ''.join(' | {0: >9}'.format(phase) for phase in PHASES)
+    if baseline:
+        header += ' | vs baseline'
+    lines = [header, '-' * 8 + '+' + '-' * (len(header) - 9)]
+    for result in results:
+        line = '{case: <8}| {median_ms: >9.1f} | {min_ms: >9.1f}'.format(
+            **result)
+        for phase in PHASES:
+            value = result['phases_ms'].get(phase)
+            line += ' | {0: >9}'.format('' if value is None else
+                                        '{0:.1f}'.format(value))
+        previous = (baseline or {}).get(result['case'])
+        if previous is not None:
+            line += ' | {0:+.1f}%'.format(
+                100 * (result['median_ms'] / previous['median_ms'] - 1))
+        lines.append(line)
+    return '\n'.join(lines)
+
+def main(args):
+    names = CASES if args['--only'] == 'all' else \
+        [name.strip() for name in args['--only'].split(',')]
+    for name in names:
+        if name not in CASES:
+            sys.exit("Unknown case {0}.".format(name))
+    runs = int(args['--runs'])
+    server = mock_server.start_server(port=0)
+    cookies_file = os.path.join(tempfile.mkdtemp(), 'cookies')
+    commands = case_commands(server.url, cookies_file)
+    # cases load cached bytecode even where the interpreter would not write
+    # it, as with PYTHONDONTWRITEBYTECODE set
+    compileall.compile_dir(PACKAGE_DIR, maxlevels=0, quiet=1)
+    if 'command' in names:
+        # sign in once; the timed runs resume the saved session
+        run_case(commands['command'], 1)
+    results = []
+    for name in names:
+        seconds, phases = run_case(commands[name], runs)
+        results.append({
+            'case': name, 'runs': runs,
+            'median_ms': median(seconds) * 1000,
+            'min_ms': min(seconds) * 1000,
+            'phases_ms': dict((phase, median(values))
+                              for phase, values in phases.items()),
+        })
+    server.shutdown()
+    baseline = None
+    if args['--compare']:
+        with open(args['--compare'], 'r') as baseline_file:
+            baseline = {result['case']: result
+                        for result in json.load(baseline_file)['results']}
+    print(format_results(results, baseline))
+    if args['--json']:
+        with open(args['--json'], 'w') as results_file:
+            json.dump({'python': sys.version, 'created_at': time.time(),
+                       'results': results}, results_file, indent=2)
+    return None
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    main(arguments)
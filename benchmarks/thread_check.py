@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+
+"""
+Concurrency check of OneslateClient against the local mock server.
+
+Usage:
+  thread_check.py [options]
+
+Options:
+  -h --help                 Show this screen.
+  -n --ops=<n>              Operations per round [default: 600].
+  -w --workers=<n>          Threads sharing one client [default: 32].
+  --rounds=<n>              Rounds to run [default: 5].
+  --latency=<seconds>       Server latency per request [default: 0.002].
+  --jitter=<seconds>        Random extra server latency [default: 0.003].
+  --seed=<n>                Seed for the server [default: 1].
+
+Every round runs an even mix of node creation, rating and search from the
+given number of threads, all sharing one OneslateClient.  Halfway through a
+round the server forgets every session, so requests in flight and those that
+follow are refused with 401 until the client has logged in again.  The check
+fails unless every operation succeeded, the server holds exactly the nodes
+and ratings sent, and the client logged in only once per round.
+"""
+
+import logging
+import os
+import sys
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import oneslate
+import mock_server
+
+USER = 'check@example.com'
+PASSWORD = 'check'
+SEED_NODES = 60
+OPERATIONS = ('add', 'rate', 'list')
+
+
+def run_round(server, client, seed_ids, ops, workers):
+    # Returns the failed operations of one round.
+    state = server.state
+
+    def operate(client, index):
+        if index == ops // 2:
+            with state.lock:
+                state.sessions.clear()
+        operation = OPERATIONS[index % len(OPERATIONS)]
+        try:
+            if operation == 'add':
+                result = client.post_node('Thread check {0}'.format(index))
+                ok = result.node_id is not None
+            elif operation == 'rate':
+                result = client.post_rating(
+                    seed_ids[index % len(seed_ids)], index % 5)
+                ok = result.ok
+            else:
+                found = list(client.iter_search_results('Seed'))
+                ok = len(found) == len(seed_ids)
+        except Exception as e:
+            logging.warning("{0} {1} failed: {2}".format(operation, index, e))
+            ok = False
+        return operation, ok
+
+    return [(index, operation) for index, (operation, ok) in
+            enumerate(client.map(operate, range(ops), workers)) if not ok]
+
+def main(args):
+    logging.basicConfig(level=logging.ERROR)
+    ops = int(args['--ops'])
+    workers = int(args['--workers'])
+    server = mock_server.start_server(latency=float(args['--latency']),
+                                      jitter=float(args['--jitter']),
+                                      seed=int(args['--seed']))
+    state = server.state
+    problems = []
+    try:
+        client = oneslate.OneslateClient.log_in(server.url, None, USER,
+                                                PASSWORD)
+        seed_ids = [result.node_id for result in client.map(
+            oneslate.OneslateClient.post_node,
+            ['Seed {0}'.format(index) for index in range(SEED_NODES)],
+            workers)]
+        for round_number in range(int(args['--rounds'])):
+            nodes_before = len(state.nodes)
+            ratings_before = sum(state.nodes[node_id]['ratings_count']
+                                 for node_id in seed_ids)
+            started = time.perf_counter()
+            failed = run_round(server, client, seed_ids, ops, workers)
+            elapsed = time.perf_counter() - started
+            added = len(state.nodes) - nodes_before
+            rated = sum(state.nodes[node_id]['ratings_count']
+                        for node_id in seed_ids) - ratings_before
+            logins = len(state.sessions)
+            print("round {0}: {1} ops in {2:.2f}s, {3} failed, {4} added, "
+                  "{5} rated, {6} logins".format(round_number, ops, elapsed,
+                                                  len(failed), added, rated,
+                                                  logins))
+            expected = dict((operation, len(range(index, ops,
+                                                  len(OPERATIONS))))
+                            for index, operation in enumerate(OPERATIONS))
+            if failed:
+                problems.append("round {0}: failed {1}".format(
+                    round_number, failed[:10]))
+            if added != expected['add'] or rated != expected['rate']:
+                problems.append("round {0}: expected {1} added and {2} "
+                                "rated".format(round_number, expected['add'],
+                                               expected['rate']))
+            if logins != 1:
+                problems.append("round {0}: expected one login, got "
+                                "{1}".format(round_number, logins))
+    finally:
+        server.shutdown()
+    if problems:
+        sys.exit("\n".join(problems))
+    print("ok")
+    return None
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    main(arguments)
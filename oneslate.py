@@ -5,15 +5,25 @@ Handles actions for command line or Pythonic Oneslate interaction.
 
 Usage:
   oneslate.py [options] add_node <title>
+  oneslate.py [options] add_nodes <file>
   oneslate.py [options] search_nodes <title>
   oneslate.py [options] node_details <node_id> 
   oneslate.py [options] node_stats <node_id> 
   oneslate.py [options] rate_node <node_id> <validity> 
+  oneslate.py [options] rate_nodes <file>
   oneslate.py [options] link_support <node_id> <support_node_id> 
   oneslate.py [options] link_conclusion <node_id> <conclusion_node_id> 
   oneslate.py [options] relegate_node <node_id> <confirmation>
   oneslate.py [options] list_supports <root_node_id>
+  oneslate.py [options] crawl_tree <root_node_id>
+  oneslate.py [options] import_graph <file>
   oneslate.py [options] edit_node <node_id> <new_title>
+  oneslate.py [options] snapshot export <snapfile> <root_ids>...
+  oneslate.py [options] snapshot load <snapfile>
+  oneslate.py [options] sync <root_ids>...
+  oneslate.py [options] find_title <title>
+  oneslate.py [options] shell
+  oneslate.py [options] --batch=<commands>
   oneslate.py -h | --help
   oneslate.py --version
 
@@ -33,6 +43,79 @@ Options:
   -i <infile>, --input=<infile>       Cookies input file [default: cookies.txt].
   -o <outfile>, --output=<outfile>    Cookies output file [default: cookies.txt].
   -r <validity>, --rating=<validity>  Rating to give node.
+  -w <workers>, --workers=<workers>   Requests to keep in flight for bulk
+                                      commands [default: 8].
+  -d <depth>, --depth=<depth>         Levels of supports and conclusions to
+                                      crawl [default: 3].
+  --out=<outfile>                     File to write command output to, or -
+                                      for stdout [default: -].
+  --log=<logfile>                     Result log for rate_nodes.  Input up to
+                                      the last line it records as accepted
+                                      for a node is skipped.
+  --format=<format>                   Output format for search_nodes: table,
+                                      json, jsonl or csv [default: table].
+  --since=<snapfile>                  Previous snapshot to export incrementally
+                                      from.
+  --checkpoint=<file>                 Progress file for import_graph.  Nodes
+                                      and links it records are not redone.
+  --cache=<dbfile>                    Cache node and tree reads in this SQLite
+                                      file between runs.
+  --cache-ttl=<seconds>               Seconds a cached read stays fresh
+                                      [default: 60].
+  --connect-timeout=<seconds>         Seconds to wait for a connection
+                                      [default: 1].
+  --timeout=<seconds>                 Seconds to wait for a response before
+                                      adapting to observed latency [default: 1].
+  --retries=<retries>                 Times to retry a failed request
+                                      [default: 3].
+  --pool-size=<n>                     Pooled connections per host
+                                      [default: 10].
+  --keep-alive=<seconds>              Idle time before TCP keep-alive probes on
+                                      pooled connections, 0 for the system
+                                      default [default: 60].
+  --http2                             Multiplex requests over HTTP/2 (needs
+                                      httpx[http2]).
+  --metrics                           Print per-endpoint request metrics to
+                                      stderr on exit.
+  --metrics-export=<target>           Also export metrics: statsd://host:port
+                                      sends each request to StatsD, any other
+                                      value is a file written in Prometheus
+                                      text format on exit.
+  --timings                           Print how long the import, argument
+                                      parsing, session, command and finish
+                                      phases took to stderr on exit.
+  --interval=<seconds>                Shortest sync polling interval per node
+                                      [default: 5].
+  --max-interval=<seconds>            Longest sync polling interval per node
+                                      [default: 300].
+  --duration=<seconds>                Stop syncing after this long.
+  --title-index=<dbfile>              Keep every node title seen in this
+                                      SQLite file for find_title and --dedupe.
+  --dedupe                            Skip add_node and add_nodes titles that
+                                      match an indexed title.
+  --similarity=<score>                Lowest title similarity from 0 to 1 that
+                                      counts as a match [default: 0.8].
+  --accounts=<file>                   Accounts file, one username, whitespace
+                                      and password per line.  Each account
+                                      keeps its own cookies file, named after
+                                      the input and output files with the
+                                      username added.
+  --as=<users>                        Comma separated accounts from --accounts
+                                      to run the command as, or all.  Several
+                                      accounts run in parallel, up to --workers
+                                      at once, with a JSON result line each.
+                                      Defaults to the first account.
+  --outbox=<journal>                  Queue node, rating, link, edit and
+                                      relegation commands in this journal and
+                                      send them in the background.
+  --rate-limit=<limits>               Requests per second per endpoint class,
+                                      e.g. create=5,rate=20,default=50.
+  --max-in-flight=<limits>            Concurrent requests per endpoint class,
+                                      e.g. create=4,tree=16.
+  --limit-file=<statefile>            Share rate and in-flight limits with
+                                      other processes using this file.
+  -b <commands>, --batch=<commands>   Run the commands in this file, one per
+                                      line, or - for stdin, over one session.
   -q, --quiet                         Print less text.
   --verbose                           Print more text.
   --debug                             Print even more text, for debugging.
@@ -46,16 +129,70 @@ Arguments:
               4 - full
     confirmation:
               confirm - do execute this (only used to confirm relegate_node actions)
+    file:
+              path to a file with one node title per line (add_nodes) or
+              one node_id,validity pair per line as CSV or JSONL
+              (rate_nodes, which sends the ratings of a node in order so
+              its last one counts), or - for stdin; for import_graph a JSON
+              graph in the crawl_tree layout or a GraphML file with edges
+              pointing from conclusion to support
+    limits:
+              endpoint classes are create (add_node), rate (rate_node),
+              tree (list_supports, crawl_tree), search (search_nodes) and
+              default (everything else, and classes not listed)
 """
 
+import time
+
+# Start of the import phase reported by --timings.
+IMPORT_STARTED = time.perf_counter()
+
+import codecs
+import bisect
+import contextlib
+import csv
+import heapq
+import html
+import importlib
 import logging
-import pickle
+import math
+import os
 import random
-import requests
+import re
+import shlex
 import json
+import struct
+import sys
+import threading
+import types
+import unicodedata
+import urllib.parse
+
+from array import array
+from collections import Counter, deque, namedtuple, OrderedDict
+
+class LazyModule(object):
+    # Stands in for a module that is only imported when one of its
+    # attributes is first used, so importing this module stays cheap for
+    # callers that never reach the network.  Modules only needed by one
+    # function are imported inside it instead.
+
+    def __init__(self, module_name):
+        self.module_name = module_name
 
-from bs4 import BeautifulSoup
-from docopt import docopt
+    def __getattr__(self, name):
+        return getattr(importlib.import_module(self.module_name), name)
+
+requests = LazyModule('requests')
+
+# Classes kept in oneslate_http because they subclass requests types.
+HTTP_CLASSES = ('KeepAliveAdapter', 'HTTP2Adapter', 'OneslateSession')
+
+def __getattr__(name):
+    if name in HTTP_CLASSES:
+        return getattr(importlib.import_module('oneslate_http'), name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(
+        __name__, name))
 
 # Configure certificate verification as needed
 cert_in_use = False                                                       # Do not verify (for insecure setups)
@@ -74,9 +211,131 @@ def get_tree_url(host):
     tree_url = '{host}/trees'.format(**locals())
     return tree_url 
 
-def get_session(server, existing_cookies_file=None, user=None, passwd=None):
-    login_url = get_login_url(server)
-    session_to_use = requests.Session()
+# A CSRF token read back from disk is trusted for at most this many seconds,
+# and never past the earliest expiry of the saved cookies.
+CSRF_TOKEN_MAX_AGE = 12 * 60 * 60
+
+META_TAG_RE = re.compile(r'<meta\b[^>]*>', re.IGNORECASE)
+INPUT_TAG_RE = re.compile(r'<input\b[^>]*>', re.IGNORECASE)
+TAG_ATTRIBUTE_RE = re.compile(
+    r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+
+def find_tag_attribute(page_text, tag_re, name, attribute):
+    # Scans only the tags of one kind (meta or input) for the one carrying
+    # name=<name>, instead of building a whole parse tree of the page.
+    for tag in tag_re.finditer(page_text):
+        attributes = {}
+        for match in TAG_ATTRIBUTE_RE.finditer(tag.group(0)):
+            value = next(v for v in match.groups()[1:] if v is not None)
+            attributes[match.group(1).lower()] = value
+        if attributes.get('name') == name and attribute in attributes:
+            return html.unescape(attributes[attribute])
+    return None
+
+def soup_tag_attribute(page_text, selector, attribute):
+    # Slow path for markup the targeted scan does not understand.
+    from bs4 import BeautifulSoup
+    page_soup = BeautifulSoup(page_text, 'html.parser')
+    try:
+        return page_soup.select(selector)[0][attribute]
+    except (IndexError, KeyError):
+        return None
+
+def extract_csrf_token(page_text):
+    token = find_tag_attribute(page_text, META_TAG_RE, 'csrf-token', 'content')
+    if token is None and 'csrf-token' in page_text:
+        token = soup_tag_attribute(page_text, 'meta[name="csrf-token"]', 
+                                   'content')
+    return token
+
+def extract_authenticity_token(page_text):
+    token = find_tag_attribute(page_text, INPUT_TAG_RE, 'authenticity_token',
+                               'value')
+    if token is None and 'authenticity_token' in page_text:
+        token = soup_tag_attribute(page_text, 
+                                   'input[name="authenticity_token"]', 'value')
+    return token
+
+def get_csrf_file(cookies_file):
+    # The CSRF token is saved next to the cookies it belongs to.
+    return '{cookies_file}.csrf'.format(**locals())
+
+class Transport(object):
+    # Connection settings for every session this module creates.  Each host
+    # keeps up to pool_size pooled connections; with pool_block, threads
+    # beyond that wait for a free connection instead of opening one that is
+    # closed again straight after.  keep_alive is the idle time in seconds
+    # before TCP keep-alive probes start, so pooled connections outlive idle
+    # timeouts of NATs and load balancers (0 keeps the system default).  With
+    # http2, API calls are multiplexed over HTTP/2 by HTTP2Adapter.
+
+    def __init__(self, pool_size=10, keep_alive=60, pool_block=True, 
+                 http2=False):
+        self.pool_size = max(1, int(pool_size))
+        self.keep_alive = max(0, int(keep_alive))
+        self.pool_block = pool_block
+        self.http2 = http2
+
+    def socket_options(self):
+        import socket
+        import urllib3.connection
+        options = list(urllib3.connection.HTTPConnection.default_socket_options)
+        if self.keep_alive > 0:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in (('TCP_KEEPIDLE', self.keep_alive),
+                                ('TCP_KEEPINTVL', max(1, self.keep_alive // 4)),
+                                ('TCP_KEEPCNT', 4)):
+                if hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name),
+                                    value))
+        return options
+
+    def adapter(self, pool_size=None):
+        import oneslate_http
+        pool_size = max(self.pool_size, int(pool_size or 0))
+        if self.http2:
+            return oneslate_http.HTTP2Adapter(pool_size, self.keep_alive)
+        return oneslate_http.KeepAliveAdapter(socket_options=self.socket_options(),
+                                pool_connections=pool_size, 
+                                pool_maxsize=pool_size,
+                                pool_block=self.pool_block)
+
+    def mount(self, s, pool_size=None):
+        adapter = self.adapter(pool_size)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+# Used by get_session and ensure_pool_size; replace through
+# configure_transport.
+transport = Transport()
+
+def configure_transport(**transport_settings):
+    global transport
+    transport = Transport(**transport_settings)
+    return transport
+
+def load_csrf_token(existing_cookies_file, server):
+    # Returns (token, expires_at) saved by save_session, or (None, None) when
+    # missing, for another server, or expired.
+    try:
+        with open(get_csrf_file(existing_cookies_file), 'r') as csrf_file:
+            csrf_data = json.load(csrf_file)
+    except (IOError, OSError, TypeError, ValueError):
+        return None, None
+    if csrf_data.get('server') != server:
+        return None, None
+    if csrf_data.get('expires_at', 0) <= time.time():
+        logging.info("Saved XCSRF token has expired.")
+        return None, None
+    return csrf_data.get('token'), csrf_data['expires_at']
+
+def get_session(server, existing_cookies_file=None, user=None, passwd=None,
+                verify=None):
+    import pickle
+    from oneslate_http import OneslateSession
+    session_to_use = transport.mount(OneslateSession(server, user, passwd, 
+                                                     verify))
     # read cookies if available
     try:
         with open(existing_cookies_file, 'rb') as file_to_load:
@@ -86,63 +345,1248 @@ def get_session(server, existing_cookies_file=None, user=None, passwd=None):
             session_to_use.cookies = cookiejar
     except:
         logging.warning("Could not load from cookies file. Continuing.")
-    # load login URL
-    page = session_to_use.get(login_url, timeout=1, verify=False)
-    logging.debug(page.content)
-    page_soup = BeautifulSoup(page.content, 'html.parser')
-    # try to get csrf-token to show already logged in
-    try:
-        xcsrf_token = page_soup.select('meta[name="csrf-token"]')[0]['content'] 
-        if xcsrf_token != None:
-            # Already logged in, no need to log in again, just return session
-            logging.info("Provided session appears valid.  Going to try "
-                         "to reuse it.")
-    except:
-        logging.info("Did not appear to have valid current session. About to "
-                     "try logging in for a new session.")
-        # Could not get csrf-token, not logged in yet, so log in freshly.
-        token = page_soup.select('input[name="authenticity_token"]')[0]['value']
-        logging.debug("token = " + token)
-        payload = {
-            'utf8': '✓',
-            'authenticity_token': token,
-            'private_user[email]': user,
-            'private_user[password]': passwd,
-            'private_user[remember_me]': '1',
-            'commit': 'Sign in',
-        }
-        r = session_to_use.post(login_url, data=payload, timeout=1, verify=False)
-        logging.debug(r.content)
-        logging.debug("status code returned = " + str(r.status_code))
-
-        xcsrf_soup = BeautifulSoup(r.content, 'html.parser')
-        try:
-            xcsrf_token = xcsrf_soup.select('meta[name="csrf-token"]')[0]['content'] 
-        except:
-            logging.warning("No XCSRF token found when logging in! Are the "
-                            "username and password correct?")
-    finally:
-        logging.debug("xcsrf_token = {xcsrf_token}".format(**locals()))
+    # reuse a saved token while it is valid, without contacting the server
+    xcsrf_token, expires_at = load_csrf_token(existing_cookies_file, server)
+    if xcsrf_token is not None and len(session_to_use.cookies) > 0:
+        logging.info("Reusing saved XCSRF token.")
+        session_to_use.set_csrf_token(xcsrf_token, expires_at)
+    else:
+        xcsrf_token = session_to_use.log_in()
+    logging.debug("xcsrf_token = {xcsrf_token}".format(**locals()))
     return session_to_use, xcsrf_token
 
 def save_session(session_to_save, file_to_save_to=None):
-    session_to_use = requests.Session()
+    import pickle
     if file_to_save_to:
         with open(file_to_save_to, 'wb') as pickle_file:
             pickle.dump(session_to_save.cookies._cookies, pickle_file)
         logging.debug("Tried saving cookies to {file_to_save_to}".format(**locals()))
+        xcsrf_token = getattr(session_to_save, 'csrf_token', None)
+        if xcsrf_token is not None:
+            csrf_data = {
+                'server': session_to_save.server,
+                'token': xcsrf_token,
+                'expires_at': session_to_save.csrf_expires_at,
+            }
+            with open(get_csrf_file(file_to_save_to), 'w') as csrf_file:
+                json.dump(csrf_data, csrf_file)
     return None 
 
-def add_node(server, s, xcsrf_token, title_to_add):
-    node_url = get_node_url(server)
-    title_text = str(title_to_add)
-    title_length = len(title_text)
-    if title_length <= 0:
-        logging.warning("Title length of {title_length} too short. Not trying"
-                        " to add node.")
-        return False 
-    # with requests.Session() as s:
+class RequestPolicy(object):
+    # Timeouts and retries shared by every request the module sends.
+    # Idempotent requests are retried on connection errors, timeouts and
+    # 429/500/502/503/504 answers with jittered exponential backoff, waiting
+    # at least as long as any Retry-After header asks.  Other requests are
+    # only retried when the server cannot have acted on them: the connection
+    # was never made, or the answer was 429 Too Many Requests.  Once enough
+    # latencies have been observed the read timeout follows their 99th
+    # percentile, kept between read_timeout and max_read_timeout.
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+    RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, connect_timeout=1, read_timeout=1, max_retries=3,
+                 backoff_base=0.25, backoff_cap=8, max_retry_after=60,
+                 adaptive=True, max_read_timeout=30, latency_window=200):
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.max_retries = int(max_retries)
+        self.backoff_base = float(backoff_base)
+        self.backoff_cap = float(backoff_cap)
+        self.max_retry_after = float(max_retry_after)
+        self.adaptive = adaptive
+        self.max_read_timeout = float(max_read_timeout)
+        self.counters = {'requests': 0, 'retries': 0, 'timeouts': 0, 
+                         'connection_errors': 0}
+        self._latencies = deque(maxlen=int(latency_window))
+        self._lock = threading.Lock()
+
+    def timeout(self):
+        read_timeout = self.read_timeout
+        if self.adaptive:
+            with self._lock:
+                latencies = sorted(self._latencies)
+            if len(latencies) >= 20:
+                p99 = latencies[min(len(latencies) - 1, 
+                                    int(len(latencies) * 0.99))]
+                read_timeout = min(self.max_read_timeout, 
+                                   max(read_timeout, 3 * p99))
+        return (self.connect_timeout, read_timeout)
+
+    def record(self, counter=None, latency=None):
+        with self._lock:
+            if counter is not None:
+                self.counters[counter] += 1
+            if latency is not None:
+                self._latencies.append(latency)
+
+    def backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoff_cap, 
+                                      self.backoff_base * 2 ** attempt))
+        if response is not None and response.status_code in (429, 503):
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After'))
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['read_timeout'] = self.timeout()[1]
+        return stats
+
+def parse_retry_after(retry_after):
+    # Retry-After is either a number of seconds or an HTTP date.
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+# Used by send_request; replace through configure_requests.
+request_policy = RequestPolicy()
+
+def configure_requests(**policy_settings):
+    global request_policy
+    request_policy = RequestPolicy(**policy_settings)
+    return request_policy
+
+def classify_request(method, url):
+    # Endpoint class used to pick a rate limit: create, rate, tree, search
+    # or default.
+    path = urllib.parse.urlsplit(url).path
+    if path.endswith('/ratings.json'):
+        return 'rate'
+    if '/trees/' in path:
+        return 'tree'
+    if path.endswith('/nodes'):
+        return 'create' if method == 'POST' else 'search'
+    return 'default'
+
+class RateLimiter(object):
+    # Token buckets and in-flight limits per endpoint class.  rates maps a
+    # class to requests per second and max_in_flight to concurrent requests;
+    # a 'default' entry covers classes not listed.  With a state_file, every
+    # process pointing at the same file shares one budget: bucket levels live
+    # in the file under an exclusive lock, and each in-flight slot is a lock
+    # file that the OS releases if its holder dies.
+
+    def __init__(self, rates=None, max_in_flight=None, state_file=None):
+        self.rates = dict(rates or {})
+        self.max_in_flight = dict(max_in_flight or {})
+        self.state_file = state_file
+        self._state = {}
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _limit(self, limits, endpoint_class):
+        return limits.get(endpoint_class, limits.get('default'))
+
+    def _update_state(self, update):
+        # Calls update(state) with the shared bucket state and saves it.
+        with self._lock:
+            if self.state_file is None:
+                return update(self._state)
+            import fcntl
+            with open(self.state_file, 'a+') as state_file:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+                try:
+                    state_file.seek(0)
+                    try:
+                        state = json.loads(state_file.read() or '{}')
+                    except ValueError:
+                        state = {}
+                    result = update(state)
+                    state_file.seek(0)
+                    state_file.truncate()
+                    state_file.write(json.dumps(state))
+                    state_file.flush()
+                finally:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
+            return result
+
+    def _take_token(self, endpoint_class, rate):
+        # Returns 0 when a token was taken, otherwise seconds to wait.
+        def take(state):
+            now = time.time()
+            bucket = state.setdefault(endpoint_class, 
+                                      {'tokens': rate, 'updated': now,
+                                       'paused_until': 0})
+            burst = max(1.0, rate)
+            bucket['tokens'] = min(burst, bucket['tokens'] + 
+                                   (now - bucket['updated']) * rate)
+            bucket['updated'] = now
+            if now < bucket['paused_until']:
+                return bucket['paused_until'] - now
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return 0
+            return (1 - bucket['tokens']) / rate
+        return self._update_state(take)
+
+    def pause(self, endpoint_class, seconds):
+        # Holds back every sharer of the bucket, e.g. after a 429 answer.
+        def hold(state):
+            bucket = state.get(endpoint_class)
+            if bucket is not None:
+                bucket['paused_until'] = max(bucket['paused_until'], 
+                                             time.time() + seconds)
+        if self._limit(self.rates, endpoint_class):
+            self._update_state(hold)
+        return None
+
+    def _acquire_slot(self, endpoint_class, limit):
+        if self.state_file is None:
+            with self._lock:
+                semaphore = self._semaphores.get(endpoint_class)
+                if semaphore is None:
+                    semaphore = threading.BoundedSemaphore(limit)
+                    self._semaphores[endpoint_class] = semaphore
+            semaphore.acquire()
+            return semaphore
+        import fcntl
+        while True:
+            for slot_number in range(limit):
+                slot_path = '{0}.{1}.{2}.lock'.format(self.state_file, 
+                                                      endpoint_class,
+                                                      slot_number)
+                slot_file = open(slot_path, 'a')
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot_file
+                except (IOError, OSError):
+                    slot_file.close()
+            time.sleep(0.01)
+
+    def _release_slot(self, slot):
+        if isinstance(slot, threading.Semaphore):
+            slot.release()
+        else:
+            import fcntl
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+        return None
+
+    @contextlib.contextmanager
+    def slot(self, endpoint_class):
+        limit = self._limit(self.max_in_flight, endpoint_class)
+        slot = None
+        if limit:
+            slot = self._acquire_slot(endpoint_class, int(limit))
+        try:
+            rate = self._limit(self.rates, endpoint_class)
+            if rate:
+                wait_for = self._take_token(endpoint_class, float(rate))
+                while wait_for > 0:
+                    time.sleep(wait_for)
+                    wait_for = self._take_token(endpoint_class, float(rate))
+            yield
+        finally:
+            if slot is not None:
+                self._release_slot(slot)
+
+def parse_limits(limits_spec):
+    # "create=5,rate=20,default=50" -> {'create': 5.0, 'rate': 20.0, ...}
+    limits = {}
+    for item in (limits_spec or '').split(','):
+        if item.strip():
+            endpoint_class, limit = item.split('=', 1)
+            limits[endpoint_class.strip()] = float(limit)
+    return limits
+
+# Set through configure_rate_limits.  When None requests are not throttled.
+rate_limiter = None
+
+def configure_rate_limits(rates=None, max_in_flight=None, state_file=None):
+    global rate_limiter
+    rate_limiter = RateLimiter(rates, max_in_flight, state_file)
+    return rate_limiter
+
+# Paths of the API endpoints metrics are kept for.  Node ids are replaced
+# by {id} so each endpoint is one series; other paths count as "other".
+ENDPOINT_PATTERNS = (
+    (re.compile(r'/users/sign_in$'), '/users/sign_in'),
+    (re.compile(r'/nodes/[^/]+/ratings\.json$'), '/nodes/{id}/ratings.json'),
+    (re.compile(r'/nodes/[^/]+\.json$'), '/nodes/{id}.json'),
+    (re.compile(r'/trees/[^/]+\.json$'), '/trees/{id}.json'),
+    (re.compile(r'/nodes(\.json)?/?$'), '/nodes'),
+)
+
+def endpoint_name(method, url):
+    path = urllib.parse.urlsplit(url).path
+    for pattern, template in ENDPOINT_PATTERNS:
+        if pattern.search(path):
+            return '{0} {1}'.format(method.upper(), template)
+    return '{0} other'.format(method.upper())
+
+# Passed to every metrics hook once per attempt.  status is None and error
+# holds the exception when no response came back; attempt is 0 for the first
+# try and counts up on retries.
+RequestEvent = namedtuple('RequestEvent', 
+                          ['endpoint', 'method', 'url', 'status', 'latency',
+                           'bytes_sent', 'bytes_received', 'attempt', 
+                           'error'])
+
+class EndpointMetrics(object):
+    # Counters and latency histogram of one endpoint.
+
+    def __init__(self, buckets, sample_size):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = {}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.latencies = deque(maxlen=sample_size)
+
+class RequestMetrics(object):
+    # Per-endpoint request metrics, filled by send_request.  Latencies go into
+    # cumulative histogram buckets (as exported to Prometheus) and a window
+    # of recent samples for percentiles.  Hooks added with add_hook are
+    # called with a RequestEvent after every attempt, from the thread that
+    # sent the request.
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 
+                       5.0, 10.0)
+
+    def __init__(self, sample_size=1000):
+        self.sample_size = int(sample_size)
+        self.endpoints = {}
+        self.hooks = []
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, event):
+        with self._lock:
+            endpoint = self.endpoints.get(event.endpoint)
+            if endpoint is None:
+                endpoint = EndpointMetrics(self.LATENCY_BUCKETS, 
+                                           self.sample_size)
+                self.endpoints[event.endpoint] = endpoint
+            endpoint.count += 1
+            if event.attempt > 0:
+                endpoint.retries += 1
+            if event.status is None:
+                endpoint.errors += 1
+            else:
+                endpoint.statuses[event.status] = endpoint.statuses.get(
+                    event.status, 0) + 1
+            endpoint.bytes_sent += event.bytes_sent
+            endpoint.bytes_received += event.bytes_received
+            endpoint.latency_sum += event.latency
+            endpoint.latency_max = max(endpoint.latency_max, event.latency)
+            endpoint.bucket_counts[bisect.bisect_left(self.LATENCY_BUCKETS,
+                                                      event.latency)] += 1
+            endpoint.latencies.append(event.latency)
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception as e:
+                logging.warning("Metrics hook {0!r} failed: {1}".format(hook,
+                                                                        e))
+
+    def summary(self):
+        # {endpoint: dict of totals, rate per second and p50/p99/max latency}
+        with self._lock:
+            elapsed = max(time.time() - self.started_at, 1e-9)
+            summary = {}
+            for name, endpoint in self.endpoints.items():
+                latencies = sorted(endpoint.latencies)
+                def percentile(fraction):
+                    return latencies[min(len(latencies) - 1, 
+                                         int(len(latencies) * fraction))]
+                summary[name] = {
+                    'count': endpoint.count, 'errors': endpoint.errors,
+                    'retries': endpoint.retries, 
+                    'statuses': dict(endpoint.statuses),
+                    'bytes_sent': endpoint.bytes_sent,
+                    'bytes_received': endpoint.bytes_received,
+                    'per_second': endpoint.count / elapsed,
+                    'p50': percentile(0.5), 'p99': percentile(0.99),
+                    'max': endpoint.latency_max,
+                }
+        return summary
+
+    def format_summary(self):
+        lines = ['{0: <34}| {1: >6} | {2: >6} | {3: >7} | {4: >7} | {5: >8} '
+                 '| {6: >8} | {7: >9} | {8: >9} | {9}'.format(
+                     'endpoint', 'count', 'errors', 'retries', 'rate/s', 
+                     'p50 ms', 'p99 ms', 'sent', 'received', 'statuses')]
+        lines.append('-' * 34 + '+' + '-' * 100)
+        for name, totals in sorted(self.summary().items()):
+            statuses = ' '.join('{0}:{1}'.format(status, count) for 
+                                status, count in sorted(totals['statuses']
+                                                        .items()))
+            lines.append(
+                '{0: <34}| {count: >6} | {errors: >6} | {retries: >7} | '
+                '{per_second: >7.1f} | {p50_ms: >8.1f} | {p99_ms: >8.1f} | '
+                '{bytes_sent: >9} | {bytes_received: >9} | {1}'.format(
+                    name, statuses, p50_ms=totals['p50'] * 1000,
+                    p99_ms=totals['p99'] * 1000, **totals))
+        return '\n'.join(lines)
+
+    def prometheus_text(self):
+        # Prometheus text exposition format, e.g. for node_exporter's
+        # textfile collector.
+        lines = []
+        def series(metric, kind, help_text, values):
+            lines.append('# HELP oneslate_{0} {1}'.format(metric, help_text))
+            lines.append('# TYPE oneslate_{0} {1}'.format(metric, kind))
+            for labels, value in values:
+                label_text = ','.join('{0}="{1}"'.format(key, value) 
+                                      for key, value in labels)
+                lines.append('oneslate_{0}{{{1}}} {2}'.format(metric, 
+                                                              label_text,
+                                                              value))
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            requests_total = []
+            other_totals = {'errors': [], 'retries': [], 'bytes_sent': [], 
+                            'bytes_received': []}
+            histogram = []
+            for name, endpoint in endpoints:
+                method, path = name.split(' ', 1)
+                labels = (('method', method), ('endpoint', path))
+                for status, count in sorted(endpoint.statuses.items()):
+                    requests_total.append((labels + (('status', status),), 
+                                           count))
+                for key in other_totals:
+                    other_totals[key].append((labels, getattr(endpoint, key)))
+                cumulative = 0
+                for bound, count in zip(self.LATENCY_BUCKETS + ('+Inf',),
+                                        endpoint.bucket_counts):
+                    cumulative += count
+                    histogram.append(('_bucket', labels + (('le', bound),),
+                                      cumulative))
+                histogram.append(('_sum', labels, endpoint.latency_sum))
+                histogram.append(('_count', labels, endpoint.count))
+        series('requests_total', 'counter', 'Responses by status code.',
+               requests_total)
+        series('request_errors_total', 'counter', 
+               'Attempts that got no response.', other_totals['errors'])
+        series('request_retries_total', 'counter', 'Retried attempts.',
+               other_totals['retries'])
+        series('request_bytes_sent_total', 'counter', 'Request body bytes.',
+               other_totals['bytes_sent'])
+        series('response_bytes_received_total', 'counter', 
+               'Response body bytes.', other_totals['bytes_received'])
+        lines.append('# HELP oneslate_request_duration_seconds Request '
+                     'latency.')
+        lines.append('# TYPE oneslate_request_duration_seconds histogram')
+        for suffix, labels, value in histogram:
+            label_text = ','.join('{0}="{1}"'.format(key, value) 
+                                  for key, value in labels)
+            lines.append('oneslate_request_duration_seconds{0}{{{1}}} '
+                         '{2}'.format(suffix, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # Written to a temporary file first so scrapers never see half of it.
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus_text())
+        os.replace(temporary_path, path)
+
+class StatsDExporter(object):
+    # Metrics hook sending each attempt to a StatsD server over UDP as a
+    # timing plus status counter, e.g. oneslate.get.nodes_id_json.latency.
+    # Send failures are ignored so metrics never slow down requests.
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='oneslate'):
+        self.address = (host, int(port))
+        import socket
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def metric_name(self, endpoint):
+        return self.prefix + '.' + re.sub(r'[^a-z0-9]+', '_', 
+                                          endpoint.lower()).strip('_')
+
+    def __call__(self, event):
+        name = self.metric_name(event.endpoint)
+        status = event.status if event.status is not None else 'error'
+        lines = ['{0}.latency:{1:.3f}|ms'.format(name, event.latency * 1000),
+                 '{0}.status.{1}:1|c'.format(name, status)]
+        if event.attempt > 0:
+            lines.append('{0}.retries:1|c'.format(name))
+        try:
+            self._socket.sendto('\n'.join(lines).encode('utf-8'), 
+                                self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self._socket.close()
+
+def parse_metrics_target(target):
+    # --metrics-export takes statsd://host:port or a file path for the
+    # Prometheus text format.
+    if target.startswith('statsd://'):
+        address = urllib.parse.urlsplit(target)
+        return StatsDExporter(address.hostname or '127.0.0.1', 
+                              address.port or 8125)
+    return target
+
+# Filled by send_request.  Scripts can add hooks or read summary() at any
+# time.
+request_metrics = RequestMetrics()
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:  # generators and file objects
+        return 0
+
+def response_size(response):
+    # Streamed bodies are not read here; their Content-Length is used.
+    if response._content is not False:
+        return len(response.content or b'')
+    try:
+        return int(response.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+def send_request(s, method, url, xcsrf_token=None, idempotent=None, 
+                 limited=True, **kwargs):
+    # Every request of this module goes through here.  The CSRF token is sent
+    # per request rather than stored on the shared session.  With limited
+    # False the request skips rate_limiter, as logins made while a refused
+    # request still holds its in-flight slot must.
+    policy = request_policy
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in policy.IDEMPOTENT_METHODS
+    if xcsrf_token is not None:
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers["X-CSRF-Token"] = xcsrf_token
+        kwargs['headers'] = headers
+    kwargs.setdefault('verify', cert_in_use)
+    limiter = rate_limiter if limited else None
+    endpoint_class = classify_request(method, url)
+    metrics = request_metrics
+    endpoint = endpoint_name(method, url)
+    attempt = 0
+    while True:
+        response = None
+        started = None
+        kwargs['timeout'] = policy.timeout()
+        try:
+            if limiter is None:
+                started = time.time()
+                policy.record('requests')
+                response = s.request(method, url, **kwargs)
+            else:
+                with limiter.slot(endpoint_class):
+                    started = time.time()
+                    policy.record('requests')
+                    response = s.request(method, url, **kwargs)
+        except requests.exceptions.ConnectTimeout as e:
+            policy.record('timeouts')
+            retryable = True  # never reached the server
+            error = e
+        except requests.exceptions.Timeout as e:
+            policy.record('timeouts', latency=kwargs['timeout'][1])
+            retryable = idempotent
+            error = e
+        except requests.exceptions.ConnectionError as e:
+            policy.record('connection_errors')
+            retryable = idempotent
+            error = e
+        else:
+            policy.record(latency=time.time() - started)
+            retryable = (response.status_code in policy.RETRY_STATUS_CODES
+                         and (idempotent or response.status_code == 429))
+            error = None
+        if started is not None:
+            if response is not None:
+                metrics.record(RequestEvent(
+                    endpoint, method, url, response.status_code,
+                    response.elapsed.total_seconds(), 
+                    body_size(response.request.body), 
+                    response_size(response), attempt, None))
+            else:
+                metrics.record(RequestEvent(
+                    endpoint, method, url, None, time.time() - started, 0, 0,
+                    attempt, error))
+        if not retryable or attempt >= policy.max_retries:
+            if error is not None:
+                raise error
+            return response
+        delay = policy.backoff(attempt, response)
+        if limiter is not None and response is not None and \
+                response.status_code == 429:
+            limiter.pause(endpoint_class, delay)
+        logging.info("Retrying {method} {url} in {delay:.2f} seconds.".format(
+            **locals()))
+        policy.record('retries')
+        time.sleep(delay)
+        attempt += 1
+
+# Set by the first decode_json call: orjson.loads when orjson is installed,
+# otherwise json.loads.
+json_loads = None
+
+def decode_json(body):
+    # Decodes a JSON response body, given as bytes or text.  Bytes are
+    # parsed as they are, without first being decoded into a str copy.
+    # Raises ValueError for invalid JSON with either parser.
+    global json_loads
+    if json_loads is None:
+        try:
+            import orjson
+            json_loads = orjson.loads
+        except ImportError:
+            json_loads = json.loads
+    return json_loads(body)
+
+class LazyFormat(object):
+    # A log message that is only formatted with str.format if a handler
+    # emits it, so logging.debug(LazyFormat("tree = {tree}", tree=tree))
+    # costs nothing unless debug logging is on.
+
+    def __init__(self, template, *args, **fields):
+        self.template = template
+        self.args = args
+        self.fields = fields
+
+    def __str__(self):
+        return self.template.format(*self.args, **self.fields)
+
+# Most bytes of a response body logged at debug level.
+DEBUG_BODY_LIMIT = 4096
+
+def log_response(response):
+    # Logs the start of the response body at debug level and its status code
+    # at info level.
+    logger = logging.getLogger()
+    if logger.isEnabledFor(logging.DEBUG):
+        body = response.content
+        if len(body) > DEBUG_BODY_LIMIT:
+            body = body[:DEBUG_BODY_LIMIT] + "... ({0} bytes)".format(
+                len(body)).encode('ascii')
+        logging.debug(body)
+    if logger.isEnabledFor(logging.INFO):
+        logging.info("status code returned = " + str(response.status_code))
+    return None
+
+# Cached GET responses.  body is the undecoded JSON body so every caller gets
+# its own freshly decoded copy.
+CacheEntry = namedtuple('CacheEntry', 
+                        ['node_id', 'stored_at', 'etag', 'last_modified', 
+                         'body'])
+
+class NodeCache(object):
+    # In-memory LRU of /nodes/{id}.json and /trees/{id}.json responses, with
+    # an optional SQLite tier that survives between CLI invocations.  Entries
+    # are fresh for ttl seconds; stale entries carrying an ETag or
+    # Last-Modified header are kept so they can be revalidated.
+
+    def __init__(self, max_entries=1024, ttl=60, db_path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self.counters = {'hits': 0, 'misses': 0, 'revalidations': 0, 
+                         'invalidations': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            import sqlite3
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                "node_id TEXT, stored_at REAL, etag TEXT, last_modified TEXT, "
+                "body TEXT)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_node_id "
+                "ON responses (node_id)")
+            # Expired entries without validators can never be reused.
+            self._db.execute(
+                "DELETE FROM responses WHERE stored_at < ? AND etag IS NULL "
+                "AND last_modified IS NULL", (time.time() - self.ttl,))
+            self._db.commit()
+
+    @staticmethod
+    def make_key(url, params=None):
+        if params:
+            url += '?' + '&'.join('{0}={1}'.format(k, params[k]) 
+                                  for k in sorted(params))
+        return url
+
+    def _is_fresh(self, entry):
+        return time.time() - entry.stored_at < self.ttl
+
+    def lookup(self, key):
+        # Returns (entry, fresh).  entry is None on a miss.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT node_id, stored_at, etag, last_modified, body "
+                    "FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = CacheEntry(*row)
+                    self._remember(key, entry)
+            if entry is not None and self._is_fresh(entry):
+                self.counters['hits'] += 1
+                return entry, True
+            if entry is not None and (entry.etag or entry.last_modified):
+                return entry, False
+            self.counters['misses'] += 1
+            return None, False
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def store(self, key, node_id, response):
+        entry = CacheEntry("{0}".format(node_id), time.time(), 
+                           response.headers.get('ETag'),
+                           response.headers.get('Last-Modified'),
+                           response.content)
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (key,) + tuple(entry))
+                self._db.commit()
+        return entry
+
+    def revalidated(self, key, entry):
+        # The server answered 304 Not Modified, so the entry is fresh again.
+        entry = entry._replace(stored_at=time.time())
+        with self._lock:
+            self.counters['revalidations'] += 1
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "UPDATE responses SET stored_at = ? WHERE key = ?",
+                    (entry.stored_at, key))
+                self._db.commit()
+        return entry
+
+    def invalidate(self, *node_ids):
+        node_ids = set("{0}".format(node_id) for node_id in node_ids)
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() 
+                        if entry.node_id in node_ids]:
+                del self._entries[key]
+            if self._db is not None:
+                self._db.executemany(
+                    "DELETE FROM responses WHERE node_id = ?", 
+                    [(node_id,) for node_id in node_ids])
+                self._db.commit()
+            self.counters['invalidations'] += len(node_ids)
+        return None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+        return stats
+
+# Set through enable_cache.  When None every read goes to the server.
+node_cache = None
+
+def enable_cache(max_entries=1024, ttl=60, db_path=None):
+    global node_cache
+    node_cache = NodeCache(max_entries, ttl, db_path)
+    return node_cache
+
+def invalidate_nodes(*node_ids):
+    if node_cache is not None:
+        node_cache.invalidate(*node_ids)
+    return None
+
+def invalidate_node_and_neighbours(node_id):
+    # Cached trees of a node's supports and conclusions list its title too.
+    # The neighbours are those argument_graph knows, which includes every
+    # tree read from the cache in this process.
+    if node_cache is not None:
+        node_cache.invalidate(node_id, *(argument_graph.supports(node_id) +
+                                         argument_graph.conclusions(node_id)))
+    return None
+
+def get_json(s, url, xcsrf_token, node_id, params=None):
+    return OneslateClient(None, s, xcsrf_token).get_json(url, node_id, params)
+
+def normalize_rating_counts(rating_counts):
+    # The server may send rating_counts as a list of five bins, as a dict
+    # keyed by validity, or as None before any rating.
+    if isinstance(rating_counts, dict):
+        return tuple(int(rating_counts.get(str(validity), 
+                                           rating_counts.get(validity, 0)) 
+                         or 0) for validity in range(5))
+    if isinstance(rating_counts, (list, tuple)) and len(rating_counts) == 5:
+        return tuple(int(count or 0) for count in rating_counts)
+    return None
+
+class NodeRecord(object):
+    # What is known locally about one node.  Fields stay None until a
+    # response carrying them has been seen.
+    __slots__ = ('id', 'title', 'rating', 'ratings_count', 'rating_counts',
+                 'children_count', 'parents_count', 'flags_count')
+
+    def __init__(self, node_id):
+        self.id = node_id
+        self.title = None
+        self.rating = None
+        self.ratings_count = None
+        self.rating_counts = None
+        self.children_count = None
+        self.parents_count = None
+        self.flags_count = None
+
+    def __repr__(self):
+        return 'NodeRecord(id={0!r}, title={1!r})'.format(self.id, self.title)
+
+class ArgumentGraph(object):
+    # Nodes and support edges seen in server responses, indexed by id and by
+    # title, with adjacency kept in both directions as compact integer arrays.
+    # Node ids are the server's integer ids.  Title changes are passed on to
+    # title_index when one is attached (see enable_title_index).
+
+    def __init__(self):
+        self.nodes = {}
+        self.title_index = None
+        self._titles = {}
+        self._supports = {}
+        self._conclusions = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_id):
+        return normalize_node_id(node_id) in self.nodes
+
+    def clear(self):
+        with self._lock:
+            self.nodes.clear()
+            self._titles.clear()
+            self._supports.clear()
+            self._conclusions.clear()
+        return None
+
+    def get(self, node_id):
+        return self.nodes.get(normalize_node_id(node_id))
+
+    def _record(self, node_id):
+        record = self.nodes.get(node_id)
+        if record is None:
+            record = self.nodes[node_id] = NodeRecord(node_id)
+        return record
+
+    def _set_title(self, record, title):
+        if record.title == title:
+            return
+        if record.title is not None:
+            ids = self._titles.get(record.title)
+            if ids is not None and record.id in ids:
+                ids.remove(record.id)
+                if not ids:
+                    del self._titles[record.title]
+        record.title = title
+        if title is not None:
+            self._titles.setdefault(title, []).append(record.id)
+        if self.title_index is not None:
+            self.title_index.set_title(record.id, title)
+
+    def add_node(self, node_data):
+        # Merges a node dict from any endpoint (details, stats, tree, search
+        # or create responses) and returns its record.
+        node_id = normalize_node_id(node_data.get('id'))
+        if node_id is None:
+            return None
+        with self._lock:
+            record = self._record(node_id)
+            if 'title' in node_data:
+                self._set_title(record, node_data['title'])
+            for field in ('rating', 'ratings_count', 'children_count', 
+                          'parents_count', 'flags_count'):
+                if node_data.get(field) is not None:
+                    setattr(record, field, node_data[field])
+            if 'rating_counts' in node_data:
+                record.rating_counts = normalize_rating_counts(
+                    node_data['rating_counts'])
+        return record
+
+    def update_node(self, node_id, **fields):
+        fields['id'] = node_id
+        return self.add_node(fields)
+
+    def remove_node(self, node_id):
+        node_id = normalize_node_id(node_id)
+        with self._lock:
+            record = self.nodes.pop(node_id, None)
+            if record is None:
+                # may still be indexed from an earlier run
+                if self.title_index is not None:
+                    self.title_index.remove(node_id)
+                return None
+            self._set_title(record, None)
+            for support_id in self._supports.pop(node_id, ()):
+                self._discard(self._conclusions, support_id, node_id)
+            for conclusion_id in self._conclusions.pop(node_id, ()):
+                self._discard(self._supports, conclusion_id, node_id)
+        return record
+
+    @staticmethod
+    def _discard(adjacency, node_id, other_id):
+        neighbours = adjacency.get(node_id)
+        if neighbours is not None and other_id in neighbours:
+            neighbours.remove(other_id)
+
+    def add_edge(self, conclusion_id, support_id):
+        conclusion_id = normalize_node_id(conclusion_id)
+        support_id = normalize_node_id(support_id)
+        with self._lock:
+            self._record(conclusion_id)
+            self._record(support_id)
+            supports = self._supports.setdefault(conclusion_id, array('q'))
+            if support_id not in supports:
+                supports.append(support_id)
+                self._conclusions.setdefault(support_id, 
+                                             array('q')).append(conclusion_id)
+        return None
+
+    def add_tree(self, tree_data):
+        # Merges a /trees/{id}.json document: its nodes and every support or
+        # conclusion relation in its (possibly nested) mapping.
+        for node in tree_data.get('nodes', []):
+            self.add_node(node)
+        pending = [tree_data.get('mapping', {})]
+        while pending:
+            mapping = pending.pop()
+            node_id = mapping.get('id')
+            if node_id is None:
+                continue
+            for support in mapping.get('children', []):
+                self.add_edge(node_id, support['id'])
+                pending.append(support)
+            for conclusion in mapping.get('parents', []):
+                self.add_edge(conclusion['id'], node_id)
+                pending.append(conclusion)
+        return None
+
+    def find_title(self, title):
+        return list(self._titles.get(title, ()))
+
+    def title_of(self, node_id):
+        record = self.get(node_id)
+        return record.title if record is not None else None
+
+    def supports(self, node_id):
+        return list(self._supports.get(normalize_node_id(node_id), ()))
+
+    def conclusions(self, node_id):
+        return list(self._conclusions.get(normalize_node_id(node_id), ()))
+
+    def _walk(self, adjacency, node_id):
+        start = normalize_node_id(node_id)
+        seen = set()
+        pending = list(adjacency.get(start, ()))
+        while pending:
+            next_id = pending.pop()
+            if next_id in seen:
+                continue
+            seen.add(next_id)
+            pending.extend(adjacency.get(next_id, ()))
+        seen.discard(start)
+        return seen
+
+    def ancestors(self, node_id):
+        # Every conclusion the node supports directly or through others.
+        return self._walk(self._conclusions, node_id)
+
+    def descendants(self, node_id):
+        # Every node supporting this one directly or through others.
+        return self._walk(self._supports, node_id)
+
+    def is_reachable(self, from_id, to_id):
+        # True if to_id supports from_id, directly or through other nodes.
+        return normalize_node_id(to_id) in self.descendants(from_id)
 
+    def rating_summary(self, node_ids=None):
+        # Totals of the 0 - 4 validity bins over node_ids (default: every
+        # node with known rating_counts), with the weighted mean validity.
+        if node_ids is None:
+            records = list(self.nodes.values())
+        else:
+            records = [self.get(node_id) for node_id in node_ids]
+        bins = [0, 0, 0, 0, 0]
+        rated_nodes = 0
+        for record in records:
+            if record is None or record.rating_counts is None:
+                continue
+            rated_nodes += 1
+            for validity, count in enumerate(record.rating_counts):
+                bins[validity] += count
+        ratings_count = sum(bins)
+        mean = None
+        if ratings_count:
+            mean = sum(validity * count 
+                       for validity, count in enumerate(bins)) / ratings_count
+        return {'nodes': rated_nodes, 'ratings_count': ratings_count, 
+                'rating_counts': bins, 'mean_validity': mean}
+
+# Filled by every fetch in this module.  Call argument_graph.clear() to
+# start over.
+argument_graph = ArgumentGraph()
+
+TITLE_WORD_RE = re.compile(r'\w+')
+
+def normalize_title(title):
+    # Case folded words of title joined by single spaces, so case, accents
+    # written as combining characters, punctuation and spacing do not tell
+    # titles apart.
+    title = unicodedata.normalize('NFKC', "{0}".format(title)).casefold()
+    return ' '.join(TITLE_WORD_RE.findall(title))
+
+def title_trigrams(normalized_title):
+    # Character trigrams of each word padded with two leading spaces and one
+    # trailing space, as PostgreSQL's pg_trgm does, so short words and word
+    # starts still count.
+    trigrams = set()
+    for word in normalized_title.split():
+        padded = '  ' + word + ' '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+# One title found by TitleIndex.  score is 1.0 for titles equal after
+# normalize_title and the trigram similarity otherwise.
+TitleMatch = namedtuple('TitleMatch', ['node_id', 'title', 'score'])
+
+class TitleIndex(object):
+    # Node titles for exact and fuzzy lookups without server requests.  Each
+    # title is stored with its normalize_title form for exact lookups, and
+    # an inverted index maps each trigram to the sorted ids of the nodes
+    # whose title has it, so a fuzzy lookup only counts the nodes sharing
+    # trigrams with the query.  The score is the Dice coefficient of the two
+    # trigram sets.  With db_path the index lives in that SQLite file and
+    # survives between runs; otherwise in memory.  Changed posting lists are
+    # held in memory and written every COMMIT_EVERY changes and by flush()
+    # or close().
+
+    COMMIT_EVERY = 5000
+
+    def __init__(self, db_path=None):
+        import sqlite3
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path or ':memory:',
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        self._changed = {}  # trigram -> set of node ids, not yet written
+        self._uncommitted = 0
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS titles (node_id INTEGER PRIMARY KEY, "
+            "title TEXT, normalized TEXT, trigram_count INTEGER)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS titles_normalized "
+            "ON titles (normalized)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS postings (trigram TEXT PRIMARY KEY, "
+            "node_ids BLOB)")
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM titles").fetchone()[0]
+
+    def _posting(self, trigram):
+        # Node ids for trigram, as the changed set or as stored.
+        node_ids = self._changed.get(trigram)
+        if node_ids is not None:
+            return node_ids
+        row = self._db.execute("SELECT node_ids FROM postings "
+                               "WHERE trigram = ?", (trigram,)).fetchone()
+        node_ids = array('q')
+        if row is not None:
+            node_ids.frombytes(row[0])
+        return node_ids
+
+    def _changed_posting(self, trigram):
+        node_ids = self._changed.get(trigram)
+        if node_ids is None:
+            node_ids = self._changed[trigram] = set(self._posting(trigram))
+        return node_ids
+
+    def set_title(self, node_id, title):
+        # Adds or replaces the title of node_id; a title of None removes it.
+        node_id = normalize_node_id(node_id)
+        if not isinstance(node_id, int):
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT title, normalized FROM titles WHERE node_id = ?",
+                (node_id,)).fetchone()
+            if row is not None and row[0] == title:
+                return None
+            old_trigrams = title_trigrams(row[1]) if row is not None else set()
+            if title is None:
+                new_trigrams = set()
+                self._db.execute("DELETE FROM titles WHERE node_id = ?",
+                                 (node_id,))
+            else:
+                normalized = normalize_title(title)
+                new_trigrams = title_trigrams(normalized)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?)",
+                    (node_id, title, normalized, len(new_trigrams)))
+            for trigram in old_trigrams - new_trigrams:
+                self._changed_posting(trigram).discard(node_id)
+            for trigram in new_trigrams - old_trigrams:
+                self._changed_posting(trigram).add(node_id)
+            self._uncommitted += 1
+            if self._uncommitted >= self.COMMIT_EVERY:
+                self._commit()
+        return None
+
+    def remove(self, node_id):
+        return self.set_title(node_id, None)
+
+    def find_exact(self, title):
+        # Nodes whose title equals title after normalize_title.
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT node_id, title FROM titles WHERE normalized = ? "
+                "ORDER BY node_id", (normalize_title(title),)).fetchall()
+        return [TitleMatch(node_id, found, 1.0) for node_id, found in rows]
+
+    def find_similar(self, title, min_score=0.6, limit=10):
+        # Up to limit nodes whose title scores at least min_score against
+        # title, best first.
+        trigrams = title_trigrams(normalize_title(title))
+        if not trigrams:
+            return []
+        min_score = min(max(float(min_score), 0.01), 1.0)
+        query_count = len(trigrams)
+        # Dice >= min_score bounds how many trigrams must be shared.
+        least_shared = max(1, int(math.ceil(
+            min_score * query_count / (2 - min_score))))
+        shared = Counter()
+        with self._lock:
+            for trigram in trigrams:
+                shared.update(self._posting(trigram))
+            candidates = [node_id for node_id, count in shared.items()
+                          if count >= least_shared]
+            rows = []
+            # in chunks, under SQLite's limit on query parameters
+            for start in range(0, len(candidates), 500):
+                chunk = candidates[start:start + 500]
+                rows.extend(self._db.execute(
+                    "SELECT node_id, title, trigram_count FROM titles "
+                    "WHERE node_id IN ({0})".format(
+                        ', '.join('?' * len(chunk))), chunk))
+        matches = []
+        for node_id, found, trigram_count in rows:
+            score = 2.0 * shared[node_id] / (query_count + trigram_count)
+            if score >= min_score:
+                matches.append(TitleMatch(node_id, found, round(score, 4)))
+        matches.sort(key=lambda match: (-match.score, match.node_id))
+        return matches[:limit]
+
+    def find(self, title, min_score=0.6, limit=10):
+        # Exact matches first, then similar titles, without repeats.
+        matches = self.find_exact(title)
+        found = set(match.node_id for match in matches)
+        for match in self.find_similar(title, min_score, limit):
+            if match.node_id not in found:
+                matches.append(match)
+        return matches[:limit]
+
+    def _commit(self):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO postings VALUES (?, ?)",
+            [(trigram, array('q', sorted(node_ids)).tobytes())
+             for trigram, node_ids in self._changed.items() if node_ids])
+        self._db.executemany(
+            "DELETE FROM postings WHERE trigram = ?",
+            [(trigram,) for trigram, node_ids in self._changed.items()
+             if not node_ids])
+        self._db.commit()
+        self._changed = {}
+        self._uncommitted = 0
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+        return None
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+        return None
+
+# Set through enable_title_index.  When None titles are only kept in
+# argument_graph.
+title_index = None
+
+def enable_title_index(db_path=None):
+    # From now on every title argument_graph learns of, from searches,
+    # crawls, created and edited nodes, is kept in a TitleIndex, starting
+    # with the titles it already holds.  Relegated nodes are removed.
+    global title_index
+    title_index = TitleIndex(db_path)
+    for record in list(argument_graph.nodes.values()):
+        if record.title is not None:
+            title_index.set_title(record.id, record.title)
+    argument_graph.title_index = title_index
+    return title_index
+
+def find_duplicate_title(title, min_score=0.8):
+    # The indexed node whose title matches title best with a score of at
+    # least min_score, or None.
+    if title_index is None:
+        return None
+    matches = title_index.find(title, min_score, limit=1)
+    return matches[0] if matches else None
+
+def iter_new_titles(titles_iterable, min_score=0.8, duplicates=None):
+    # Yields the titles that find_duplicate_title does not match and that
+    # did not come earlier in titles_iterable.  Each skipped title is
+    # appended to duplicates as (title, TitleMatch or None for a repeat).
+    seen = set()
+    for title in titles_iterable:
+        normalized = normalize_title(title)
+        match = find_duplicate_title(title, min_score)
+        if match is None and normalized not in seen:
+            seen.add(normalized)
+            yield title
+        elif duplicates is not None:
+            duplicates.append((title, match))
+
+def get_node_data(title_text):
     the_explan = 'This node posted via automation in oneslate.py v0.0.1-dev.'
     node_data = {
         "title": title_text,
@@ -158,219 +1602,792 @@ def add_node(server, s, xcsrf_token, title_to_add):
         "type": None,
         "sources": []
     }
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    request_node  = s.post(node_url, json=node_data, timeout=1, verify=cert_in_use)
-    logging.debug(request_node.content)
-    logging.info("status code returned = " + str(request_node.status_code))
-    if request_node.status_code == 201:  # HTTP 201 Created
-        return True 
-    else:
+    return node_data
+
+class OneslateClient(object):
+    # Server, session and CSRF token of one login, for any number of threads
+    # at once.  Calls never write to shared state: the CSRF header is a
+    # read-only mapping merged into each request's own headers and TLS
+    # verification is fixed when the client is made, so later changes to
+    # cert_in_use do not reach it.  The session's connection pool and cookie
+    # jar are thread safe, and OneslateSession logs in again at most once
+    # when several threads see the same expired token.  Requests keep
+    # sending the token given here; the session swaps it for the renewed one.
+    # The module-level functions taking (server, s, xcsrf_token) build a
+    # client and delegate to it.
+
+    def __init__(self, server, s, xcsrf_token, verify=None):
+        self.server = server
+        self.session = s
+        self.xcsrf_token = xcsrf_token
+        self.verify = cert_in_use if verify is None else verify
+        self.csrf_header = types.MappingProxyType(
+            {} if xcsrf_token is None else {"X-CSRF-Token": xcsrf_token})
+
+    @classmethod
+    def log_in(cls, server, cookies_file=None, user=None, passwd=None, 
+               verify=None):
+        s, xcsrf_token = get_session(server, cookies_file, user, passwd, 
+                                     verify)
+        return cls(server, s, xcsrf_token, verify)
+
+    def ensure_pool_size(self, pool_size):
+        ensure_pool_size(self.session, max(1, int(pool_size)))
+        return self
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        headers = dict(self.csrf_header)
+        headers.update(kwargs.pop('headers', None) or {})
+        kwargs.setdefault('verify', self.verify)
+        return send_request(self.session, method, url, idempotent=idempotent,
+                            headers=headers, **kwargs)
+
+    def node_json_url(self, node_id):
+        node_url = get_node_url(self.server)
+        return node_url + "/{node_id}.json".format(**locals())
+
+    def get_json(self, url, node_id, params=None):
+        # GET a JSON document about node_id through node_cache when enabled.
+        # Returns (status code, decoded body or None).
+        headers = {}
+        entry = None
+        if node_cache is not None:
+            cache_key = node_cache.make_key(url, params)
+            entry, fresh = node_cache.lookup(cache_key)
+            if fresh:
+                logging.debug(LazyFormat("cache hit for {cache_key}",
+                                         cache_key=cache_key))
+                return 200, decode_json(entry.body)
+            if entry is not None:
+                if entry.etag:
+                    headers['If-None-Match'] = entry.etag
+                if entry.last_modified:
+                    headers['If-Modified-Since'] = entry.last_modified
+        response = self.request('GET', url, params=params, headers=headers)
+        log_response(response)
+        if response.status_code == 304 and entry is not None:  # Not Modified
+            entry = node_cache.revalidated(cache_key, entry)
+            return 200, decode_json(entry.body)
+        if response.status_code != 200:  # HTTP 200 OK
+            return response.status_code, None
+        if node_cache is not None:
+            node_cache.store(cache_key, node_id, response)
+        return response.status_code, decode_json(response.content)
+
+    def add_node(self, title_to_add):
+        node_url = get_node_url(self.server)
+        title_text = str(title_to_add)
+        title_length = len(title_text)
+        if title_length <= 0:
+            logging.warning("Title length of {title_length} too short. Not "
+                            "trying to add node.")
+            return False 
+        node_data = get_node_data(title_text)
+        request_node = self.request('POST', node_url, json=node_data)
+        log_response(request_node)
+        if request_node.status_code == 201:  # HTTP 201 Created
+            try:
+                argument_graph.add_node(decode_json(request_node.content))
+            except ValueError:
+                pass
+            return True 
+        else:
+            return None
+
+    def post_node(self, title_to_add):
+        # add_node returning an AddNodeResult, with request errors reported
+        # in it rather than raised.
+        node_url = get_node_url(self.server)
+        title_text = str(title_to_add)
+        if len(title_text) <= 0:
+            return AddNodeResult(title_text, None, "title too short")
+        node_data = get_node_data(title_text)
+        try:
+            request_node = self.request('POST', node_url, json=node_data)
+        except requests.exceptions.RequestException as e:
+            return AddNodeResult(title_text, None, "{0}".format(e))
+        log_response(request_node)
+        if request_node.status_code != 201:  # HTTP 201 Created
+            return AddNodeResult(title_text, None, 
+                    "status code {0}".format(request_node.status_code))
+        try:
+            node_id = decode_json(request_node.content)['id']
+        except (ValueError, KeyError, TypeError):
+            node_id = None
+        else:
+            argument_graph.add_node({'id': node_id, 'title': title_text})
+        return AddNodeResult(title_text, node_id, None)
+
+    def iter_search_results(self, search_string):
+        # Yields a SearchResult per node whose title matches search_string,
+        # as the response body streams in.  Further pages announced by a
+        # Link: <...>; rel="next" header are followed.  Raises
+        # requests.exceptions.HTTPError if the server refuses the search.
+        page_url = get_node_url(self.server)
+        query_params = {
+            "term": search_string,
+            "filter": "title"
+        }
+        while page_url:
+            query_response = self.request('GET', page_url, data=query_params,
+                                          stream=True)
+            with contextlib.closing(query_response):
+                logging.debug(LazyFormat("status code returned = {0}",
+                                         query_response.status_code))
+                query_response.raise_for_status()
+                for result in iter_json_array(
+                        query_response.iter_content(chunk_size=65536)):
+                    argument_graph.add_node(result)
+                    yield SearchResult(result.get('id'), result.get('title'),
+                                       result)
+                page_url = query_response.links.get('next', {}).get('url')
+
+    def fetch_node_details(self, node_id):
+        # Returns the detail view of a node, or None if it could not be read.
+        details_params = {
+            "view": "detail"
+        }
+        status_code, results_data = self.get_json(
+            self.node_json_url(node_id), node_id, params=details_params)
+        logging.debug(results_data)
+        if results_data is None:
+            return None
+        argument_graph.add_node(results_data)
+        return results_data
+
+    def fetch_node_counts(self, node_id):
+        # Returns the stats view of a node (children_count, parents_count,
+        # flags_count and, when the server sends it, ratings_count), or None
+        # if it could not be read.
+        stats_params = {
+            "view": "stats"
+        }
+        status_code, results_data = self.get_json(
+            self.node_json_url(node_id), node_id, params=stats_params)
+        logging.debug(results_data)
+        if results_data is None:
+            return None
+        argument_graph.add_node(dict(results_data, id=node_id))
+        return results_data
+
+    def get_tree(self, node_id):
+        tree_url = get_tree_url(self.server)
+        node_tree_url = tree_url + "/{node_id}.json".format(**locals())
+        status_code, tree_data = self.get_json(node_tree_url, node_id)
+        if status_code == 200:  # HTTP 200 OK
+            argument_graph.add_tree(tree_data)
+            return tree_data
+        else:
+            return None
+
+    def rate_node(self, node_to_rate, rating):
+        # Appears at this time unimportant to distinguish between rating and
+        # re-rating a node.  In the future the "type: update" pair may be
+        # added.
+        rating = int(rating)
+        rating_data = {
+            "rating": rating,
+            "timeseries": False
+        }
+        node_url = get_node_url(self.server)
+        rate_node_url = node_url + "/{node_to_rate}/ratings.json".format(
+            **locals())
+        logging.debug(LazyFormat("rating_data = {rating_data}",
+                                 rating_data=rating_data))
+        logging.debug(LazyFormat("rate_node_url = {rate_node_url}",
+                                 rate_node_url=rate_node_url))
+        request_node = self.request('POST', rate_node_url, json=rating_data)
+        invalidate_nodes(node_to_rate)
+        log_response(request_node)
+        if request_node.status_code == 201:  # HTTP 201 Created
+            return True 
+        else:
+            return None
+
+    def post_rating(self, node_to_rate, rating):
+        # rate_node returning a RateNodeResult, with request errors reported
+        # in it rather than raised.
+        rating_data = {
+            "rating": rating,
+            "timeseries": False
+        }
+        node_url = get_node_url(self.server)
+        rate_node_url = node_url + "/{node_to_rate}/ratings.json".format(
+            **locals())
+        try:
+            request_node = self.request('POST', rate_node_url, 
+                                        json=rating_data)
+        except requests.exceptions.RequestException as e:
+            return RateNodeResult(node_to_rate, rating, False, "{0}".format(e))
+        invalidate_nodes(node_to_rate)
+        logging.info("status code returned = " + str(request_node.status_code))
+        if request_node.status_code != 201:  # HTTP 201 Created
+            return RateNodeResult(node_to_rate, rating, False,
+                    "status code {0}".format(request_node.status_code))
+        return RateNodeResult(node_to_rate, rating, True, None)
+
+    def add_support_link(self, node_to_support, supporting_node_id):
+        support_link_data = {
+            "sources": [],
+            "child_id": supporting_node_id 
+        }
+        support_link_url = self.node_json_url(node_to_support)
+        logging.debug(LazyFormat("support_link_data = {support_link_data}",
+                                 support_link_data=support_link_data))
+        logging.debug(LazyFormat("support_link_url = {support_link_url}",
+                                 support_link_url=support_link_url))
+        request_node = self.request('PATCH', support_link_url, 
+                                    json=support_link_data)
+        invalidate_nodes(node_to_support, supporting_node_id)
+        log_response(request_node)
+        if request_node.status_code == 202:  # HTTP 202 Accepted
+            argument_graph.add_edge(node_to_support, supporting_node_id)
+            return True 
+        else:
+            return None
+
+    def add_conclusion_link(self, node_to_link_conclusion_to, 
+                            conclusion_node_id):
+        conclusion_link_data = {
+            "sources": [],
+            "parent_id": conclusion_node_id 
+        }
+        conclusion_link_url = self.node_json_url(node_to_link_conclusion_to)
+        logging.debug(LazyFormat("support_link_data = {conclusion_link_data}",
+                                 conclusion_link_data=conclusion_link_data))
+        logging.debug(LazyFormat("support_link_url = {conclusion_link_url}",
+                                 conclusion_link_url=conclusion_link_url))
+        request_node = self.request('PATCH', conclusion_link_url,
+                                    json=conclusion_link_data)
+        invalidate_nodes(node_to_link_conclusion_to, conclusion_node_id)
+        log_response(request_node)
+        if request_node.status_code == 202:  # HTTP 202 Accepted
+            argument_graph.add_edge(conclusion_node_id, 
+                                    node_to_link_conclusion_to)
+            return True 
+        else:
+            return None
+
+    def relegate_node(self, id_of_node, relegate_confirmation):
+        relegation_url = self.node_json_url(id_of_node)
+        logging.debug(LazyFormat("relegate_link_url = {relegation_url}",
+                                 relegation_url=relegation_url))
+        if "{relegate_confirmation}".format(**locals()) == "confirm":
+            request_node = self.request('DELETE', relegation_url)
+            invalidate_node_and_neighbours(id_of_node)
+            log_response(request_node)
+            if request_node.status_code == 204:  # HTTP 204 No Content 
+                argument_graph.remove_node(id_of_node)
+                return True 
+            else:
+                return None
+        else:
+            logging.warning("Confirmation argument did not match required "
+                            "value.")
+            return None
+
+    def edit_node(self, node_id, new_title):
+        title_text = str(new_title)
+        edit_node_data = {
+            "title": title_text,
+        }
+        edit_node_url = self.node_json_url(node_id)
+        logging.debug(LazyFormat("edit_node_data = {edit_node_data}",
+                                 edit_node_data=edit_node_data))
+        logging.debug(LazyFormat("edit_node_url = {edit_node_url}",
+                                 edit_node_url=edit_node_url))
+        # Setting a title twice leaves the same result, so it is safe to
+        # retry.
+        request_node = self.request('PATCH', edit_node_url, idempotent=True,
+                                    json=edit_node_data)
+        invalidate_node_and_neighbours(node_id)
+        log_response(request_node)
+        if request_node.status_code == 202:  # HTTP 202 Accepted
+            argument_graph.update_node(node_id, title=title_text)
+            return True 
+        else:
+            return None
+
+    def map(self, function, items, max_workers=8):
+        # Yields function(self, item) for each item, in input order, from up
+        # to max_workers threads sharing this client and its pool.
+        self.ensure_pool_size(max_workers)
+        return iter_bounded(lambda item: function(self, item), items, 
+                            max_workers)
+
+# One account of a SessionPool.
+Account = namedtuple('Account', ['user', 'passwd'])
+
+def read_accounts(path):
+    # One account per line: the username, whitespace, then the password.
+    # Blank lines and lines starting with # are skipped.  A path of - reads
+    # stdin.
+    accounts = []
+    with contextlib.closing(open_input(path)) as accounts_file:
+        for line in accounts_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError("Account line without a password: "
+                                 "{0!r}".format(fields[0]))
+            accounts.append(Account(fields[0], fields[1]))
+    return accounts
+
+def account_file(path, user):
+    # path with user added before its extension, so cookies.txt becomes
+    # cookies.alice@example.com.txt and each account keeps its own file.
+    root, extension = os.path.splitext(path)
+    user = re.sub(r'[^\w.@+-]', '_', user)
+    return '{root}.{user}{extension}'.format(**locals())
+
+class SessionPool(object):
+    # A OneslateClient per account of one server.  Each account logs in on
+    # first use, reusing the cookies and CSRF token saved by save() in its own
+    # account_file of cookies_input, so sessions stay warm between runs.
+    # Clients are thread safe, and logging in one account does not hold up
+    # the others.
+
+    def __init__(self, server, accounts, cookies_input='cookies.txt', 
+                 cookies_output=None, verify=None):
+        self.server = server
+        self.accounts = OrderedDict((account.user, account) 
+                                    for account in accounts)
+        self.cookies_input = cookies_input
+        self.cookies_output = cookies_output or cookies_input
+        self.verify = verify
+        self._clients = {}
+        self._locks = dict((user, threading.Lock()) for user in self.accounts)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    @property
+    def users(self):
+        return list(self.accounts)
+
+    def select(self, users=None):
+        # Usernames from a list or comma separated string; None or 'all'
+        # selects every account.  Raises ValueError for unknown accounts.
+        if users is None or users == 'all':
+            return self.users
+        if isinstance(users, str):
+            users = [user.strip() for user in users.split(',') if user.strip()]
+        unknown = [user for user in users if user not in self.accounts]
+        if unknown:
+            raise ValueError("Unknown accounts: {0}".format(', '.join(unknown)))
+        return list(users)
+
+    def client(self, user):
+        with self._locks[user]:
+            client = self._clients.get(user)
+            if client is None:
+                client = OneslateClient.log_in(
+                    self.server, account_file(self.cookies_input, user), user,
+                    self.accounts[user].passwd, self.verify)
+                self._clients[user] = client
+        return client
+
+    def fan_out(self, function, users=None, max_workers=8):
+        # Yields (user, function(client)) for each selected account, in
+        # order, running up to max_workers accounts at once.
+        return iter_bounded(lambda user: (user, function(self.client(user))),
+                            self.select(users), max_workers)
+
+    def route(self, function, pairs, max_workers=8):
+        # Yields function(client, item) for each (user, item) pair, in input
+        # order, with up to max_workers calls running across the accounts.
+        return iter_bounded(lambda pair: function(self.client(pair[0]), 
+                                                  pair[1]),
+                            pairs, max_workers)
+
+    def save(self):
+        # Saves the cookies and CSRF token of every account logged in so far.
+        for user, client in list(self._clients.items()):
+            save_session(client.session, 
+                         account_file(self.cookies_output, user))
         return None
 
-def search_nodes(server, s, xcsrf_token, search_string):
-    node_url = get_node_url(server)
+def add_node(server, s, xcsrf_token, title_to_add):
+    return OneslateClient(server, s, xcsrf_token).add_node(title_to_add)
+
+# One entry per title handed to add_nodes: node_id is set on success and error
+# holds a short reason otherwise.
+AddNodeResult = namedtuple('AddNodeResult', ['title', 'node_id', 'error'])
+
+# Serializes pool growth, so threads sharing a session mount one adapter.
+pool_size_lock = threading.Lock()
+
+def ensure_pool_size(s, pool_size):
+    # Grows the session's pool to at least pool_size connections so every
+    # worker thread can hold one.
+    with pool_size_lock:
+        adapter = s.get_adapter('https://')
+        if getattr(adapter, '_pool_maxsize', 0) < pool_size:
+            transport.mount(s, pool_size)
+    return s
+
+def post_node(server, s, xcsrf_token, title_to_add):
+    return OneslateClient(server, s, xcsrf_token).post_node(title_to_add)
+
+def iter_bounded(function, items, max_workers=8):
+    # Yields function(item) for each item, in input order, while keeping at
+    # most max_workers calls running.  Items are consumed lazily so
+    # arbitrarily long inputs do not have to fit in memory.
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    max_workers = max(1, int(max_workers))
+    items = iter(items)
+    pending = {}
+    done_by_index = {}
+    next_index = 0
+    next_to_yield = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while len(pending) < max_workers:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                pending[executor.submit(function, item)] = next_index
+                next_index += 1
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done_by_index[pending.pop(future)] = future.result()
+            while next_to_yield in done_by_index:
+                yield done_by_index.pop(next_to_yield)
+                next_to_yield += 1
+
+def iter_add_nodes(server, s, xcsrf_token, titles_iterable, max_workers=8):
+    # Yields an AddNodeResult per title, in input order, while keeping at most
+    # max_workers POSTs in flight.
+    return OneslateClient(server, s, xcsrf_token).map(
+        OneslateClient.post_node, titles_iterable, max_workers)
+
+def add_nodes(server, s, xcsrf_token, titles_iterable, max_workers=8):
+    return list(iter_add_nodes(server, s, xcsrf_token, titles_iterable, 
+                               max_workers))
+
+def open_input(path):
+    # A path of - reads stdin, which is left open when the result is closed.
+    if path == '-':
+        return open(sys.stdin.fileno(), 'r', closefd=False)
+    return open(path, 'r')
+
+def read_titles(path):
+    # One title per line; blank lines are skipped.  A path of - reads stdin.
+    title_file = open_input(path)
+    try:
+        for line in title_file:
+            title = line.rstrip('\r\n')
+            if title.strip():
+                yield title
+    finally:
+        title_file.close()
+
+# One node matching a search.  data keeps every field the server sent.
+SearchResult = namedtuple('SearchResult', ['id', 'title', 'data'])
+
+def iter_json_array(chunks):
+    # Yields the elements of a JSON array as its text arrives in chunks, so
+    # memory stays bounded by the largest element rather than the response.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a JSON array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if exhausted:
+                    raise
+            else:
+                yield element
+                position = end
+                continue
+        elif exhausted:
+            raise ValueError("JSON array ended early")
+        # need more text; drop what has been consumed
+        buffer = buffer[position:]
+        position = 0
+        try:
+            buffer += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buffer += text_decoder.decode(b'', final=True)
+            exhausted = True
+
+def iter_search_results(server, s, xcsrf_token, search_string):
+    return OneslateClient(server, s, xcsrf_token).iter_search_results(
+        search_string)
+
+def write_search_results(results, output_format, output_file, query=None):
+    # Writes results as they arrive.  output_format is table, json, jsonl or
+    # csv.
+    if output_format == 'table':
+        output_file.write(
+            "Search results for node title: {query}\n"
+            "node_id | node_title\n"
+            "--------+-----------------------------------------------------------"
+            "\n".format(**locals()))
+        for result in results:
+            output_file.write('{0: <8}'.format(result.id) + 
+                              "| {0}\n".format(result.title))
+    elif output_format == 'jsonl':
+        for result in results:
+            output_file.write(json.dumps(result.data) + "\n")
+    elif output_format == 'json':
+        separator = "[\n"
+        for result in results:
+            output_file.write(separator + json.dumps(result.data))
+            separator = ",\n"
+        output_file.write("[]\n" if separator == "[\n" else "\n]\n")
+    elif output_format == 'csv':
+        writer = csv.writer(output_file)
+        writer.writerow(['node_id', 'node_title'])
+        for result in results:
+            writer.writerow([result.id, result.title])
+    else:
+        raise ValueError("Unknown output format: " + output_format)
+    return None
+
+def search_nodes(server, s, xcsrf_token, search_string, output_format='table',
+                 output_file=None):
     query = search_string
     logging.debug("query = " + query)
-    query_params = {
-        "term": query,
-        "filter": "title"
-    }
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    query_response = s.get(node_url, data=query_params, timeout=1, verify=cert_in_use)
-    results_data = json.loads(query_response.text)
-    logging.debug(results_data)
-    logging.debug("status code returned = " + str(query_response.status_code))
-    print(
-        "Search results for node title: {query}\n"
-        "node_id | node_title\n"
-        "--------+-----------------------------------------------------------"
-        "".format(**locals()))
-    for result in results_data:
-        id = result['id']
-        title = result['title']
-        print('{0: <8}'.format(id) + "| {title}".format(**locals()))
-    if query_response.status_code == 200:  # HTTP 200 OK
-        return True 
-    else:
+    if output_file is None:
+        output_file = sys.stdout
+    results = iter_search_results(server, s, xcsrf_token, query)
+    try:
+        write_search_results(results, output_format, output_file, query)
+    except requests.exceptions.HTTPError as e:
+        logging.warning("{0}".format(e))
         return None
+    return True 
+
+def fetch_node_details(server, s, xcsrf_token, node_id):
+    return OneslateClient(server, s, xcsrf_token).fetch_node_details(node_id)
+
+# Fields of the detail view printed by get_node_details, in order.
+NODE_DETAIL_FIELDS = ('id', 'title', 'rating', 'explanation', 'media', 'type',
+                      'flagged', 'followed', 'created_at', 'username',
+                      'rating_counts', 'ratings_count', 'current_user_author',
+                      'communities', 'sources')
 
 def get_node_details(server, s, xcsrf_token, node_id):
-    logging.debug("node_id = {node_id}".format(**locals()))
-    details_params = {
-        "view": "detail"
-    }
-    node_url = get_node_url(server)
-    node_details_url = node_url + "/{node_id}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    query_response = s.get(node_details_url, params=details_params, 
-            timeout=1, verify=cert_in_use)
-    results_data = json.loads(query_response.text)
-    logging.debug(results_data)
-    logging.debug("status code returned = " + str(query_response.status_code))
-    id = results_data['id']
-    rating = results_data['rating']
-    title = results_data['title']
-    media = results_data['media']
-    type = results_data['type']
-    flagged = results_data['flagged']
-    followed = results_data['followed']
-    explanation = results_data['explanation']
-    created_at = results_data['created_at']
-    username = results_data['username']
-    rating_counts = results_data['rating_counts']
-    ratings_count = results_data['ratings_count']
-    current_user_author = results_data['current_user_author']
-    communities = results_data['communities']
-    sources = results_data['sources']
+    logging.debug(LazyFormat("node_id = {node_id}", node_id=node_id))
+    results_data = fetch_node_details(server, s, xcsrf_token, node_id)
+    if results_data is None:
+        return None
+    lines = [
+        "Details for node_id: {node_id}".format(**locals()),
+        "detail              | value",
+        "--------------------+-----------------------------------------------",
+    ]
+    for field in NODE_DETAIL_FIELDS:
+        lines.append('{0: <20}| {1}'.format(field, results_data[field]))
+    print('\n'.join(lines))
     # May not get back any key/value pair for time series unless ratings exist
-    if int(ratings_count) > 0:
-      ratings_time_series = results_data['ratings_time_series']
-    print(
-        "Details for node_id: {node_id}\n"
-        "detail              | value\n"
-        "--------------------+-----------------------------------------------\n"
-        "id                  | {id}\n"  
-        "title               | {title}\n"  
-        "rating              | {rating}\n"  
-        "explanation         | {explanation}\n"  
-        "media               | {media}\n"  
-        "type                | {type}\n"  
-        "flagged             | {flagged}\n"  
-        "followed            | {followed}\n"  
-        "created_at          | {created_at}\n"  
-        "username            | {username}\n"  
-        "rating_counts       | {rating_counts}\n"  
-        "ratings_count       | {ratings_count}\n"  
-        "current_user_author | {current_user_author}\n"  
-        "communities         | {communities}\n"  
-        "sources             | {sources}"  
-        "".format(**locals()))
-    if int(ratings_count) > 0:
-        print("ratings_time_series | {ratings_time_series}".format(**locals()))
+    if int(results_data['ratings_count']) > 0:
+        print("ratings_time_series | {0}".format(
+            results_data['ratings_time_series']))
     else:
         print("ratings_time_series | (not applicable)")
-    if query_response.status_code == 200:  # HTTP 200 OK
-        return results_data
-    else:
-        return None
+    return results_data
 
 def rate_node(server, s, xcsrf_token, node_to_rate, rating):
-    # Appears at this time unimportant to distinguish between rating and 
-    # re-rating a node.  In the future the "type: update" pair may be added.
-    rating = int(rating)
-    rating_data = {
-        "rating": rating,
-        "timeseries": False
-    }
-    node_url = get_node_url(server)
-    rate_node_url = node_url + "/{node_to_rate}/ratings.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    logging.debug("rating_data = {rating_data}".format(**locals()))
-    logging.debug("rate_node_url = {rate_node_url}".format(**locals()))
-    request_node  = s.post(rate_node_url, json=rating_data, timeout=1, verify=cert_in_use)
-    logging.debug(request_node.content)
-    logging.info("status code returned = " + str(request_node.status_code))
-    if request_node.status_code == 201:  # HTTP 201 Created
-        return True 
-    else:
-        return None
+    return OneslateClient(server, s, xcsrf_token).rate_node(node_to_rate, 
+                                                            rating)
+
+# One entry per (node_id, rating) pair handed to rate_nodes.  ok is True once
+# the server accepted the rating; error holds a short reason otherwise.
+RateNodeResult = namedtuple('RateNodeResult', 
+                            ['node_id', 'rating', 'ok', 'error'])
+
+def validate_rating(rating):
+    # Ratings use the 0 (none) to 4 (full) validity scale.
+    rating_value = int("{rating}".format(**locals()).strip())
+    if rating_value < 0 or rating_value > 4:
+        raise ValueError("rating {rating_value} is outside 0 - 4".format(
+            **locals()))
+    return rating_value
+
+def post_rating(server, s, xcsrf_token, node_to_rate, rating):
+    return OneslateClient(server, s, xcsrf_token).post_rating(node_to_rate, 
+                                                              rating)
+
+def read_ratings(path):
+    # Yields (node_id, validity) pairs from CSV (node_id,validity per line,
+    # optional header) or JSONL ({"node_id": ..., "validity": ...} per line;
+    # "rating" is accepted in place of "validity").  A path of - reads stdin.
+    for line in read_titles(path):
+        line = line.strip()
+        if line.startswith('{'):
+            record = json.loads(line)
+            yield (record['node_id'], 
+                   record.get('validity', record.get('rating')))
+            continue
+        fields = next(csv.reader([line]))
+        if len(fields) < 2:
+            raise ValueError("Expected node_id,validity but got: " + line)
+        if fields[0].strip() == 'node_id':
+            continue  # header
+        yield (fields[0].strip(), fields[1].strip())
+
+def load_rating_log(path):
+    # Returns node_id -> the last input index a previous run logged as 
+    # accepted for that node.
+    accepted = {}
+    try:
+        with open(path, 'r') as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+                if record.get('ok') and record.get('index') is not None:
+                    node_id = normalize_node_id(record['node_id'])
+                    accepted[node_id] = max(record['index'], 
+                                            accepted.get(node_id, -1))
+    except (IOError, OSError):
+        pass
+    return accepted
+
+def check_rating(node_id, rating):
+    # Returns (node_id, rating, error) with both parsed to integers where 
+    # possible; error is None when the pair can be sent.
+    node_id = normalize_node_id(node_id)
+    try:
+        rating = int("{rating}".format(**locals()).strip())
+    except ValueError:
+        return (node_id, None, 
+                "rating {rating!r} is not an integer".format(**locals()))
+    if not isinstance(node_id, int):
+        return (node_id, rating, 
+                "node id {node_id!r} is not an integer".format(**locals()))
+    try:
+        validate_rating(rating)
+    except ValueError as e:
+        return (node_id, rating, "{0}".format(e))
+    return (node_id, rating, None)
+
+def iter_rate_nodes(server, s, xcsrf_token, ratings_iterable, max_workers=8,
+                    already_rated=None):
+    # Yields (index, RateNodeResult) per (node_id, validity) pair, in input 
+    # order, index being the pair's position in ratings_iterable.  Invalid
+    # pairs are reported without being sent, a rating repeating the node's
+    # previous one is sent once, and pairs at or before the index 
+    # already_rated (see load_rating_log) holds for their node are skipped
+    # entirely.  Ratings of the same node are never in flight together: 
+    # each waits for the one before it, so the server keeps the node's last
+    # rating in the input.
+    skipped = already_rated or {}
+    latest = {}  # node_id -> (rating, Event set once it has been sent)
+
+    def ordered_pairs():
+        for index, (node_id, rating) in enumerate(ratings_iterable):
+            node_id, rating, error = check_rating(node_id, rating)
+            if error is not None:
+                yield (index, RateNodeResult(node_id, rating, False, error))
+                continue
+            if index <= skipped.get(node_id, -1):
+                continue
+            previous = latest.get(node_id)
+            if previous is not None and previous[0] == rating:
+                continue
+            sent = threading.Event()
+            latest[node_id] = (rating, sent)
+            yield (index, (node_id, rating, previous and previous[1], sent))
+
+    def submit(client, pair):
+        index, pair = pair
+        if isinstance(pair, RateNodeResult):
+            return (index, pair)
+        node_id, rating, previous_sent, sent = pair
+        try:
+            # submitted earlier, so already running or done
+            if previous_sent is not None:
+                previous_sent.wait()
+            return (index, client.post_rating(node_id, rating))
+        finally:
+            sent.set()
+
+    return OneslateClient(server, s, xcsrf_token).map(submit, ordered_pairs(),
+                                                      max_workers)
+
+def rate_nodes(server, s, xcsrf_token, ratings_iterable, max_workers=8, 
+               result_log=None):
+    # Bulk version of rate_node.  When result_log is given, results are
+    # appended to it as JSON lines with their input index, and input up to
+    # the last index it records as accepted for a node is not rated again, 
+    # so an interrupted run can simply be repeated on the same input.
+    already_rated = load_rating_log(result_log) if result_log else None
+    log_file = open(result_log, 'a') if result_log else None
+    results = []
+    try:
+        for index, result in iter_rate_nodes(server, s, xcsrf_token, 
+                                             ratings_iterable, max_workers, 
+                                             already_rated):
+            if log_file is not None:
+                record = dict(result._asdict(), index=index)
+                log_file.write(json.dumps(record) + "\n")
+                log_file.flush()
+            results.append(result)
+    finally:
+        if log_file is not None:
+            log_file.close()
+    return results
 
 def add_support_link(server, s, xcsrf_token, node_to_support, 
                      supporting_node_id):
-    support_link_data = {
-        "sources": [],
-        "child_id": supporting_node_id 
-    }
-    node_url = get_node_url(server)
-    support_link_url = "{node_url}/{node_to_support}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    logging.debug("support_link_data = {support_link_data}".format(**locals()))
-    logging.debug("support_link_url = {support_link_url}".format(**locals()))
-    request_node  = s.patch(support_link_url, json=support_link_data, 
-                            timeout=1, verify=cert_in_use)
-    logging.debug(request_node.content)
-    logging.info("status code returned = " + str(request_node.status_code))
-    if request_node.status_code == 202:  # HTTP 202 Accepted
-        return True 
-    else:
-        return None
+    return OneslateClient(server, s, xcsrf_token).add_support_link(
+        node_to_support, supporting_node_id)
 
 def add_conclusion_link(server, s, xcsrf_token, node_to_link_conclusion_to, 
         conclusion_node_id):
-    conclusion_link_data = {
-        "sources": [],
-        "parent_id": conclusion_node_id 
-    }
-    node_url = get_node_url(server)
-    conclusion_link_url = ("{node_url}/{node_to_link_conclusion_to}"
-                ".json".format(**locals()))
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    logging.debug("support_link_data = {conclusion_link_data}".format(**locals()))
-    logging.debug("support_link_url = {conclusion_link_url}".format(**locals()))
-    request_node  = s.patch(conclusion_link_url, json=conclusion_link_data, timeout=1, verify=cert_in_use)
-    logging.debug(request_node.content)
-    logging.info("status code returned = " + str(request_node.status_code))
-    if request_node.status_code == 202:  # HTTP 202 Accepted
-        return True 
-    else:
-        return None
+    return OneslateClient(server, s, xcsrf_token).add_conclusion_link(
+        node_to_link_conclusion_to, conclusion_node_id)
 
 def relegate_node(server, s, xcsrf_token, id_of_node, relegate_confirmation):
-    node_url = get_node_url(server)
-    relegation_url= node_url + "/{id_of_node}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    logging.debug("relegate_link_url = {relegation_url}".format(**locals()))
-    if "{relegate_confirmation}".format(**locals()) == "confirm":
-        request_node  = s.delete(relegation_url, timeout=1, verify=cert_in_use)
-        logging.debug(request_node.content)
-        logging.info("status code returned = " + str(request_node.status_code))
-        if request_node.status_code == 204:  # HTTP 204 No Content 
-            return True 
-        else:
-            return None
-    else:
-        logging.warning("Confirmation argument did not match required value.")
-        return None
+    return OneslateClient(server, s, xcsrf_token).relegate_node(
+        id_of_node, relegate_confirmation)
+
+def fetch_node_counts(server, s, xcsrf_token, node_id):
+    return OneslateClient(server, s, xcsrf_token).fetch_node_counts(node_id)
 
 def get_node_stats(server, s, xcsrf_token, node_id):
-    logging.debug("node_id = {node_id}".format(**locals()))
-    stats_params = {
-        "view": "stats"
-    }
-    node_url = get_node_url(server)
-    node_stats_url = node_url + "/{node_id}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    query_response = s.get(node_stats_url, params=stats_params, 
-            timeout=1, verify=cert_in_use)
-    results_data = json.loads(query_response.text)
-    logging.debug(results_data)
-    logging.debug("status code returned = " + str(query_response.status_code))
+    logging.debug(LazyFormat("node_id = {node_id}", node_id=node_id))
+    results_data = fetch_node_counts(server, s, xcsrf_token, node_id)
     children_count = results_data['children_count']
     parents_count = results_data['parents_count']
     flags_count = results_data['flags_count']
     return (children_count, parents_count, flags_count)
 
 def list_supports(server, s, xcsrf_token, id_of_root_node):
-    tree_url = get_tree_url(server)
     (supports_qty, conclusions_qty, flag_qty) = get_node_stats(
             server, s, xcsrf_token, id_of_root_node)
-    list_supports_url= tree_url + "/{id_of_root_node}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    logging.debug("supports_list_url = {list_supports_url}".format(**locals()))
-    supports_list_response = s.get(list_supports_url, timeout=1, verify=cert_in_use)
-    supports_list_data = supports_list_response.json() 
-    # logging.debug(supports_list_response.content)
-    logging.info("status code returned = " + str(supports_list_response.status_code))
-    # logging.debug("supports_list_response.content = " + str(supports_list_response.content))
-    logging.debug("supports_list_data = " + str(supports_list_data))
-    # node_title = next((x['title'] for x in supports_list_data['nodes'] if x['id'] == id_of_root_node)) 
-    node_title = next((x['title'] for x in supports_list_data['nodes'] if x['id'] == supports_list_data['mapping']['id']))
+    supports_list_data = get_tree(server, s, xcsrf_token, id_of_root_node)
+    logging.debug(LazyFormat("supports_list_data = {supports_list_data}",
+                             supports_list_data=supports_list_data))
+    if supports_list_data is None:
+        return None
+    # get_tree indexed the titles in argument_graph
+    node_title = argument_graph.title_of(supports_list_data['mapping']['id'])
     print(
         "Results for:\n"
         " node_id: {id_of_root_node}\n"
@@ -386,43 +2403,23 @@ def list_supports(server, s, xcsrf_token, id_of_root_node):
         if "children" in supports_list_data['mapping']:
             for support in supports_list_data['mapping']['children']:
                 support_id = support['id']
-                support_title = next((x['title'] for x in supports_list_data['nodes'] if x['id'] == support_id), None)
+                support_title = argument_graph.title_of(support_id)
                 print('{0: <8}'.format(support_id) + "| {support_title}".format(**locals()))
     else:
         logging.warning("No supports found for that node_id.")
-    if supports_list_response.status_code == 200:  # HTTP 200 OK
-        return True 
-    else:
-        return None
+    return True 
 
 def edit_node(server, s, xcsrf_token, node_id, new_title):
-    title_text = str(new_title)
-    edit_node_data = {
-        "title": title_text,
-    }
-    node_url = get_node_url(server)
-    edit_node_url = node_url + "/{node_id}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    logging.debug("xcsrf_token = " + xcsrf_token)
-    logging.debug("edit_node_data = {edit_node_data}".format(**locals()))
-    logging.debug("edit_node_url = {edit_node_url}".format(**locals()))
-    request_node  = s.patch(edit_node_url, json=edit_node_data, timeout=1, verify=cert_in_use)
-    logging.debug(request_node.content)
-    logging.info("status code returned = " + str(request_node.status_code))
-    if request_node.status_code == 202:  # HTTP 202 Accepted
-        return True 
-    else:
-        return None
+    return OneslateClient(server, s, xcsrf_token).edit_node(node_id, 
+                                                            new_title)
 
 def node_stats(server, s, xcsrf_token, node_id):
     (supports_qty, conclusions_qty, flag_qty) = get_node_stats(
             server, s, xcsrf_token, node_id)
-    tree_url = get_tree_url(server)
-    title_url = tree_url + "/{node_id}.json".format(**locals())
-    s.headers.update({"X-CSRF-Token": xcsrf_token})
-    title_response = s.get(title_url, timeout=1, verify=cert_in_use)
-    title_data = title_response.json() 
-    node_title = next((x['title'] for x in title_data['nodes'] if x['id'] == title_data['mapping']['id']))
+    title_data = get_tree(server, s, xcsrf_token, node_id)
+    if title_data is None:
+        return None
+    node_title = argument_graph.title_of(title_data['mapping']['id'])
     print(
         "node_id:           {node_id}\n"
         "node_title:        {node_title}\n"
@@ -430,55 +2427,1189 @@ def node_stats(server, s, xcsrf_token, node_id):
         "conclusions_count: {conclusions_qty}\n"
         "flags_count:       {flag_qty}".format(**locals())
     )
-    if title_response.status_code == 200:  # HTTP 200 OK
-        return True 
-    else:
+    return True 
+
+def normalize_node_id(node_id):
+    # Command line ids arrive as strings while the server returns integers.
+    try:
+        return int(node_id)
+    except (TypeError, ValueError):
+        return node_id
+
+def get_tree(server, s, xcsrf_token, node_id):
+    return OneslateClient(server, s, xcsrf_token).get_tree(node_id)
+
+def crawl_tree(server, s, xcsrf_token, id_of_root_node, depth=3, 
+               max_workers=8):
+    # Breadth-first walk of /trees/{id}.json documents.  Every node of a level
+    # is fetched concurrently and each node id is fetched at most once, so
+    # cycles and shared subtrees cost a single request.  Returns a dict with
+    # the root id, the nodes found keyed by id, the (conclusion_id,
+    # support_id) edges and the ids whose trees could not be fetched.
+    from concurrent.futures import ThreadPoolExecutor
+    max_workers = max(1, int(max_workers))
+    ensure_pool_size(s, max_workers)
+    root_id = normalize_node_id(id_of_root_node)
+    graph = {'root': root_id, 'nodes': {}, 'edges': set(), 'errors': []}
+    graph['nodes'][root_id] = {'id': root_id, 'depth': 0}
+    seen = set([root_id])
+    frontier = [root_id]
+
+    def fetch_tree(node_id):
+        try:
+            return get_tree(server, s, xcsrf_token, node_id)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Could not fetch tree {0}: {1}".format(node_id, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for level in range(int(depth)):
+            if not frontier:
+                break
+            trees = executor.map(fetch_tree, frontier)
+            next_frontier = []
+            for node_id, tree_data in zip(frontier, trees):
+                if tree_data is None:
+                    graph['errors'].append(node_id)
+                    continue
+                for node in tree_data.get('nodes', []):
+                    known = graph['nodes'].get(node['id'])
+                    if known is not None:
+                        known.update(node)
+                mapping = tree_data.get('mapping', {})
+                neighbours = []
+                for support in mapping.get('children', []):
+                    graph['edges'].add((node_id, support['id']))
+                    neighbours.append(support['id'])
+                for conclusion in mapping.get('parents', []):
+                    graph['edges'].add((conclusion['id'], node_id))
+                    neighbours.append(conclusion['id'])
+                titles = {x['id']: x for x in tree_data.get('nodes', [])}
+                for neighbour_id in neighbours:
+                    if neighbour_id in seen:
+                        continue
+                    seen.add(neighbour_id)
+                    node = dict(titles.get(neighbour_id, {'id': neighbour_id}))
+                    node['depth'] = level + 1
+                    graph['nodes'][neighbour_id] = node
+                    next_frontier.append(neighbour_id)
+            frontier = next_frontier
+    graph['edges'] = sorted(graph['edges'])
+    return graph
+
+def read_graph(path):
+    # Returns (nodes, edges) from a JSON or GraphML graph file.  nodes is a
+    # list of (local_id, title) and edges a list of (conclusion_id,
+    # support_id) local ids; title is None for a node without one.  JSON
+    # files use the crawl_tree layout:
+    #   {"nodes": [{"id": "a", "title": "..."}, ...],
+    #    "edges": [["a", "b"], ...]}
+    # where an edge may also be {"conclusion": "a", "support": "b"}.  In
+    # GraphML the edge source is the conclusion and the target its support,
+    # and titles come from the node data key named "title".
+    with open(path, 'rb') as graph_file:
+        head = graph_file.read(64).lstrip()
+    if path.endswith('.graphml') or head.startswith(b'<'):
+        return read_graphml(path)
+    with open(path, 'r') as graph_file:
+        graph_data = json.load(graph_file)
+    nodes = [(node['id'], node.get('title')) for node in graph_data['nodes']]
+    edges = []
+    for edge in graph_data.get('edges', []):
+        if isinstance(edge, dict):
+            edges.append((edge['conclusion'], edge['support']))
+        else:
+            edges.append((edge[0], edge[1]))
+    return nodes, edges
+
+def read_graphml(path):
+    from xml.etree import ElementTree
+    nodes = []
+    edges = []
+    title_key = None
+    for event, element in ElementTree.iterparse(path):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'key' and element.get('attr.name') == 'title':
+            title_key = element.get('id')
+        elif tag == 'node':
+            title = None
+            for data in element:
+                if data.get('key') in (title_key, 'title'):
+                    title = data.text
+            nodes.append((element.get('id'), title))
+            element.clear()
+        elif tag == 'edge':
+            edges.append((element.get('source'), element.get('target')))
+            element.clear()
+    return nodes, edges
+
+def load_import_checkpoint(path):
+    # Returns ({local_id: server_id}, set of linked (conclusion, support)
+    # local id pairs) recorded by an earlier import_graph run.
+    ids = {}
+    links = set()
+    try:
+        with open(path, 'r') as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+                if 'node' in record:
+                    ids[record['node']] = record['server_id']
+                else:
+                    links.add(tuple(record['link']))
+    except (IOError, OSError):
+        pass
+    return ids, links
+
+def import_graph(server, s, xcsrf_token, nodes, edges, max_workers=8, 
+                 checkpoint=None):
+    # Creates every node concurrently, taking server ids from the 201
+    # responses, then links supports to conclusions concurrently, except
+    # that links to the same conclusion, which PATCH the same node, are sent
+    # one after the other.  Nodes without a title are not created.  With
+    # a checkpoint file, progress is appended to it as JSON lines and work it
+    # already records is skipped, so an interrupted import can be repeated.
+    # Returns a dict with the local to server id mapping and what failed.
+    ids, linked = ({}, set())
+    if checkpoint:
+        ids, linked = load_import_checkpoint(checkpoint)
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+    summary = {'ids': ids, 'failed_nodes': [], 'failed_links': []}
+
+    def record(entry):
+        if checkpoint_file is not None:
+            checkpoint_file.write(json.dumps(entry) + "\n")
+            checkpoint_file.flush()
+
+    try:
+        to_create = []
+        for local_id, title in nodes:
+            if local_id in ids:
+                continue
+            if not title:
+                summary['failed_nodes'].append(local_id)
+                logging.warning("Failed to add node {0}: no title".format(
+                    local_id))
+                continue
+            to_create.append((local_id, title))
+        results = iter_add_nodes(server, s, xcsrf_token, 
+                                 (title for local_id, title in to_create),
+                                 max_workers)
+        for (local_id, title), result in zip(to_create, results):
+            if result.node_id is None:
+                summary['failed_nodes'].append(local_id)
+                logging.warning("Failed to add node {0}: {1}".format(
+                    local_id, result.error or "no id in response"))
+                continue
+            ids[local_id] = result.node_id
+            record({'node': local_id, 'server_id': result.node_id})
+
+        to_link = []
+        for edge in edges:
+            edge = tuple(edge)
+            if edge in linked:
+                continue
+            if edge[0] not in ids or edge[1] not in ids:
+                summary['failed_links'].append(edge)
+                continue
+            to_link.append(edge)
+
+        def ordered_links():
+            latest = {}  # conclusion -> Event set once its link has been sent
+            for edge in to_link:
+                sent = threading.Event()
+                yield (edge, latest.get(edge[0]), sent)
+                latest[edge[0]] = sent
+
+        def link(item):
+            edge, previous_sent, sent = item
+            try:
+                # submitted earlier, so already running or done
+                if previous_sent is not None:
+                    previous_sent.wait()
+                return add_support_link(server, s, xcsrf_token, ids[edge[0]],
+                                        ids[edge[1]])
+            except requests.exceptions.RequestException as e:
+                logging.warning("{0}".format(e))
+                return None
+            finally:
+                sent.set()
+
+        for edge, linked_ok in zip(to_link, iter_bounded(link, ordered_links(),
+                                                         max_workers)):
+            if linked_ok == True:
+                record({'link': list(edge)})
+            else:
+                summary['failed_links'].append(edge)
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+    return summary
+
+def open_output(path):
+    # A path of - writes to stdout.
+    if path is None or path == '-':
+        return sys.stdout
+    return open(path, 'w')
+
+def write_graph(graph, path):
+    graph_data = {
+        'root': graph['root'],
+        'nodes': list(graph['nodes'].values()),
+        'edges': [list(edge) for edge in graph['edges']],
+        'errors': graph['errors'],
+    }
+    output_file = open_output(path)
+    try:
+        json.dump(graph_data, output_file, indent=2)
+        output_file.write("\n")
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+    return None
+
+
+# Snapshot files start with SNAPSHOT_MAGIC, a little-endian 64 bit header
+# length and a JSON header naming each column's typecode, offset and item
+# count.  Columns follow, each aligned to 8 bytes, holding nodes sorted by
+# id: integer count fields use -1 and ratings NaN for unknown values, titles
+# and rating time series are UTF-8/JSON blobs addressed by offset columns.
+SNAPSHOT_MAGIC = b'OSSNAP01'
+SNAPSHOT_COUNT_FIELDS = ('ratings_count', 'children_count', 'parents_count',
+                         'flags_count')
+
+def pack_blobs(texts):
+    # Returns (offsets, blob) where text i is blob[offsets[i]:offsets[i + 1]].
+    offsets = array('q', [0])
+    blob = bytearray()
+    for text in texts:
+        blob += text.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, array('B', bytes(blob))
+
+def write_snapshot(path, nodes, edges, metadata=None):
+    # nodes maps node ids to dicts of the fields described above; edges holds
+    # (conclusion_id, support_id) pairs.
+    node_ids = sorted(nodes)
+    columns = OrderedDict()
+    columns['id'] = array('q', node_ids)
+    for field in SNAPSHOT_COUNT_FIELDS:
+        columns[field] = array('q', (-1 if nodes[node_id].get(field) is None
+                                     else int(nodes[node_id][field]) 
+                                     for node_id in node_ids))
+    ratings = array('d')
+    rating_counts = array('q')
+    for node_id in node_ids:
+        try:
+            ratings.append(float(nodes[node_id].get('rating')))
+        except (TypeError, ValueError):
+            ratings.append(float('nan'))
+        counts = normalize_rating_counts(nodes[node_id].get('rating_counts'))
+        rating_counts.extend(counts if counts is not None else (-1,) * 5)
+    columns['rating'] = ratings
+    columns['rating_counts'] = rating_counts
+    columns['title_offsets'], columns['titles'] = pack_blobs(
+        nodes[node_id].get('title') or '' for node_id in node_ids)
+    columns['series_offsets'], columns['series'] = pack_blobs(
+        json.dumps(nodes[node_id].get('ratings_time_series')) 
+        for node_id in node_ids)
+    edges = sorted(set(tuple(edge) for edge in edges))
+    columns['edge_conclusion'] = array('q', (edge[0] for edge in edges))
+    columns['edge_support'] = array('q', (edge[1] for edge in edges))
+    header = dict(metadata or {})
+    header.update({'created_at': time.time(), 'byteorder': sys.byteorder,
+                   'node_count': len(node_ids), 'edge_count': len(edges),
+                   'columns': {}})
+    offset = 0
+    for name, column in columns.items():
+        header['columns'][name] = [column.typecode, offset, len(column)]
+        offset += -(-len(column) * column.itemsize // 8) * 8
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(SNAPSHOT_MAGIC)
+        snapshot_file.write(struct.pack('<Q', len(header_bytes)))
+        snapshot_file.write(header_bytes)
+        snapshot_file.write(b'\0' * (-snapshot_file.tell() % 8))
+        for column in columns.values():
+            snapshot_file.write(column.tobytes())
+            snapshot_file.write(b'\0' * (-snapshot_file.tell() % 8))
+    return header
+
+class Snapshot(object):
+    # Read-only view of a snapshot file.  The file is memory-mapped and each
+    # column is only touched when first used, so opening is independent of
+    # snapshot size.  Node lookups bisect the sorted id column.
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            self.close()
+            raise ValueError("{path} is not a snapshot file".format(**locals()))
+        header_length = struct.unpack_from('<Q', self._map, 
+                                           len(SNAPSHOT_MAGIC))[0]
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        self.header = json.loads(
+            self._map[header_start:header_start + header_length].decode('utf-8'))
+        if self.header['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError("Snapshot was written with another byte order")
+        self._data_start = -(-(header_start + header_length) // 8) * 8
+        self._columns = {}
+
+    def close(self):
+        for column in self._columns.values():
+            column.release()
+        self._columns = {}
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.header['node_count']
+
+    def column(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            typecode, offset, length = self.header['columns'][name]
+            start = self._data_start + offset
+            itemsize = array(typecode).itemsize
+            column = memoryview(self._map)[start:start + length * itemsize]
+            column = column.cast(typecode)
+            self._columns[name] = column
+        return column
+
+    def _blob_text(self, offsets_name, blob_name, index):
+        offsets = self.column(offsets_name)
+        blob = self.column(blob_name)
+        return bytes(blob[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def index_of(self, node_id):
+        ids = self.column('id')
+        node_id = normalize_node_id(node_id)
+        index = bisect.bisect_left(ids, node_id)
+        if index < len(ids) and ids[index] == node_id:
+            return index
         return None
 
+    def node_at(self, index, time_series=True):
+        node = {'id': self.column('id')[index],
+                'title': self._blob_text('title_offsets', 'titles', index)}
+        for field in SNAPSHOT_COUNT_FIELDS:
+            value = self.column(field)[index]
+            node[field] = None if value < 0 else value
+        rating = self.column('rating')[index]
+        node['rating'] = None if math.isnan(rating) else rating
+        rating_counts = tuple(self.column('rating_counts')[index * 5:
+                                                           index * 5 + 5])
+        node['rating_counts'] = None if rating_counts[0] < 0 else rating_counts
+        if time_series:
+            node['ratings_time_series'] = json.loads(
+                self._blob_text('series_offsets', 'series', index))
+        return node
 
-def main(args):
-    logging.basicConfig()
-    if args['--verbose'] == True:
-        logging.getLogger().setLevel(logging.INFO)
-    elif args['--quiet'] == True:
-        logging.getLogger().setLevel(logging.ERROR)
-    elif args['--debug'] == True:
-        logging.getLogger().setLevel(logging.DEBUG)
-    else: 
-        logging.getLogger().setLevel(logging.WARNING)
-    logging.debug("Got args:\n{args}".format(**locals()))
-    cookies_input = args['--input']
-    cookies_output = args['--output']
-    if args['--user']:
-        user = args['--user']
-    else:
-        user = None
-    if args['--server']:
-        server = args['--server']
-    if args['--pass']:
-        password = args['--pass']
-    else:
-        password = None
-    if args['--config']:
-        config_path = args['--config']
+    def get(self, node_id):
+        index = self.index_of(node_id)
+        return None if index is None else self.node_at(index)
+
+    def iter_nodes(self):
+        for index in range(len(self)):
+            yield self.node_at(index)
+
+    def edges(self):
+        return zip(self.column('edge_conclusion'), self.column('edge_support'))
+
+    def rating_summary(self):
+        # Same totals as ArgumentGraph.rating_summary, read off the columns.
+        rating_counts = self.column('rating_counts')
+        bins = [sum(count for count in rating_counts[validity::5] if count > 0)
+                for validity in range(5)]
+        rated_nodes = sum(1 for count in rating_counts[::5] if count >= 0)
+        ratings_count = sum(bins)
+        mean = None
+        if ratings_count:
+            mean = sum(validity * count 
+                       for validity, count in enumerate(bins)) / ratings_count
+        return {'nodes': rated_nodes, 'ratings_count': ratings_count, 
+                'rating_counts': bins, 'mean_validity': mean}
+
+    def to_graph(self, graph=None):
+        # Fills an ArgumentGraph (by default a new one) from the snapshot.
+        if graph is None:
+            graph = ArgumentGraph()
+        for index in range(len(self)):
+            graph.add_node(self.node_at(index, time_series=False))
+        for conclusion_id, support_id in self.edges():
+            graph.add_edge(conclusion_id, support_id)
+        return graph
+
+def load_snapshot(path):
+    return Snapshot(path)
+
+def fetch_snapshot_nodes(server, s, xcsrf_token, node_ids, max_workers=8):
+    # Returns {node_id: fields} with the detail and stats views of each node
+    # that could be read.
+    def fetch(node_id):
         try:
-            with open(config_path, 'r') as config_file:
-                config = config_file.read().splitlines()
-        except:
-            logging.warning("Problem reading config file! Exiting.")
-        if len(config) == 3:
-            logging.debug("config = {config}".format(**locals()))
-            server = config[0]
-            user = config[1]
-            password = config[2]
+            details = fetch_node_details(server, s, xcsrf_token, node_id)
+            counts = fetch_node_counts(server, s, xcsrf_token, node_id)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Could not fetch node {0}: {1}".format(node_id, e))
+            return None
+        if details is None or counts is None:
+            return None
+        fields = dict(counts)
+        for field in ('title', 'rating', 'rating_counts', 'ratings_count',
+                      'ratings_time_series'):
+            fields[field] = details.get(field)
+        return fields
+    node_ids = list(node_ids)
+    fetched = {}
+    for node_id, fields in zip(node_ids, iter_bounded(fetch, node_ids, 
+                                                      max_workers)):
+        if fields is not None:
+            fetched[node_id] = fields
+    return fetched
+
+def export_snapshot(server, s, xcsrf_token, root_ids, path, depth=3, 
+                    max_workers=8, previous_path=None):
+    # Crawls the trees under root_ids and writes the nodes, ratings and edges
+    # to a snapshot file.  Given the previous snapshot, only the stats view
+    # of each known node is read; trees are fetched again only for nodes whose
+    # support or conclusion counts changed, and details only for nodes whose
+    # rating or flag counts changed or that are new.  A re-rating that leaves
+    # ratings_count unchanged is therefore only picked up by a full export.
+    root_ids = [normalize_node_id(root_id) for root_id in root_ids]
+    nodes = {}
+    edges = set()
+    to_crawl = [(root_id, depth) for root_id in root_ids]
+    to_fetch = set()
+    if previous_path:
+        with load_snapshot(previous_path) as previous:
+            nodes = dict((node['id'], node) for node in previous.iter_nodes())
+            edges = set(previous.edges())
+        to_crawl = [(root_id, depth) for root_id in root_ids 
+                    if root_id not in nodes]
+        known_ids = list(nodes)
+        counts = iter_bounded(
+            lambda node_id: fetch_node_counts(server, s, xcsrf_token, node_id),
+            known_ids, max_workers)
+        restructured = []
+        for node_id, current in zip(known_ids, counts):
+            if current is None:  # relegated or unreadable
+                del nodes[node_id]
+                continue
+            old = nodes[node_id]
+            if any(current.get(field) != old.get(field)
+                   for field in ('children_count', 'parents_count')):
+                restructured.append(node_id)
+            if any(field in current and current[field] != old.get(field)
+                   for field in ('ratings_count', 'flags_count')):
+                to_fetch.add(node_id)
+            old.update(current)
+        edges = set(edge for edge in edges 
+                    if edge[0] in nodes and edge[1] in nodes)
+        trees = iter_bounded(
+            lambda node_id: get_tree(server, s, xcsrf_token, node_id),
+            restructured, max_workers)
+        for node_id, tree_data in zip(restructured, trees):
+            if tree_data is None:
+                continue
+            mapping = tree_data.get('mapping', {})
+            edges = set(edge for edge in edges if edge[0] != node_id)
+            edges.update((node_id, support['id']) 
+                         for support in mapping.get('children', []))
+            if 'parents' in mapping:
+                edges = set(edge for edge in edges if edge[1] != node_id)
+                edges.update((conclusion['id'], node_id)
+                             for conclusion in mapping['parents'])
+        # nodes newly linked to known ones only need their own links
+        to_crawl.extend((node_id, 1) for node_id in 
+                        set(node_id for edge in edges for node_id in edge
+                            if node_id not in nodes))
+    crawled = set()
+    for root_id, crawl_depth in to_crawl:
+        if root_id in crawled:
+            continue
+        graph = crawl_tree(server, s, xcsrf_token, root_id, crawl_depth, 
+                           max_workers)
+        edges.update(graph['edges'])
+        new_ids = set(graph['nodes']) - set(nodes)
+        crawled.update(graph['nodes'])
+        to_fetch.update(new_ids)
+    fetched = fetch_snapshot_nodes(server, s, xcsrf_token, sorted(to_fetch),
+                                   max_workers)
+    for node_id, fields in fetched.items():
+        nodes.setdefault(node_id, {}).update(fields)
+    # nodes that could not be read are left out together with their edges
+    for node_id in to_fetch - set(fetched):
+        nodes.pop(node_id, None)
+    edges = set(edge for edge in edges 
+                if edge[0] in nodes and edge[1] in nodes)
+    header = write_snapshot(path, nodes, edges, 
+                            {'server': server, 'roots': root_ids})
+    header['fetched'] = len(fetched)
+    return header
+
+# What sync reports.  kind is added, removed, rated, flagged or linked;
+# changes maps each changed field to its (old, new) values and data carries
+# what was fetched because of the change.
+SyncEvent = namedtuple('SyncEvent', ['kind', 'node_id', 'changes', 'data'])
+
+class WatchedNode(object):
+    __slots__ = ('node_id', 'depth', 'counts', 'supports', 'conclusions',
+                 'interval', 'due_at')
+
+    def __init__(self, node_id, depth, interval):
+        self.node_id = node_id
+        self.depth = depth
+        self.counts = None
+        self.supports = set()
+        self.conclusions = set()
+        self.interval = interval
+        self.due_at = 0
+
+class SyncWatcher(object):
+    # Keeps the nodes within depth of the watched roots up to date by
+    # polling their stats view, the cheapest request per node.  A tree is
+    # fetched again only when children_count or parents_count changes, and
+    # details only when ratings_count or flags_count does.  Every node has
+    # its own polling interval: it drops to min_interval when the node
+    # changes and grows by backoff (up to max_interval) each time it does
+    # not, so request load follows the rate of change rather than the number
+    # of nodes.  A node whose tree or details cannot be fetched is backed off
+    # the same way and reports the change on a later poll.  With a cache 
+    # enabled, keep min_interval above its ttl.
+
+    COUNT_FIELDS = ('children_count', 'parents_count', 'flags_count',
+                    'ratings_count')
+
+    def __init__(self, server, s, xcsrf_token, depth=3, min_interval=5,
+                 max_interval=300, backoff=2, max_workers=8):
+        self.server = server
+        self.session = s
+        self.xcsrf_token = xcsrf_token
+        self.depth = int(depth)
+        self.min_interval = float(min_interval)
+        self.max_interval = max(float(max_interval), self.min_interval)
+        self.backoff = float(backoff)
+        self.max_workers = max(1, int(max_workers))
+        self.nodes = {}
+        self._schedule = []
+        ensure_pool_size(s, self.max_workers)
+
+    def _schedule_node(self, node, now, changed):
+        if changed:
+            node.interval = self.min_interval
         else:
-            logging.warning("Config file was not 3 lines! Exiting.")
+            node.interval = min(self.max_interval, 
+                                node.interval * self.backoff)
+        node.due_at = now + node.interval
+        heapq.heappush(self._schedule, (node.due_at, node.node_id))
+
+    def _fetch_counts(self, node_id):
+        # (status code, stats dict or None); errors count as status None.
+        stats_url = get_node_url(self.server) + "/{node_id}.json".format(
+            **locals())
+        try:
+            status_code, counts = get_json(self.session, stats_url,
+                                           self.xcsrf_token, node_id,
+                                           params={"view": "stats"})
+        except requests.exceptions.RequestException as e:
+            logging.warning("Could not poll node {0}: {1}".format(node_id, e))
+            return None, None
+        if counts is not None:
+            argument_graph.add_node(dict(counts, id=node_id))
+        return status_code, counts
+
+    def _fetch_tree(self, node_id):
+        try:
+            return get_tree(self.server, self.session, self.xcsrf_token, 
+                            node_id)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Could not fetch tree {0}: {1}".format(node_id, e))
             return None
-    else:
-        config = None
-    logging.debug("Got user={user} and password={password}".format(**locals()))
-    active_session, security_token = get_session(server, cookies_input, user, 
-                                                 password)
+
+    def _fetch_details(self, node_id):
+        try:
+            return fetch_node_details(self.server, self.session, 
+                                      self.xcsrf_token, node_id)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Could not fetch node {0}: {1}".format(node_id, e))
+            return None
+
+    def _retry_later(self, node, changes, fields, now):
+        # Puts back the old value of the changed fields a failed fetch could
+        # not act on, so the next poll sees the change again, and backs the
+        # node off.
+        for field in fields:
+            if field in changes:
+                node.counts[field] = changes[field][0]
+        self._schedule_node(node, now, False)
+
+    def _add_nodes(self, depths, now):
+        # Starts watching {node_id: depth}, taking baseline counts.  Returns
+        # the added events.
+        node_ids = [node_id for node_id in depths if node_id not in self.nodes]
+        events = []
+        fetched = iter_bounded(self._fetch_counts, node_ids, self.max_workers)
+        for node_id, (status_code, counts) in zip(node_ids, fetched):
+            if counts is None:
+                logging.warning("Could not read node {0}; not watching "
+                                "it.".format(node_id))
+                continue
+            node = WatchedNode(node_id, depths[node_id], self.min_interval)
+            node.counts = dict((field, counts.get(field)) 
+                               for field in self.COUNT_FIELDS)
+            self.nodes[node_id] = node
+            self._schedule_node(node, now, True)
+            events.append(SyncEvent('added', node_id, {}, dict(
+                node.counts, depth=node.depth, 
+                title=argument_graph.title_of(node_id))))
+        return events
+
+    def watch(self, root_id):
+        # Crawls the tree under root_id and returns an added event for every
+        # node newly watched.
+        root_id = normalize_node_id(root_id)
+        graph = crawl_tree(self.server, self.session, self.xcsrf_token,
+                           root_id, self.depth, self.max_workers)
+        depths = dict((node_id, node['depth']) 
+                      for node_id, node in graph['nodes'].items()
+                      if node_id not in self.nodes or 
+                      node['depth'] < self.nodes[node_id].depth)
+        for node_id, depth in depths.items():
+            if node_id in self.nodes:
+                self.nodes[node_id].depth = depth
+        events = self._add_nodes(depths, time.time())
+        for conclusion_id, support_id in graph['edges']:
+            if conclusion_id in self.nodes and support_id in self.nodes:
+                self.nodes[conclusion_id].supports.add(support_id)
+                self.nodes[support_id].conclusions.add(conclusion_id)
+        return events
+
+    def next_due(self):
+        # Time of the next poll, or None with nothing watched.
+        while self._schedule:
+            due_at, node_id = self._schedule[0]
+            node = self.nodes.get(node_id)
+            if node is not None and node.due_at == due_at:
+                return due_at
+            heapq.heappop(self._schedule)  # rescheduled or removed
+        return None
+
+    def _relink(self, node, tree_data):
+        mapping = tree_data.get('mapping', {})
+        supports = set(support['id'] for support in 
+                       mapping.get('children', []))
+        conclusions = node.conclusions
+        if 'parents' in mapping:
+            conclusions = set(conclusion['id'] for conclusion in
+                              mapping['parents'])
+        data = {
+            'supports_added': sorted(supports - node.supports),
+            'supports_removed': sorted(node.supports - supports),
+            'conclusions_added': sorted(conclusions - node.conclusions),
+            'conclusions_removed': sorted(node.conclusions - conclusions),
+        }
+        node.supports = supports
+        node.conclusions = conclusions
+        return data
+
+    def poll(self, now=None):
+        # Polls every node that is due and returns the resulting events.
+        if now is None:
+            now = time.time()
+        due = []
+        while self.next_due() is not None and self.next_due() <= now:
+            due.append(self.nodes[heapq.heappop(self._schedule)[1]])
+        events = []
+        restructured = []
+        rerated = []
+        polled = iter_bounded(lambda node: self._fetch_counts(node.node_id),
+                              due, self.max_workers)
+        for node, (status_code, counts) in zip(due, polled):
+            if status_code == 404:  # relegated
+                del self.nodes[node.node_id]
+                for other in self.nodes.values():
+                    other.supports.discard(node.node_id)
+                    other.conclusions.discard(node.node_id)
+                events.append(SyncEvent('removed', node.node_id, {}, None))
+                continue
+            if counts is None:
+                self._schedule_node(node, now, False)
+                continue
+            changes = dict((field, (node.counts.get(field), 
+                                    counts.get(field)))
+                           for field in self.COUNT_FIELDS 
+                           if counts.get(field) != node.counts.get(field))
+            node.counts = dict((field, counts.get(field)) 
+                               for field in self.COUNT_FIELDS)
+            self._schedule_node(node, now, bool(changes))
+            if not changes:
+                continue
+            if 'children_count' in changes or 'parents_count' in changes:
+                restructured.append((node, changes))
+            if 'ratings_count' in changes or 'flags_count' in changes:
+                rerated.append((node, changes))
+        trees = iter_bounded(lambda item: self._fetch_tree(item[0].node_id),
+                             restructured, self.max_workers)
+        new_depths = {}
+        for (node, changes), tree_data in zip(restructured, trees):
+            if tree_data is None:
+                self._retry_later(node, changes, 
+                                  ('children_count', 'parents_count'), now)
+                continue
+            data = self._relink(node, tree_data)
+            events.append(SyncEvent('linked', node.node_id, changes, data))
+            if node.depth < self.depth:
+                for node_id in data['supports_added'] + \
+                        data['conclusions_added']:
+                    if node_id not in self.nodes:
+                        new_depths[node_id] = min(
+                            new_depths.get(node_id, node.depth + 1),
+                            node.depth + 1)
+        events.extend(self._add_nodes(new_depths, now))
+        for node_id in new_depths:
+            if node_id not in self.nodes:
+                continue
+            for other in self.nodes.values():
+                if node_id in other.supports:
+                    self.nodes[node_id].conclusions.add(other.node_id)
+                if node_id in other.conclusions:
+                    self.nodes[node_id].supports.add(other.node_id)
+        details = iter_bounded(
+            lambda item: self._fetch_details(item[0].node_id),
+            rerated, self.max_workers)
+        for (node, changes), node_details in zip(rerated, details):
+            if node_details is None:
+                self._retry_later(node, changes, 
+                                  ('ratings_count', 'flags_count'), now)
+                continue
+            data = dict((field, node_details.get(field)) for field in 
+                        ('title', 'rating', 'rating_counts', 'ratings_count',
+                         'flagged'))
+            if 'ratings_count' in changes:
+                events.append(SyncEvent('rated', node.node_id, changes, data))
+            if 'flags_count' in changes:
+                events.append(SyncEvent('flagged', node.node_id, changes, 
+                                        data))
+        return events
+
+    def iter_events(self, duration=None):
+        # Polls until duration seconds have passed (forever by default),
+        # sleeping until the next node is due, and yields each event.
+        stop_at = None if duration is None else time.time() + float(duration)
+        while True:
+            due_at = self.next_due()
+            if due_at is None:
+                return
+            if stop_at is not None and due_at > stop_at:
+                time.sleep(max(0, stop_at - time.time()))
+                return
+            time.sleep(max(0, due_at - time.time()))
+            for event in self.poll():
+                yield event
+
+def write_sync_event(event, output_file):
+    output_file.write(json.dumps(event._asdict()) + "\n")
+    output_file.flush()
+
+# One queued mutation.  args are the positional arguments of the function
+# named by kind after (server, s, xcsrf_token); state is pending, taken
+# (picked for sending, only kept in memory), sending, done, failed,
+# superseded or unknown.
+class OutboxEntry(object):
+    __slots__ = ('seq', 'kind', 'args', 'state', 'result', 'error')
+
+    def __init__(self, seq, kind, args, state='pending'):
+        self.seq = seq
+        self.kind = kind
+        self.args = list(args)
+        self.state = state
+        self.result = None
+        self.error = None
+
+    def node_ids(self):
+        # Nodes whose operations must reach the server in journal order.
+        if self.kind == 'add_node':
+            return ()
+        if self.kind in ('add_support_link', 'add_conclusion_link'):
+            return (self.args[0], self.args[1])
+        return (self.args[0],)
+
+    def coalesce_key(self):
+        # Entries with equal keys supersede each other.  A conclusion link is
+        # the same edge as a support link in the other direction.
+        if self.kind == 'add_node':
+            return None
+        if self.kind == 'rate_node':
+            return ('rate', self.args[0])
+        if self.kind == 'edit_node':
+            return ('edit', self.args[0])
+        if self.kind == 'add_support_link':
+            return ('link', self.args[0], self.args[1])
+        if self.kind == 'add_conclusion_link':
+            return ('link', self.args[1], self.args[0])
+        return ('relegate', self.args[0])
+
+class Outbox(object):
+    # Write-behind queue of mutations, backed by an append-only journal of
+    # JSON lines.  enqueue() journals an operation and returns its sequence
+    # number at once; a background thread (start) or flush() sends pending
+    # operations with up to max_workers requests in flight.  Superseded
+    # operations are dropped before they are sent: the last edit and the
+    # last rating of a node win, a repeated link is sent once, and relegating
+    # a node drops its pending edits and ratings.  Operations on the same
+    # node are sent in journal order.  Each operation is journaled as
+    # sending just before its own request goes out and is never sent again
+    # after a restart, so delivery is at most once; only operations a crash
+    # caught in flight are marked unknown.  Operations taken for sending but
+    # not yet sent stay pending in the journal and are sent by the next run.
+
+    OPERATIONS = ('add_node', 'rate_node', 'edit_node', 'add_support_link',
+                  'add_conclusion_link', 'relegate_node')
+
+    def __init__(self, server, s, xcsrf_token, journal_path, max_workers=8,
+                 flush_interval=0.2, fsync=True):
+        self.server = server
+        self.session = s
+        self.xcsrf_token = xcsrf_token
+        self.journal_path = journal_path
+        self.max_workers = max(1, int(max_workers))
+        self.flush_interval = float(flush_interval)
+        self.fsync = fsync
+        self.entries = OrderedDict()
+        self._pending_keys = {}
+        self.counters = {'done': 0, 'failed': 0, 'superseded': 0, 
+                         'unknown': 0}
+        self.failures = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._replay()
+        self._journal = open(journal_path, 'a')
+        ensure_pool_size(s, self.max_workers)
+
+    def _replay(self):
+        # Rebuilds the pending entries from the journal and rewrites it with
+        # only those, so it does not grow across runs.
+        entries = OrderedDict()
+        try:
+            with open(self.journal_path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # line cut short by a crash
+                    if 'kind' in record:
+                        entries[record['seq']] = OutboxEntry(
+                            record['seq'], record['kind'], record['args'])
+                    elif record['seq'] in entries:
+                        entries[record['seq']].state = record['state']
+        except (IOError, OSError):
+            pass
+        unknown = [seq for seq, entry in entries.items() 
+                   if entry.state == 'sending']
+        self.counters['unknown'] = len(unknown)
+        if unknown:
+            logging.warning("Outbox operations {0} were in flight when the "
+                            "last run stopped and are not sent again.".format(
+                                unknown))
+        self._next_seq = max(entries) + 1 if entries else 1
+        temporary_path = self.journal_path + '.tmp'
+        with open(temporary_path, 'w') as journal_file:
+            for seq, entry in entries.items():
+                if entry.state != 'pending':
+                    continue
+                self.entries[seq] = entry
+                if entry.coalesce_key() is not None:
+                    self._pending_keys.setdefault(entry.coalesce_key(), seq)
+                journal_file.write(json.dumps({'seq': seq, 
+                                               'kind': entry.kind,
+                                               'args': entry.args}) + "\n")
+        os.replace(temporary_path, self.journal_path)
+        if self.entries:
+            logging.info("Outbox resumed {0} pending operations.".format(
+                len(self.entries)))
+
+    def _write(self, records):
+        for record in records:
+            self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _mark(self, entries, state):
+        # Sets the state in memory only.
+        for entry in entries:
+            entry.state = state
+            if self._pending_keys.get(entry.coalesce_key()) == entry.seq:
+                del self._pending_keys[entry.coalesce_key()]
+
+    def _set_state(self, entries, state, **fields):
+        self._mark(entries, state)
+        self._write([dict(fields, seq=entry.seq, state=state) 
+                     for entry in entries])
+
+    def enqueue(self, kind, *args):
+        # Journals the operation and returns its sequence number, or the
+        # number of the pending operation that already does the same.
+        if kind not in self.OPERATIONS:
+            raise ValueError("Unknown outbox operation {0}".format(kind))
+        args = list(args)
+        if kind != 'add_node':
+            args[0] = normalize_node_id(args[0])
+        if kind in ('add_support_link', 'add_conclusion_link'):
+            args[1] = normalize_node_id(args[1])
+        if kind == 'rate_node':
+            args[1] = validate_rating(args[1])
+        with self._condition:
+            entry = OutboxEntry(self._next_seq, kind, args)
+            key = entry.coalesce_key()
+            # new nodes never supersede each other
+            earlier_seq = None if key is None else self._pending_keys.get(key)
+            if earlier_seq is not None and kind in ('add_support_link',
+                                                    'add_conclusion_link',
+                                                    'relegate_node'):
+                return earlier_seq
+            self._next_seq += 1
+            self._write([{'seq': entry.seq, 'kind': kind, 'args': args}])
+            superseded = []
+            if earlier_seq is not None:
+                superseded.append(self.entries[earlier_seq])
+            if kind == 'relegate_node':
+                superseded.extend(
+                    self.entries[seq] for seq in 
+                    (self._pending_keys.get(('rate', args[0])),
+                     self._pending_keys.get(('edit', args[0])))
+                    if seq is not None)
+            if superseded:
+                self._set_state(superseded, 'superseded', by=entry.seq)
+                self.counters['superseded'] += len(superseded)
+                for old_entry in superseded:
+                    del self.entries[old_entry.seq]
+            self.entries[entry.seq] = entry
+            if key is not None:
+                self._pending_keys[key] = entry.seq
+            self._condition.notify_all()
+        return entry.seq
+
+    def add_node(self, title_to_add):
+        return self.enqueue('add_node', str(title_to_add))
+
+    def rate_node(self, node_to_rate, rating):
+        return self.enqueue('rate_node', node_to_rate, rating)
+
+    def edit_node(self, node_id, new_title):
+        return self.enqueue('edit_node', node_id, str(new_title))
+
+    def add_support_link(self, node_to_support, supporting_node_id):
+        return self.enqueue('add_support_link', node_to_support, 
+                            supporting_node_id)
+
+    def add_conclusion_link(self, node_to_link_conclusion_to, 
+                            conclusion_node_id):
+        return self.enqueue('add_conclusion_link', node_to_link_conclusion_to,
+                            conclusion_node_id)
+
+    def relegate_node(self, id_of_node):
+        return self.enqueue('relegate_node', id_of_node)
+
+    def _take_batch(self):
+        # Pending entries that can be sent now: none of their nodes has an
+        # earlier entry still pending or being sent.  They are marked taken;
+        # _send journals each as sending when its request goes out.
+        blocked = set()
+        for entry in self.entries.values():
+            if entry.state in ('taken', 'sending'):
+                blocked.update(entry.node_ids())
+        batch = []
+        for entry in self.entries.values():
+            if entry.state != 'pending':
+                continue
+            node_ids = set(entry.node_ids())
+            if not node_ids & blocked:
+                batch.append(entry)
+            blocked.update(node_ids)
+            if len(batch) >= 4 * self.max_workers:
+                break
+        self._mark(batch, 'taken')
+        return batch
+
+    def _send(self, entry):
+        # Returns (ok, result, error) for one operation.
+        server, s, xcsrf_token = self.server, self.session, self.xcsrf_token
+        with self._condition:
+            self._set_state([entry], 'sending')
+        try:
+            if entry.kind == 'add_node':
+                added = post_node(server, s, xcsrf_token, *entry.args)
+                return added.error is None, added.node_id, added.error
+            if entry.kind == 'rate_node':
+                rated = post_rating(server, s, xcsrf_token, *entry.args)
+                return rated.ok, None, rated.error
+            if entry.kind == 'relegate_node':
+                sent = relegate_node(server, s, xcsrf_token, entry.args[0],
+                                     'confirm')
+            else:
+                sent = globals()[entry.kind](server, s, xcsrf_token, 
+                                             *entry.args)
+        except requests.exceptions.RequestException as e:
+            return False, None, "{0}".format(e)
+        if sent == True:
+            return True, None, None
+        return False, None, "not accepted by the server"
+
+    def _send_batch(self, batch):
+        for entry, (ok, result, error) in zip(
+                batch, iter_bounded(self._send, batch, self.max_workers)):
+            with self._condition:
+                entry.result = result
+                entry.error = error
+                if ok:
+                    self._set_state([entry], 'done', result=result)
+                    self.counters['done'] += 1
+                else:
+                    self._set_state([entry], 'failed', error=error)
+                    self.counters['failed'] += 1
+                    self.failures.append(entry)
+                    logging.warning("Outbox {0} #{1} {2} failed: {3}".format(
+                        entry.kind, entry.seq, entry.args, error))
+                del self.entries[entry.seq]
+                self._condition.notify_all()
+
+    def _run(self):
+        idle = True
+        while True:
+            if idle:
+                # Work arriving after a quiet spell waits flush_interval, so
+                # operations that supersede it are coalesced first.
+                time.sleep(self.flush_interval)
+            with self._condition:
+                if self._stopping:
+                    return
+                batch = self._take_batch()
+                idle = not batch
+                if idle:
+                    self._condition.wait()
+                    continue
+            self._send_batch(batch)
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, 
+                                            name='oneslate-outbox',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def flush(self):
+        # Blocks until every queued operation has been sent.
+        if self._thread is not None:
+            with self._condition:
+                while self.entries:
+                    self._condition.wait()
+            return self.counts()
+        while True:
+            with self._condition:
+                batch = self._take_batch()
+            if not batch:
+                return self.counts()
+            self._send_batch(batch)
+
+    def stop(self, flush=True):
+        # Stops the flusher, by default after sending everything queued.
+        # Operations left pending stay in the journal for the next run.
+        if flush:
+            self.flush()
+        if self._thread is not None:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify_all()
+            self._thread.join()
+            self._thread = None
+        self._journal.close()
+        return self.counts()
+
+    def counts(self):
+        with self._condition:
+            return dict(self.counters, pending=len(self.entries))
+
+# Set by enable_outbox; run_command queues mutations here when it is set.
+outbox = None
+
+def enable_outbox(server, s, xcsrf_token, journal_path, max_workers=8):
+    global outbox
+    outbox = Outbox(server, s, xcsrf_token, journal_path, max_workers).start()
+    return outbox
+
+# Subcommands that --outbox queues, with the outbox operation and the
+# arguments it takes.
+OUTBOX_COMMANDS = OrderedDict([
+    ('add_node', ('add_node', ['<title>'])),
+    ('rate_node', ('rate_node', ['<node_id>', '<validity>'])),
+    ('edit_node', ('edit_node', ['<node_id>', '<new_title>'])),
+    ('link_support', ('add_support_link', ['<node_id>', '<support_node_id>'])),
+    ('link_conclusion', ('add_conclusion_link', 
+                         ['<node_id>', '<conclusion_node_id>'])),
+    ('relegate_node', ('relegate_node', ['<node_id>'])),
+])
+
+# Set by enable_session_pool; main and run_command_line run commands --as
+# its accounts when it is set.
+session_pool = None
+
+def enable_session_pool(server, accounts, cookies_input='cookies.txt', 
+                        cookies_output=None):
+    global session_pool
+    session_pool = SessionPool(server, accounts, cookies_input, 
+                               cookies_output)
+    return session_pool
+
+# Subcommands of the usage above, as run by run_command.
+COMMANDS = ('add_node', 'add_nodes', 'search_nodes', 'node_details', 
+            'node_stats', 'rate_node', 'rate_nodes', 'link_support', 
+            'link_conclusion', 'relegate_node', 'list_supports', 'crawl_tree',
+            'import_graph', 'edit_node', 'snapshot', 'sync', 'find_title')
+
+def run_command(args, server, active_session, security_token):
+    # Runs the subcommand selected in docopt args and returns a dict with the
+    # command name, whether it succeeded and what its function returned.
+    # With an outbox enabled, mutations are queued and the result is their
+    # outbox sequence number.
+    result = None
+    if args['add_node'] == True and args['--dedupe'] == True:
+        duplicate = find_duplicate_title(args['<title>'],
+                                         float(args['--similarity']))
+        if duplicate is not None:
+            logging.warning("Not adding node; {0!r} matches node {1} {2!r} "
+                            "with score {3}.".format(args['<title>'],
+                                                     *duplicate))
+            return {'command': 'add_node', 'ok': True,
+                    'result': {'duplicate_of': duplicate._asdict()}}
+    queued = next((name for name in OUTBOX_COMMANDS if args.get(name) == True),
+                  None)
+    if outbox is not None and queued is not None:
+        kind, arg_names = OUTBOX_COMMANDS[queued]
+        if queued == 'relegate_node' and args['<confirmation>'] != 'confirm':
+            logging.warning("Confirmation argument did not match required "
+                            "value.")
+        else:
+            result = outbox.enqueue(kind, *[args[name] for name in arg_names])
+            logging.info("Queued {kind} as #{result}.".format(**locals()))
+        return {'command': queued, 'ok': result is not None, 
+                'result': result}
     if args['add_node'] == True:
         title_to_add = args['<title>']
         added_result = add_node(server, active_session, security_token, 
@@ -487,17 +3618,56 @@ def main(args):
             logging.info("Done adding node.")
         else:
             logging.warning("Failed to add node.")
+        result = added_result
+
+    if args['add_nodes'] == True:
+        titles_path = args['<file>']
+        added_qty = 0
+        failed_qty = 0
+        titles = read_titles(titles_path)
+        duplicates = []
+        if args['--dedupe'] == True:
+            titles = iter_new_titles(titles, float(args['--similarity']),
+                                     duplicates)
+        for added in iter_add_nodes(server, active_session, security_token,
+                                    titles, int(args['--workers'])):
+            if added.error is None:
+                added_qty += 1
+                print('{0: <8}'.format(added.node_id) + 
+                      "| {0}".format(added.title))
+            else:
+                failed_qty += 1
+                logging.warning("Failed to add node {0!r}: {1}".format(
+                    added.title, added.error))
+        if failed_qty == 0:
+            logging.info("Done adding nodes.")
+        else:
+            logging.warning("Failed to add {failed_qty} nodes.".format(
+                **locals()))
+        for title, match in duplicates:
+            logging.info("Skipped duplicate {0!r}{1}.".format(
+                title, " of node {0}".format(match.node_id) if match else ""))
+        if duplicates:
+            logging.warning("Skipped {0} duplicate titles.".format(
+                len(duplicates)))
+        result = {'added': added_qty, 'failed': failed_qty,
+                  'duplicates': len(duplicates)}
 
     if args['search_nodes'] == True:
         search_term = args['<title>']
-        query_result = search_nodes(server, active_session, security_token, 
-                                    search_term)
+        output_file = open_output(args['--out'])
+        try:
+            query_result = search_nodes(server, active_session, 
+                                        security_token, search_term, 
+                                        args['--format'], output_file)
+        finally:
+            if output_file is not sys.stdout:
+                output_file.close()
         if query_result == True:
             logging.info("Succeeded in querying nodes.")
         else:
             logging.warning("Failed while querying nodes.")
-    if cookies_output is not None:
-        saved_cookies = save_session(active_session, cookies_output)
+        result = query_result
 
     if args['node_details'] == True:
         node_id_to_look_up = args['<node_id>']
@@ -507,6 +3677,7 @@ def main(args):
             logging.info("Done looking up node details.")
         else:
             logging.warning("Failed to look up node details.")
+        result = sought_details
 
     if args['rate_node'] == True:
         node_id_to_rate = args['<node_id>']
@@ -518,6 +3689,22 @@ def main(args):
             logging.info("Done rating node.")
         else:
             logging.warning("Failed to rate node.")
+        result = rated_node
+
+    if args['rate_nodes'] == True:
+        ratings_path = args['<file>']
+        result = rate_nodes(server, active_session, security_token,
+                             read_ratings(ratings_path), 
+                             int(args['--workers']), args['--log'])
+        failed = [rated for rated in result if not rated.ok]
+        if args['--log'] is None:
+            for rated in result:
+                print(json.dumps(rated._asdict()))
+        for rated in failed:
+            logging.warning("Failed to rate node {0} as {1}: {2}".format(
+                rated.node_id, rated.rating, rated.error))
+        if not failed:
+            logging.info("Done rating {0} nodes.".format(len(result)))
 
     if args['link_support'] == True:
         node_id_linked_to = args['<node_id>']
@@ -529,6 +3716,7 @@ def main(args):
             logging.info("Done linking support node.")
         else:
             logging.warning("Failed to link support node.")
+        result = linked_support
 
     if args['link_conclusion'] == True:
         node_id_linked_to = args['<node_id>']
@@ -540,6 +3728,7 @@ def main(args):
             logging.info("Done linking conclusion node.")
         else:
             logging.warning("Failed to link conclusion node.")
+        result = linked_support
 
     if args['relegate_node'] == True:
         node_to_relegate = args['<node_id>']
@@ -550,6 +3739,7 @@ def main(args):
             logging.info("Done relegating node.")
         else:
             logging.warning("Failed to relegate node.")
+        result = relegated
 
     if args['list_supports'] == True:
         root_id = args['<root_node_id>']
@@ -559,6 +3749,38 @@ def main(args):
             logging.info("Done listing supports.")
         else:
             logging.warning("Failed to list supports.")
+        result = got_tree
+
+    if args['crawl_tree'] == True:
+        root_id = args['<root_node_id>']
+        graph = crawl_tree(server, active_session, security_token, root_id,
+                           int(args['--depth']), int(args['--workers']))
+        write_graph(graph, args['--out'])
+        if not graph['errors']:
+            logging.info("Done crawling tree.")
+        else:
+            logging.warning("Failed to fetch trees for node_ids: {0}".format(
+                graph['errors']))
+        result = graph
+
+    if args['import_graph'] == True:
+        nodes, edges = read_graph(args['<file>'])
+        summary = import_graph(server, active_session, security_token, nodes,
+                               edges, int(args['--workers']), 
+                               args['--checkpoint'])
+        output_file = open_output(args['--out'])
+        try:
+            json.dump(summary, output_file, indent=2)
+            output_file.write("\n")
+        finally:
+            if output_file is not sys.stdout:
+                output_file.close()
+        if summary['failed_nodes'] or summary['failed_links']:
+            logging.warning("Failed to import {0} nodes and {1} links.".format(
+                len(summary['failed_nodes']), len(summary['failed_links'])))
+        else:
+            logging.info("Done importing graph.")
+        result = summary
 
     if args['edit_node'] == True:
         node_id = args['<node_id>']
@@ -569,6 +3791,7 @@ def main(args):
             logging.info("Done editing node.")
         else:
             logging.warning("Failed to edit_node.")
+        result = edited_node
 
     if args['node_stats'] == True:
         node_id = args['<node_id>']
@@ -578,9 +3801,365 @@ def main(args):
             logging.info("Done getting stats.")
         else:
             logging.warning("Failed to get stats.")
+        result = ran_stats
+
+    if args['snapshot'] == True and args['export'] == True:
+        header = export_snapshot(server, active_session, security_token,
+                                 args['<root_ids>'], args['<snapfile>'],
+                                 int(args['--depth']), int(args['--workers']),
+                                 args['--since'])
+        print("Wrote {node_count} nodes and {edge_count} edges, fetching "
+              "{fetched} nodes.".format(**header))
+        result = header
+
+    if args['snapshot'] == True and args['load'] == True:
+        started = time.time()
+        with load_snapshot(args['<snapfile>']) as snapshot:
+            summary = snapshot.rating_summary()
+            loaded_in = time.time() - started
+            print(
+                "snapshot:      {0}\n"
+                "created_at:    {1}\n"
+                "nodes:         {2}\n"
+                "edges:         {3}\n"
+                "ratings_count: {4}\n"
+                "mean_validity: {5}\n"
+                "loaded_in:     {6:.3f}s".format(
+                    args['<snapfile>'], 
+                    time.ctime(snapshot.header['created_at']),
+                    len(snapshot), snapshot.header['edge_count'],
+                    summary['ratings_count'], summary['mean_validity'],
+                    loaded_in))
+            result = dict(snapshot.header, loaded_in=loaded_in)
+            del result['columns']
+
+    if args['sync'] == True:
+        watcher = SyncWatcher(server, active_session, security_token,
+                              int(args['--depth']), float(args['--interval']),
+                              float(args['--max-interval']), 
+                              max_workers=int(args['--workers']))
+        output_file = open_output(args['--out'])
+        event_counts = {}
+        try:
+            for root_id in args['<root_ids>']:
+                for event in watcher.watch(root_id):
+                    write_sync_event(event, output_file)
+            duration = args['--duration']
+            for event in watcher.iter_events(
+                    float(duration) if duration else None):
+                event_counts[event.kind] = event_counts.get(event.kind, 0) + 1
+                write_sync_event(event, output_file)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if output_file is not sys.stdout:
+                output_file.close()
+        logging.info("Sync events: {0}".format(event_counts))
+        result = {'nodes': len(watcher.nodes), 'events': event_counts}
+
+    if args['find_title'] == True:
+        if title_index is None:
+            raise ValueError("find_title needs --title-index")
+        matches = title_index.find(args['<title>'],
+                                   float(args['--similarity']))
+        output_file = open_output(args['--out'])
+        try:
+            write_search_results(
+                (SearchResult(match.node_id, match.title, match._asdict())
+                 for match in matches),
+                args['--format'], output_file, args['<title>'])
+        finally:
+            if output_file is not sys.stdout:
+                output_file.close()
+        result = [match._asdict() for match in matches]
+
+    ok = result is not None and result is not False
+    if args['rate_nodes'] == True:
+        # result lists every rating; ok only when all were accepted
+        ok = not failed
+    command = next((name for name in COMMANDS if args.get(name) == True), None)
+    return {
+        'command': command,
+        'ok': ok,
+        'result': result,
+    }
+
+# Options naming files a command writes, given a name per account by
+# iter_account_outcomes so runs as different accounts do not share them.
+PER_ACCOUNT_OPTIONS = ('--out', '--log', '--checkpoint')
+
+def iter_account_outcomes(args, users, max_workers=8):
+    # Runs the subcommand selected in args once as each account of
+    # session_pool in users, up to max_workers accounts at once, and yields
+    # the run_command result of each, in order, with an 'account' key.
+    # Failures, logging in included, are reported in the result.
+    command = next((name for name in COMMANDS if args.get(name) == True), None)
+    def run(user):
+        account_args = dict(args)
+        for option in PER_ACCOUNT_OPTIONS:
+            if account_args.get(option) not in (None, '-'):
+                account_args[option] = account_file(account_args[option], 
+                                                    user)
+        try:
+            client = session_pool.client(user)
+            outcome = run_command(account_args, session_pool.server, 
+                                  client.session, client.xcsrf_token)
+        except Exception as e:
+            logging.warning("Command as {0} failed: {1}".format(user, e))
+            outcome = {'command': command, 'ok': False, 
+                       'error': "{0}".format(e)}
+        outcome['account'] = user
+        return outcome
+    return iter_bounded(run, users, max_workers)
+
+def parse_arguments(argv=None, help=True, version=None):
+    # docopt(__doc__, argv, help, version), with docopt imported on first
+    # use so importing this module stays cheap.
+    from docopt import docopt
+    return docopt(__doc__, argv=argv, help=help, version=version)
 
+def run_command_line(line, server, active_session, security_token):
+    # Parses one line such as 'rate_node 65 3' with the usage of this module
+    # and runs it.  Problems are reported in the returned dict rather than
+    # raised, so one bad line does not end a batch.
+    command = None
+    try:
+        argv = shlex.split(line)
+        command = next((word for word in argv if word in COMMANDS), None)
+        line_args = parse_arguments(argv, help=False)
+        if line_args['shell'] or line_args['--batch']:
+            raise ValueError("shell and --batch cannot be nested")
+        if line_args['--as']:
+            if session_pool is None:
+                raise ValueError("--as needs --accounts")
+            if outbox is not None:
+                raise ValueError("--as cannot be combined with --outbox")
+            outcomes = list(iter_account_outcomes(
+                line_args, session_pool.select(line_args['--as']),
+                int(line_args['--workers'])))
+            return {'command': command, 
+                    'ok': all(outcome['ok'] for outcome in outcomes),
+                    'accounts': outcomes}
+        return run_command(line_args, server, active_session, security_token)
+    except SystemExit:  # DocoptExit included
+        error = "could not parse line"
+    except Exception as e:
+        logging.warning("Command failed: {0}".format(e))
+        error = "{0}".format(e)
+    return {'command': command, 'ok': False, 'error': error}
+
+def run_batch(lines, server, active_session, security_token, output_file,
+              interactive=False):
+    # Runs one command per line over the same session and writes a JSON line
+    # per command to output_file.  Blank lines and lines starting with # are
+    # skipped.  Anything the commands print goes to stderr so output_file
+    # only carries results, except at an interactive prompt.
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line in ('exit', 'quit'):
+            break
+        if not interactive:
+            with contextlib.redirect_stdout(sys.stderr):
+                outcome = run_command_line(line, server, active_session,
+                                           security_token)
+        else:
+            outcome = run_command_line(line, server, active_session,
+                                       security_token)
+        outcome['line'] = line_number
+        output_file.write(json.dumps(outcome, default=str) + "\n")
+        output_file.flush()
+    return None
+
+def read_shell_lines(prompt):
+    while True:
+        try:
+            yield input(prompt)
+        except EOFError:
+            print()
+            return
+
+class PhaseTimer(object):
+    # Wall-clock seconds spent in the consecutive phases of a run.  Each
+    # end(phase) closes the phase begun by the previous call, or at started.
+
+    def __init__(self, started=None):
+        self.phases = OrderedDict()
+        self._last = time.perf_counter() if started is None else started
+
+    def end(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+        return self.phases[phase]
+
+    def format_summary(self):
+        parts = ['{0} {1:.1f} ms'.format(phase, seconds * 1000) 
+                 for phase, seconds in self.phases.items()]
+        parts.append('total {0:.1f} ms'.format(
+            sum(self.phases.values()) * 1000))
+        return 'Timings: ' + ', '.join(parts)
+
+def main(args, phase_timer=None):
+    if phase_timer is None:
+        phase_timer = PhaseTimer()
+    logging.basicConfig()
+    if args['--verbose'] == True:
+        logging.getLogger().setLevel(logging.INFO)
+    elif args['--quiet'] == True:
+        logging.getLogger().setLevel(logging.ERROR)
+    elif args['--debug'] == True:
+        logging.getLogger().setLevel(logging.DEBUG)
+    else: 
+        logging.getLogger().setLevel(logging.WARNING)
+    logging.debug("Got args:\n{args}".format(**locals()))
+    cookies_input = args['--input']
+    cookies_output = args['--output']
+    if args['--user']:
+        user = args['--user']
+    else:
+        user = None
+    if args['--server']:
+        server = args['--server']
+    if args['--pass']:
+        password = args['--pass']
+    else:
+        password = None
+    if args['--config']:
+        config_path = args['--config']
+        try:
+            with open(config_path, 'r') as config_file:
+                config = config_file.read().splitlines()
+        except:
+            logging.warning("Problem reading config file! Exiting.")
+        if len(config) == 3:
+            logging.debug("config = {config}".format(**locals()))
+            server = config[0]
+            user = config[1]
+            password = config[2]
+        else:
+            logging.warning("Config file was not 3 lines! Exiting.")
+            return None
+    else:
+        config = None
+    logging.debug("Got user={user} and password={password}".format(**locals()))
+    configure_requests(connect_timeout=float(args['--connect-timeout']),
+                       read_timeout=float(args['--timeout']),
+                       max_retries=int(args['--retries']))
+    metrics_file = None
+    if args['--metrics-export']:
+        metrics_target = parse_metrics_target(args['--metrics-export'])
+        if isinstance(metrics_target, StatsDExporter):
+            request_metrics.add_hook(metrics_target)
+        else:
+            metrics_file = metrics_target
+    configure_transport(pool_size=int(args['--pool-size']), 
+                        keep_alive=int(args['--keep-alive']),
+                        http2=args['--http2'])
+    if args['--rate-limit'] or args['--max-in-flight']:
+        configure_rate_limits(parse_limits(args['--rate-limit']),
+                              parse_limits(args['--max-in-flight']),
+                              args['--limit-file'])
+    if args['--cache']:
+        enable_cache(ttl=float(args['--cache-ttl']), db_path=args['--cache'])
+    if args['find_title'] == True and not args['--title-index']:
+        logging.warning("find_title needs --title-index. Exiting.")
+        return None
+    if args['--title-index'] or args['--dedupe'] == True:
+        # without a file --dedupe still catches repeats within this run
+        enable_title_index(args['--title-index'])
+    if (args['snapshot'] == True and args['load'] == True) or \
+            args['find_title'] == True:
+        # Loading a snapshot and finding titles are offline; no session is
+        # needed.
+        phase_timer.end('session')
+        try:
+            run_command(args, server, None, None)
+        finally:
+            if title_index is not None:
+                title_index.close()
+        phase_timer.end('command')
+        if args['--timings'] == True:
+            sys.stderr.write(phase_timer.format_summary() + '\n')
+        return None
+    account_users = None
+    if args['--accounts']:
+        try:
+            enable_session_pool(server, read_accounts(args['--accounts']),
+                                cookies_input, cookies_output)
+            account_users = session_pool.select(args['--as'] or 
+                                                session_pool.users[:1])
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("{0}. Exiting.".format(e))
+            return None
+        if not account_users:
+            logging.warning("No accounts in accounts file! Exiting.")
+            return None
+        if len(account_users) > 1 and args['--outbox']:
+            logging.warning("--outbox sends as one account; choose one with "
+                            "--as. Exiting.")
+            return None
+        # shell and --batch lines without --as run as the first account
+        client = session_pool.client(account_users[0])
+        active_session, security_token = client.session, client.xcsrf_token
+    elif args['--as']:
+        logging.warning("--as needs --accounts. Exiting.")
+        return None
+    else:
+        active_session, security_token = get_session(server, cookies_input, 
+                                                     user, password)
+    if args['--outbox']:
+        enable_outbox(server, active_session, security_token, 
+                      args['--outbox'], int(args['--workers']))
+    phase_timer.end('session')
+    if args['shell'] == True:
+        run_batch(read_shell_lines('oneslate> '), server, active_session, 
+                  security_token, sys.stdout, interactive=True)
+    elif args['--batch']:
+        with contextlib.closing(open_input(args['--batch'])) as batch_file:
+            run_batch(batch_file, server, active_session, security_token, 
+                      sys.stdout)
+    elif account_users is not None and len(account_users) > 1:
+        # as in --batch, the commands' own output goes to stderr
+        output_file = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            for outcome in iter_account_outcomes(args, account_users, 
+                                                 int(args['--workers'])):
+                output_file.write(json.dumps(outcome, default=str) + "\n")
+                output_file.flush()
+    else:
+        run_command(args, server, active_session, security_token)
+    phase_timer.end('command')
+
+    if outbox is not None:
+        logging.info("Outbox counters: {0}".format(outbox.stop(flush=True)))
+    # Saved last so a token renewed by a command is what the next run reuses.
+    if session_pool is not None:
+        session_pool.save()
+    elif cookies_output is not None:
+        saved_cookies = save_session(active_session, cookies_output)
+    if node_cache is not None:
+        logging.info("Cache counters: {0}".format(node_cache.stats()))
+    if title_index is not None:
+        logging.info("Indexed titles: {0}".format(len(title_index)))
+        title_index.close()
+    logging.info("Request counters: {0}".format(request_policy.stats()))
+    if args['--metrics'] == True:
+        sys.stderr.write(request_metrics.format_summary() + '\n')
+    if metrics_file is not None:
+        request_metrics.write_prometheus(metrics_file)
+    phase_timer.end('finish')
+    if args['--timings'] == True:
+        sys.stderr.write(phase_timer.format_summary() + '\n')
     return None
 
 if __name__ == "__main__":
-    arguments = docopt(__doc__, version='v1.0.2-dev')
-    main(arguments)
+    # oneslate_http and other lazily imported modules import this one by
+    # name; let them find it rather than load a second copy.
+    sys.modules.setdefault('oneslate', sys.modules[__name__])
+    phase_timer = PhaseTimer(IMPORT_STARTED)
+    phase_timer.end('import')
+    arguments = parse_arguments(version='v1.0.2-dev')
+    phase_timer.end('arguments')
+    main(arguments, phase_timer)
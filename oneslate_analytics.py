@@ -0,0 +1,280 @@
+"""
+Vectorized rating analytics over many nodes.
+
+Requires NumPy.  Node ratings are loaded once into a NodeArrays table, from a
+snapshot file, from oneslate.argument_graph or from node detail dicts, and
+every computation below works on whole columns at once:
+
+    import oneslate
+    import oneslate_analytics as oa
+
+    with oneslate.load_snapshot('tuesday.snap') as snapshot:
+        arrays = oa.load_snapshot_arrays(snapshot)
+    means = oa.weighted_means(arrays)
+    buckets, trend, counts = oa.rating_trends(arrays, bucket_seconds=86400)
+    confidence = oa.support_rollup(arrays)
+    confidence[arrays.index_of([65])]
+
+Validity bins are 0 - 4 as in rating_counts.  Missing values are NaN.
+"""
+
+import datetime
+import logging
+
+import numpy
+
+import oneslate
+
+
+class NodeArrays(object):
+    # Column table of node_ids (sorted, int64), rating_counts (n x 5 int64),
+    # the flattened time series as (series_index, series_time,
+    # series_rating) with series_index pointing into node_ids, and the
+    # support edges as (conclusion_index, support_index) pairs of positions.
+
+    def __init__(self, node_ids, rating_counts, series_index=None,
+                 series_time=None, series_rating=None, conclusion_index=None,
+                 support_index=None):
+        self.node_ids = numpy.asarray(node_ids, dtype=numpy.int64)
+        self.rating_counts = numpy.asarray(
+            rating_counts, dtype=numpy.int64).reshape(-1, 5)
+        self.series_index = _int_array(series_index)
+        self.series_time = _float_array(series_time)
+        self.series_rating = _float_array(series_rating)
+        self.conclusion_index = _int_array(conclusion_index)
+        self.support_index = _int_array(support_index)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def index_of(self, node_ids):
+        # Positions of node_ids in the table, -1 for ids not in it.
+        node_ids = numpy.asarray(node_ids, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.node_ids, node_ids)
+        positions = numpy.minimum(positions, max(len(self.node_ids) - 1, 0))
+        found = len(self.node_ids) > 0
+        if found:
+            found = self.node_ids[positions] == node_ids
+        return numpy.where(found, positions, -1)
+
+def _int_array(values):
+    return numpy.asarray(values if values is not None else [],
+                         dtype=numpy.int64)
+
+def _float_array(values):
+    return numpy.asarray(values if values is not None else [],
+                         dtype=numpy.float64)
+
+def parse_time(value):
+    # Seconds since the epoch from a number or an ISO 8601 string, or None.
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value).replace('Z',
+                                                                    '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+def parse_time_series(ratings_time_series):
+    # Returns [(time, rating), ...] from a ratings_time_series value, given
+    # either as [time, rating] pairs or as dicts with a time and a rating key.
+    points = []
+    for point in ratings_time_series or []:
+        if isinstance(point, dict):
+            time_value = next((point[key] for key in
+                               ('time', 'created_at', 'date', 'x')
+                               if key in point), None)
+            rating = next((point[key] for key in ('rating', 'value', 'y')
+                           if key in point), None)
+        elif isinstance(point, (list, tuple)) and len(point) == 2:
+            time_value, rating = point
+        else:
+            continue
+        time_value = parse_time(time_value)
+        if time_value is None or rating is None:
+            continue
+        points.append((time_value, float(rating)))
+    return points
+
+def _edge_positions(node_ids, edges):
+    # (conclusion_index, support_index) for the edges whose both ends are in
+    # node_ids.
+    if not isinstance(edges, numpy.ndarray):
+        edges = list(edges)
+    edges = numpy.asarray(edges, dtype=numpy.int64).reshape(-1, 2)
+    if not len(node_ids) or not len(edges):
+        return _int_array(None), _int_array(None)
+    positions = numpy.searchsorted(node_ids, edges)
+    positions = numpy.minimum(positions, len(node_ids) - 1)
+    keep = (node_ids[positions] == edges).all(axis=1)
+    return positions[keep, 0], positions[keep, 1]
+
+def load_node_arrays(nodes, edges=()):
+    # nodes is an iterable of node dicts as returned by
+    # oneslate.fetch_node_details or Snapshot.iter_nodes; edges holds
+    # (conclusion_id, support_id) pairs.
+    by_id = {}
+    for node in nodes:
+        node_id = oneslate.normalize_node_id(node.get('id'))
+        if node_id is not None:
+            by_id[node_id] = node
+    node_ids = numpy.array(sorted(by_id), dtype=numpy.int64)
+    rating_counts = numpy.zeros((len(node_ids), 5), dtype=numpy.int64)
+    series_index, series_time, series_rating = [], [], []
+    for position, node_id in enumerate(node_ids.tolist()):
+        node = by_id[node_id]
+        counts = oneslate.normalize_rating_counts(node.get('rating_counts'))
+        if counts is not None:
+            rating_counts[position] = counts
+        for time_value, rating in parse_time_series(
+                node.get('ratings_time_series')):
+            series_index.append(position)
+            series_time.append(time_value)
+            series_rating.append(rating)
+    conclusion_index, support_index = _edge_positions(node_ids, edges)
+    logging.info("Loaded {0} nodes, {1} ratings and {2} edges.".format(
+        len(node_ids), len(series_time), len(conclusion_index)))
+    return NodeArrays(node_ids, rating_counts, series_index, series_time,
+                      series_rating, conclusion_index, support_index)
+
+def load_snapshot_arrays(snapshot, time_series=True):
+    # Builds NodeArrays from an oneslate.Snapshot.  The id, rating count and
+    # edge columns are copied straight out of the file; only the time series
+    # are decoded node by node, and can be skipped with time_series=False.
+    node_ids = numpy.array(snapshot.column('id'), dtype=numpy.int64)
+    rating_counts = numpy.array(snapshot.column('rating_counts'),
+                                dtype=numpy.int64).reshape(-1, 5)
+    rating_counts[rating_counts < 0] = 0
+    series_index, series_time, series_rating = [], [], []
+    if time_series:
+        for position in range(len(snapshot)):
+            series = snapshot.node_at(position)['ratings_time_series']
+            for time_value, rating in parse_time_series(series):
+                series_index.append(position)
+                series_time.append(time_value)
+                series_rating.append(rating)
+    edges = numpy.stack([
+        numpy.array(snapshot.column('edge_conclusion'), dtype=numpy.int64),
+        numpy.array(snapshot.column('edge_support'), dtype=numpy.int64)],
+        axis=1)
+    conclusion_index, support_index = _edge_positions(node_ids, edges)
+    return NodeArrays(node_ids, rating_counts, series_index, series_time,
+                      series_rating, conclusion_index, support_index)
+
+def load_graph_arrays(graph=None, time_series=None):
+    # Builds NodeArrays from an ArgumentGraph (by default
+    # oneslate.argument_graph).  The graph keeps no time series, so they may
+    # be passed separately as {node_id: ratings_time_series}.
+    if graph is None:
+        graph = oneslate.argument_graph
+    time_series = time_series or {}
+    nodes = [{'id': record.id, 'rating_counts': record.rating_counts,
+              'ratings_time_series': time_series.get(record.id)}
+             for record in list(graph.nodes.values())]
+    edges = [(conclusion_id, support_id)
+             for conclusion_id in list(graph.nodes)
+             for support_id in graph.supports(conclusion_id)]
+    return load_node_arrays(nodes, edges)
+
+VALIDITY = numpy.arange(5, dtype=numpy.float64)
+
+def weighted_means(arrays):
+    # Mean validity of every node from its rating_counts, NaN if unrated.
+    totals = arrays.rating_counts.sum(axis=1)
+    sums = arrays.rating_counts @ VALIDITY
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(totals > 0, sums / totals, numpy.nan)
+
+def rating_trends(arrays, bucket_seconds=86400, start=None, end=None,
+                  cumulative=False):
+    # Buckets every node's time series into bucket_seconds wide intervals.
+    # Returns (bucket_starts, means, counts) where means and counts are
+    # (nodes x buckets) arrays of the mean rating and number of ratings in
+    # each bucket.  With cumulative=True each bucket covers every rating up
+    # to its end instead, giving the running mean.
+    times = arrays.series_time
+    if start is None:
+        start = times.min() if len(times) else 0.0
+    if end is None:
+        end = times.max() if len(times) else start
+    start = numpy.floor(start / bucket_seconds) * bucket_seconds
+    bucket_count = int((end - start) // bucket_seconds) + 1
+    bucket_starts = start + bucket_seconds * numpy.arange(bucket_count)
+    buckets = ((times - start) // bucket_seconds).astype(numpy.int64)
+    keep = (buckets >= 0) & (buckets < bucket_count)
+    cells = arrays.series_index[keep] * bucket_count + buckets[keep]
+    size = len(arrays) * bucket_count
+    counts = numpy.bincount(cells, minlength=size).reshape(-1, bucket_count)
+    sums = numpy.bincount(cells, weights=arrays.series_rating[keep],
+                          minlength=size).reshape(-1, bucket_count)
+    if cumulative:
+        counts = counts.cumsum(axis=1)
+        sums = sums.cumsum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = numpy.where(counts > 0, sums / counts, numpy.nan)
+    return bucket_starts, means, counts
+
+def rating_slopes(arrays, time_unit=86400):
+    # Least-squares slope of rating against time for every node, in validity
+    # points per time_unit seconds.  NaN for nodes with fewer than two
+    # ratings at distinct times.
+    size = len(arrays)
+    index = arrays.series_index
+    times = arrays.series_time / time_unit
+    ratings = arrays.series_rating
+    count = numpy.bincount(index, minlength=size).astype(numpy.float64)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_time = numpy.bincount(index, times, size) / count
+        mean_rating = numpy.bincount(index, ratings, size) / count
+        centered = times - mean_time[index]
+        covariance = numpy.bincount(
+            index, centered * (ratings - mean_rating[index]), size)
+        variance = numpy.bincount(index, centered * centered, size)
+        return numpy.where(variance > 0, covariance / variance, numpy.nan)
+
+def support_rollup(arrays, scores=None, weights=None, tolerance=1e-9,
+                   max_iterations=1000):
+    # Rolls scores up the support tree: a node's rolled-up confidence is the
+    # weighted mean of its own score and the rolled-up confidence of each
+    # node supporting it.  scores defaults to weighted_means and weights to
+    # each node's number of ratings, so well-rated supports count for more
+    # and unrated nodes only pass on what their supports say.  Every
+    # iteration propagates one level over all edges at once; on an acyclic
+    # graph the result is exact after as many iterations as the tree is
+    # deep, and on cyclic graphs iteration stops once changes fall under
+    # tolerance.  Nodes with neither a score nor scored supports get NaN.
+    if scores is None:
+        scores = weighted_means(arrays)
+    if weights is None:
+        weights = arrays.rating_counts.sum(axis=1)
+    scores = numpy.asarray(scores, dtype=numpy.float64)
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    own_weight = numpy.where(numpy.isnan(scores), 0.0, weights)
+    own_sum = own_weight * numpy.nan_to_num(scores)
+    conclusions = arrays.conclusion_index
+    supports = arrays.support_index
+    size = len(arrays)
+    rolled = numpy.where(own_weight > 0, scores, numpy.nan)
+    # a support carries at least weight one once it has any rolled-up value
+    support_weight = numpy.maximum(weights, 1.0)
+    for iteration in range(max_iterations):
+        known = ~numpy.isnan(rolled)
+        edge_weight = numpy.where(known[supports],
+                                  support_weight[supports], 0.0)
+        edge_sum = edge_weight * numpy.nan_to_num(rolled[supports])
+        total_weight = own_weight + numpy.bincount(conclusions, edge_weight,
+                                                   size)
+        total_sum = own_sum + numpy.bincount(conclusions, edge_sum, size)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            updated = numpy.where(total_weight > 0, total_sum / total_weight,
+                                  numpy.nan)
+        if numpy.allclose(updated, rolled, rtol=0, atol=tolerance,
+                          equal_nan=True):
+            return updated
+        rolled = updated
+    logging.warning("Support roll-up did not settle after {max_iterations} "
+                    "iterations.".format(**locals()))
+    return rolled
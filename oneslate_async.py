@@ -0,0 +1,336 @@
+"""
+Asyncio counterpart of the oneslate.py operations.
+
+Requires aiohttp.  Session state comes from oneslate.get_session, so logging
+in still happens once through the synchronous client:
+
+    import asyncio
+    import oneslate
+    from oneslate_async import AsyncOneslateClient
+
+    async def rate_all(server, session, token, node_ids):
+        async with AsyncOneslateClient.from_session(server, session, token,
+                                                    max_concurrency=32) as c:
+            return await asyncio.gather(*(c.rate_node(n, 3) for n in node_ids))
+
+    session, token = oneslate.get_session(server, 'cookies.txt', usr, pwd)
+    asyncio.run(rate_all(server, session, token, [65, 66, 67]))
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import ssl
+import time
+
+import aiohttp
+
+import oneslate
+
+# Timeouts before a connection was made, so the server never saw the
+# request.  aiohttp before 3.10 does not tell them apart from read timeouts.
+CONNECT_TIMEOUT_ERRORS = getattr(aiohttp, 'ConnectionTimeoutError', ())
+
+# What _request keeps of a response once its body has been read: enough
+# for oneslate.request_policy.backoff to honor Retry-After.
+Answer = collections.namedtuple('Answer', ['status_code', 'headers', 'body'])
+
+@contextlib.asynccontextmanager
+async def limited(limiter, endpoint_class):
+    # oneslate.rate_limiter.slot for coroutines.  Waiting for the slot and
+    # the rate happens in an executor thread so the event loop keeps
+    # running; releasing never blocks and is done in place.
+    if limiter is None:
+        yield
+        return
+    slot = limiter.slot(endpoint_class)
+    acquired = asyncio.get_running_loop().run_in_executor(None, 
+                                                          slot.__enter__)
+    try:
+        await asyncio.shield(acquired)
+    except asyncio.CancelledError:
+        # the thread still gets the slot; give it back when it does
+        acquired.add_done_callback(
+            lambda done: done.exception() is None and 
+            slot.__exit__(None, None, None))
+        raise
+    try:
+        yield
+    finally:
+        slot.__exit__(None, None, None)
+
+
+class AsyncOneslateClient(object):
+    # One pooled aiohttp connection set per client; max_concurrency bounds
+    # both the connector and the number of requests awaiting a response.
+    # Idle connections are kept for oneslate.transport.keep_alive seconds.
+    # Requests follow the same oneslate.request_policy, rate_limiter and
+    # request_metrics as oneslate.send_request; timeout, when given, caps
+    # the total seconds of one attempt.
+
+    def __init__(self, server, xcsrf_token, cookies=None, max_concurrency=16,
+                 timeout=None, verify=None):
+        self.server = server
+        self.xcsrf_token = xcsrf_token
+        self.cookies = dict(cookies or {})
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = timeout
+        if verify is None:
+            verify = oneslate.cert_in_use
+        self.verify = verify
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = None
+
+    @classmethod
+    def from_session(cls, server, s, xcsrf_token, **kwargs):
+        # Accepts the (session, token) pair returned by oneslate.get_session.
+        cookies = {cookie.name: cookie.value for cookie in s.cookies}
+        return cls(server, xcsrf_token, cookies=cookies, **kwargs)
+
+    @classmethod
+    def from_client(cls, client, **kwargs):
+        # Shares the login and TLS setting of an oneslate.OneslateClient.
+        kwargs.setdefault('verify', client.verify)
+        return cls.from_session(client.server, client.session, 
+                                client.xcsrf_token, **kwargs)
+
+    def _ssl_setting(self):
+        if self.verify is False:
+            return False
+        if isinstance(self.verify, str):
+            return ssl.create_default_context(cafile=self.verify)
+        return None  # aiohttp default verification
+
+    async def open(self):
+        if self._session is None:
+            keepalive_timeout = oneslate.transport.keep_alive or 15
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency, ssl=self._ssl_setting(),
+                keepalive_timeout=keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                cookies=self.cookies,
+                headers={"X-CSRF-Token": self.xcsrf_token})
+        return self
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _request(self, method, url, idempotent=None, **kwargs):
+        # Returns (status code, decoded JSON body or None).  The async
+        # counterpart of oneslate.send_request: retries with backoff and
+        # Retry-After, adaptive read timeouts, rate limits and metrics.
+        await self.open()
+        policy = oneslate.request_policy
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in policy.IDEMPOTENT_METHODS
+        if 'json' in kwargs:
+            # encoded once, so every attempt sends and counts the same bytes
+            kwargs['data'] = json.dumps(kwargs.pop('json')).encode('utf-8')
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{
+                'Content-Type': 'application/json'})
+        sent = kwargs.get('data')
+        bytes_sent = oneslate.body_size(sent) if isinstance(
+            sent, (bytes, str)) else 0
+        limiter = oneslate.rate_limiter
+        endpoint_class = oneslate.classify_request(method, url)
+        metrics = oneslate.request_metrics
+        endpoint = oneslate.endpoint_name(method, url)
+        attempt = 0
+        while True:
+            answer = None
+            started = None
+            connect_timeout, read_timeout = policy.timeout()
+            timeout = aiohttp.ClientTimeout(total=self.timeout,
+                                            connect=connect_timeout,
+                                            sock_read=read_timeout)
+            try:
+                async with self._semaphore, limited(limiter, endpoint_class):
+                    started = time.time()
+                    policy.record('requests')
+                    async with self._session.request(
+                            method, url, timeout=timeout, **kwargs) as response:
+                        answer = Answer(response.status, response.headers,
+                                        await response.read())
+            except CONNECT_TIMEOUT_ERRORS as e:
+                policy.record('timeouts')
+                retryable = True  # never reached the server
+                error = e
+            except asyncio.TimeoutError as e:
+                policy.record('timeouts', latency=read_timeout)
+                retryable = idempotent
+                error = e
+            except aiohttp.ClientConnectionError as e:
+                policy.record('connection_errors')
+                retryable = idempotent
+                error = e
+            else:
+                policy.record(latency=time.time() - started)
+                retryable = (answer.status_code in policy.RETRY_STATUS_CODES
+                             and (idempotent or answer.status_code == 429))
+                error = None
+            if started is not None:
+                metrics.record(oneslate.RequestEvent(
+                    endpoint, method, url, 
+                    answer and answer.status_code, time.time() - started,
+                    bytes_sent if answer else 0, 
+                    len(answer.body) if answer else 0, attempt, 
+                    None if answer else error))
+            if not retryable or attempt >= policy.max_retries:
+                if error is not None:
+                    raise error
+                break
+            delay = policy.backoff(attempt, answer)
+            if limiter is not None and answer is not None and \
+                    answer.status_code == 429:
+                limiter.pause(endpoint_class, delay)
+            logging.info("Retrying {method} {url} in {delay:.2f} "
+                         "seconds.".format(**locals()))
+            policy.record('retries')
+            await asyncio.sleep(delay)
+            attempt += 1
+        logging.debug(answer.body)
+        logging.info("status code returned = " + str(answer.status_code))
+        try:
+            results_data = oneslate.decode_json(answer.body) \
+                if answer.body else None
+        except ValueError:
+            results_data = None
+        return answer.status_code, results_data
+
+    def _node_json_url(self, node_id):
+        node_url = oneslate.get_node_url(self.server)
+        return node_url + "/{node_id}.json".format(**locals())
+
+    async def add_node(self, title_to_add):
+        title_text = str(title_to_add)
+        if len(title_text) <= 0:
+            logging.warning("Title too short. Not trying to add node.")
+            return False
+        status, results_data = await self._request(
+            'POST', oneslate.get_node_url(self.server),
+            json=oneslate.get_node_data(title_text))
+        if status == 201:  # HTTP 201 Created
+            return True
+        else:
+            return None
+
+    async def search_nodes(self, search_string):
+        query_params = {
+            "term": search_string,
+            "filter": "title"
+        }
+        status, results_data = await self._request(
+            'GET', oneslate.get_node_url(self.server), data=query_params)
+        if status == 200:  # HTTP 200 OK
+            return results_data
+        else:
+            return None
+
+    async def get_node_details(self, node_id):
+        status, results_data = await self._request(
+            'GET', self._node_json_url(node_id), params={"view": "detail"})
+        if status == 200:  # HTTP 200 OK
+            return results_data
+        else:
+            return None
+
+    async def get_node_stats(self, node_id):
+        status, results_data = await self._request(
+            'GET', self._node_json_url(node_id), params={"view": "stats"})
+        if status != 200:  # HTTP 200 OK
+            return None
+        return (results_data['children_count'], results_data['parents_count'],
+                results_data['flags_count'])
+
+    async def rate_node(self, node_to_rate, rating):
+        rating_data = {
+            "rating": int(rating),
+            "timeseries": False
+        }
+        node_url = oneslate.get_node_url(self.server)
+        rate_node_url = node_url + "/{node_to_rate}/ratings.json".format(
+            **locals())
+        status, results_data = await self._request('POST', rate_node_url,
+                                                   json=rating_data)
+        if status == 201:  # HTTP 201 Created
+            return True
+        else:
+            return None
+
+    async def add_support_link(self, node_to_support, supporting_node_id):
+        support_link_data = {
+            "sources": [],
+            "child_id": supporting_node_id
+        }
+        status, results_data = await self._request(
+            'PATCH', self._node_json_url(node_to_support),
+            json=support_link_data)
+        if status == 202:  # HTTP 202 Accepted
+            return True
+        else:
+            return None
+
+    async def add_conclusion_link(self, node_to_link_conclusion_to,
+                                  conclusion_node_id):
+        conclusion_link_data = {
+            "sources": [],
+            "parent_id": conclusion_node_id
+        }
+        status, results_data = await self._request(
+            'PATCH', self._node_json_url(node_to_link_conclusion_to),
+            json=conclusion_link_data)
+        if status == 202:  # HTTP 202 Accepted
+            return True
+        else:
+            return None
+
+    async def relegate_node(self, id_of_node, relegate_confirmation):
+        if "{relegate_confirmation}".format(**locals()) != "confirm":
+            logging.warning("Confirmation argument did not match required "
+                            "value.")
+            return None
+        status, results_data = await self._request(
+            'DELETE', self._node_json_url(id_of_node))
+        if status == 204:  # HTTP 204 No Content
+            return True
+        else:
+            return None
+
+    async def list_supports(self, id_of_root_node):
+        # Returns [(support_id, support_title), ...] for the root node.
+        tree_url = oneslate.get_tree_url(self.server)
+        list_supports_url = tree_url + "/{id_of_root_node}.json".format(
+            **locals())
+        status, supports_list_data = await self._request('GET',
+                                                         list_supports_url)
+        if status != 200:  # HTTP 200 OK
+            return None
+        titles = {x['id']: x['title'] for x in supports_list_data['nodes']}
+        return [(support['id'], titles.get(support['id']))
+                for support in supports_list_data['mapping'].get('children', [])]
+
+    async def edit_node(self, node_id, new_title):
+        edit_node_data = {
+            "title": str(new_title),
+        }
+        # Setting a title twice leaves the same result, so it is safe to
+        # retry.
+        status, results_data = await self._request(
+            'PATCH', self._node_json_url(node_id), idempotent=True,
+            json=edit_node_data)
+        if status == 202:  # HTTP 202 Accepted
+            return True
+        else:
+            return None
@@ -0,0 +1,221 @@
+"""
+requests based session and adapters used by oneslate.py.
+
+Kept apart so importing oneslate does not import requests; oneslate loads this
+module the first time it builds a session.  The classes are also reachable as
+oneslate.OneslateSession, oneslate.KeepAliveAdapter and oneslate.HTTP2Adapter.
+"""
+
+import email.message
+import io
+import logging
+import ssl
+import threading
+import time
+import types
+
+import requests
+
+import oneslate
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    # HTTPAdapter whose pooled connections are opened with socket_options.
+
+    def __init__(self, socket_options=None, **kwargs):
+        # set first: HTTPAdapter.__init__ builds the pool manager
+        self.socket_options = socket_options
+        super(KeepAliveAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        return super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+    # Sends requests through httpx so calls to an HTTPS server share one
+    # multiplexed HTTP/2 connection.  Requires httpx with its http2 extra
+    # (pip install 'httpx[http2]').  Responses and errors are converted to
+    # their requests equivalents, so sessions and callers see no difference.
+
+    HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 
+                                    'transfer-encoding', 'upgrade'])
+
+    def __init__(self, pool_size=10, keep_alive=60):
+        super(HTTP2Adapter, self).__init__()
+        import httpx
+        self._httpx = httpx
+        self._pool_maxsize = pool_size
+        self._limits = httpx.Limits(max_connections=pool_size,
+                                    max_keepalive_connections=pool_size,
+                                    keepalive_expiry=keep_alive or None)
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, verify, cert):
+        key = (verify, cert)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                if isinstance(verify, str):
+                    verify = ssl.create_default_context(cafile=verify)
+                client = self._httpx.Client(http2=True, verify=verify, 
+                                            cert=cert, limits=self._limits,
+                                            trust_env=False)
+                self._clients[key] = client
+        return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, 
+             cert=None, proxies=None):
+        httpx = self._httpx
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+        else:
+            connect_timeout = read_timeout = timeout
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in self.HOP_BY_HOP_HEADERS]
+        client = self._client(verify, cert)
+        try:
+            reply = client.request(
+                request.method, request.url, headers=headers, 
+                content=request.body,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        # requests sends the session's cookies itself
+        client.cookies.clear()
+        return self.build_response(request, reply)
+
+    def build_response(self, request, reply):
+        response = requests.models.Response()
+        response.status_code = reply.status_code
+        response.reason = reply.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict()
+        set_cookies = email.message.Message()
+        for name, value in reply.headers.multi_items():
+            if name.lower() == 'set-cookie':
+                set_cookies['Set-Cookie'] = value
+            if name in response.headers:
+                value = response.headers[name] + ', ' + value
+            response.headers[name] = value
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = reply.content
+        # requests reads Set-Cookie headers from raw._original_response.msg
+        response.raw = io.BytesIO(reply.content)
+        response.raw._original_response = types.SimpleNamespace(
+            msg=set_cookies)
+        requests.cookies.extract_cookies_to_jar(response.cookies, request,
+                                                response.raw)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+class OneslateSession(requests.Session):
+    # requests.Session that remembers how to log in.  A request rejected with
+    # 401 or 422 (expired cookies or stale CSRF token) triggers one fresh
+    # login and is then re-sent.  Callers may keep passing the token they got
+    # from get_session: tokens replaced by a later login are swapped for the
+    # current one before each request is sent.  Logins verify certificates
+    # as verify says, cert_in_use when the session was made by default.
+
+    def __init__(self, server=None, user=None, passwd=None, verify=None):
+        super(OneslateSession, self).__init__()
+        self.server = server
+        self.user = user
+        self.passwd = passwd
+        self.verify = oneslate.cert_in_use if verify is None else verify
+        self.csrf_token = None
+        self.csrf_expires_at = None
+        self.stale_csrf_tokens = set()
+        self._login_lock = threading.Lock()
+
+    def prepare_request(self, request):
+        prepared = super(OneslateSession, self).prepare_request(request)
+        if prepared.headers.get("X-CSRF-Token") in self.stale_csrf_tokens:
+            prepared.headers["X-CSRF-Token"] = self.csrf_token
+        return prepared
+
+    def request(self, method, url, *args, **kwargs):
+        token_used = self.csrf_token
+        response = super(OneslateSession, self).request(method, url, *args,
+                                                        **kwargs)
+        if (response.status_code in (401, 422) and self.user is not None and
+                not url.startswith(oneslate.get_login_url(self.server))):
+            logging.info("Request was refused with status code {0}. About to "
+                         "log in again.".format(response.status_code))
+            # A streamed response holds its pooled connection until closed,
+            # which the login may need.
+            response.close()
+            with self._login_lock:
+                # Another thread may already have logged in again.
+                if self.csrf_token == token_used:
+                    self.log_in()
+            if self.csrf_token != token_used:
+                response = super(OneslateSession, self).request(
+                    method, url, *args, **kwargs)
+        return response
+
+    def set_csrf_token(self, xcsrf_token, expires_at=None):
+        if self.csrf_token is not None and self.csrf_token != xcsrf_token:
+            self.stale_csrf_tokens.add(self.csrf_token)
+        self.csrf_token = xcsrf_token
+        if expires_at is None:
+            expires_at = time.time() + oneslate.CSRF_TOKEN_MAX_AGE
+            cookie_expiries = [c.expires for c in self.cookies if c.expires]
+            if cookie_expiries:
+                expires_at = min([expires_at] + cookie_expiries)
+        self.csrf_expires_at = expires_at
+        if "X-CSRF-Token" in self.headers:
+            self.headers["X-CSRF-Token"] = xcsrf_token
+        return xcsrf_token
+
+    def log_in(self):
+        login_url = oneslate.get_login_url(self.server)
+        # load login URL
+        # Logins skip the rate limiter: the request that was refused still
+        # holds its in-flight slot, as may threads waiting for this login.
+        page = oneslate.send_request(self, 'GET', login_url, limited=False,
+                                     verify=self.verify)
+        oneslate.log_response(page)
+        # try to get csrf-token to show already logged in
+        xcsrf_token = oneslate.extract_csrf_token(page.text)
+        if xcsrf_token is not None:
+            # Already logged in, no need to log in again
+            logging.info("Provided session appears valid.  Going to try "
+                         "to reuse it.")
+            return self.set_csrf_token(xcsrf_token)
+        logging.info("Did not appear to have valid current session. About to "
+                     "try logging in for a new session.")
+        # Could not get csrf-token, not logged in yet, so log in freshly.
+        token = oneslate.extract_authenticity_token(page.text)
+        logging.debug("token = {token}".format(**locals()))
+        payload = {
+            'utf8': '✓',
+            'authenticity_token': token,
+            'private_user[email]': self.user,
+            'private_user[password]': self.passwd,
+            'private_user[remember_me]': '1',
+            'commit': 'Sign in',
+        }
+        r = oneslate.send_request(self, 'POST', login_url, data=payload,
+                                  limited=False, verify=self.verify)
+        oneslate.log_response(r)
+        xcsrf_token = oneslate.extract_csrf_token(r.text)
+        if xcsrf_token is None:
+            logging.warning("No XCSRF token found when logging in! Are the "
+                            "username and password correct?")
+            return None
+        return self.set_csrf_token(xcsrf_token)